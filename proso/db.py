@@ -1,9 +1,14 @@
 from contextlib import closing
 from django.db import connection
+from proso.django.util import is_on_postgresql
 import csv
 import re
 
 
+COPY_BUFFER_SIZE = 2 ** 16
+INSERT_CHUNK_SIZE = 10000
+
+
 def dump_table(table_name, pk_column, batch_size, dest_file):
     with closing(connection.cursor()) as cursor:
         cursor.execute('SELECT COUNT(*) FROM {}'.format(table_name))
@@ -27,3 +32,100 @@ def dump_cursor(cursor, dest_file, append=False):
         for row in cursor:
             row = [str(val) for val in row]
             writer.writerow(row)
+
+
+def copy_rows(cursor, table_name, columns, rows):
+    """
+    Loads the rows into the table without any temporary file. On PostgreSQL
+    the rows are formatted lazily and streamed to COPY FROM STDIN, so only a
+    bounded buffer is kept in the memory, other databases get chunked
+    executemany.
+
+    Args:
+        cursor: database cursor
+        table_name (str): name of the table
+        columns (list): names of the columns
+        rows (iterable): tuples with values of the columns, values can't
+            contain commas and None stands for NULL
+    """
+    if is_on_postgresql():
+        cursor.copy_from(RowsFile(rows), table_name, sep=',', null='None', columns=columns)
+        return
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table_name, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == INSERT_CHUNK_SIZE:
+            cursor.executemany(sql, chunk)
+            chunk = []
+    if chunk:
+        cursor.executemany(sql, chunk)
+
+
+def delete_by_ids(cursor, table_name, ids, pk_column='id'):
+    """
+    Deletes the rows with the given identifiers. The identifiers are loaded
+    into a temporary table which is joined, instead of building one huge IN
+    condition.
+
+    Returns:
+        int: number of deleted rows
+    """
+    if not ids:
+        return 0
+    # the temporary table lives as long as the connection, it can be left
+    # there by a previous call which failed (the connection is reused)
+    cursor.execute('DROP TABLE IF EXISTS proso_ids_to_delete')
+    cursor.execute('CREATE TEMPORARY TABLE proso_ids_to_delete (id BIGINT)')
+    copy_rows(cursor, 'proso_ids_to_delete', ['id'], ((i,) for i in ids))
+    if is_on_postgresql():
+        cursor.execute('DELETE FROM {0} USING proso_ids_to_delete WHERE {0}.{1} = proso_ids_to_delete.id'.format(table_name, pk_column))
+    else:
+        cursor.execute('DELETE FROM {0} WHERE {1} IN (SELECT id FROM proso_ids_to_delete)'.format(table_name, pk_column))
+    deleted = cursor.rowcount
+    cursor.execute('DROP TABLE proso_ids_to_delete')
+    return deleted
+
+
+class RowsFile:
+    """
+    Read-only file-like object with the given rows in the text format of
+    COPY (comma separated, 'None' for NULL). The rows are consumed only when
+    they are read.
+    """
+
+    def __init__(self, rows, buffer_size=COPY_BUFFER_SIZE):
+        self._rows = iter(rows)
+        self._buffer_size = buffer_size
+        self._buffer = ''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._buffer_size
+        self._fill(size)
+        result, self._buffer = self._buffer[:size], self._buffer[size:]
+        return result
+
+    def readline(self, size=-1):
+        while '\n' not in self._buffer and self._rows is not None:
+            self._fill(len(self._buffer) + self._buffer_size)
+        position = self._buffer.find('\n') + 1
+        if position == 0:
+            position = len(self._buffer)
+        result, self._buffer = self._buffer[:position], self._buffer[position:]
+        return result
+
+    def _fill(self, size):
+        if len(self._buffer) >= size or self._rows is None:
+            return
+        lines = [self._buffer]
+        length = len(self._buffer)
+        for row in self._rows:
+            line = ','.join(map(str, row)) + '\n'
+            lines.append(line)
+            length += len(line)
+            if length >= size:
+                break
+        else:
+            self._rows = None
+        self._buffer = ''.join(lines)
@@ -2,6 +2,7 @@ from django.core.cache.backends.locmem import LocMemCache
 from django.views.decorators.cache import cache_page
 from functools import wraps
 from proso.django.config import get_config
+from proso.django.instrumentation import record_cache
 from threading import currentThread
 import logging
 
@@ -12,6 +13,7 @@ LOGGER = logging.getLogger('django.request')
 _request_cache = {}
 _request_permanent_cache = {}
 _installed_middleware = False
+_CACHE_MISS = object()
 
 
 def cache_page_conditional(condition, timeout=3600):
@@ -35,6 +37,14 @@ def set_to_request_permanent_cache(key, value):
     _request_permanent_cache[currentThread()][key] = value
 
 
+def has_request_permanent_cache():
+    """
+    Returns True if the current thread is handling (or has handled) a request,
+    i.e., the request permanent cache can be used.
+    """
+    return currentThread() in _request_permanent_cache
+
+
 def is_cache_prepared():
     return _installed_middleware
 
@@ -50,6 +60,11 @@ class RequestCache(LocMemCache):
         params = {'max_entries': get_config('proso_common', 'request_cache.max_entries', 100000)}
         super(RequestCache, self).__init__(name, params)
 
+    def get(self, key, default=None, version=None):
+        value = super(RequestCache, self).get(key, _CACHE_MISS, version)
+        record_cache('request_cache', value is not _CACHE_MISS)
+        return default if value is _CACHE_MISS else value
+
 
 class RequestCacheMiddleware(object):
 
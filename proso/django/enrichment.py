@@ -50,6 +50,7 @@ This module provides enrichment for JSON objects.
 """
 
 from collections import defaultdict
+from proso.django.instrumentation import scope
 from proso.func import is_lambda
 from proso.list import flatten
 from threading import Lock
@@ -97,7 +98,8 @@ def enrich_json_objects_by_object_type(request, value):
             enricher_nested = any(nested.values())
         if len(enricher_objects) > 0:
             time_start = time()
-            enricher_info['enricher'](request, enricher_objects, enricher_nested)
+            with scope('enricher', enricher_info['enricher_name']):
+                enricher_info['enricher'](request, enricher_objects, enricher_nested)
             LOGGER.debug('enrichment "{}" took {} seconds'.format(enricher_info['enricher_name'], time() - time_start))
             if not enricher_info['pure']:
                 # if the enricher modified object types we must collect objects
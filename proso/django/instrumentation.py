@@ -0,0 +1,305 @@
+"""
+Per-request instrumentation: the number and the cumulative time of SQL
+queries grouped by the view, the enricher and the environment method which
+executed them, and the hits and misses of caches. The results of the request
+are sent in the Server-Timing header and attached to the debug JSON for staff
+(see :py:func:`proso.django.response.render_json`), all the requests are
+aggregated into histograms (see :py:func:`get_histograms`).
+"""
+from collections import defaultdict
+from django.db import connections
+from functools import wraps
+from threading import currentThread, Lock
+from time import time
+import inspect
+
+
+# upper bounds of the histogram buckets, the last bucket is unbounded
+QUERIES_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+MILLISECONDS_BUCKETS = [5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+SERVER_TIMING_GROUPS = ['enricher', 'environment']
+
+_installed_middleware = False
+# thread -> statistics of the currently processed request
+_request_stats = {}
+# view -> aggregated statistics of all processed requests
+_histograms = {}
+_histograms_lock = Lock()
+
+
+def is_active():
+    return currentThread() in _request_stats
+
+
+def is_instrumentation_prepared():
+    return _installed_middleware
+
+
+class scope:
+    """
+    Context manager attributing the SQL queries executed within it to the
+    given group and name. Only the innermost scope of each group is taken
+    into account.
+    """
+
+    def __init__(self, group, name):
+        self._group = group
+        self._name = name
+        self._stats = None
+
+    def __enter__(self):
+        self._stats = _request_stats.get(currentThread())
+        if self._stats is not None:
+            self._nested = (self._group, self._name) in self._stats['stack']
+            self._stats['stack'].append((self._group, self._name))
+            self._start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._stats is None:
+            return
+        self._stats['stack'].pop()
+        if not self._nested:
+            record = self._stats['scopes'][self._group, self._name]
+            record['calls'] += 1
+            record['time'] += time() - self._start
+
+
+def instrument(group, name=None):
+    """
+    Decorator executing the function within :py:class:`scope`.
+
+    Args:
+        group (str): e.g. 'environment'
+        name (str): name of the scope, the name of the function by default
+    """
+    def _instrument(func):
+        scope_name = func.__name__ if name is None else name
+
+        @wraps(func)
+        def _wrapper(*args, **kwargs):
+            if currentThread() not in _request_stats:
+                return func(*args, **kwargs)
+            with scope(group, scope_name):
+                return func(*args, **kwargs)
+        return _wrapper
+    return _instrument
+
+
+def instrument_methods(group):
+    """
+    Class decorator instrumenting all public methods defined in the class,
+    the scopes are named 'ClassName.method'.
+    """
+    def _instrument_methods(cls):
+        for name, member in list(cls.__dict__.items()):
+            if not name.startswith('_') and inspect.isfunction(member):
+                setattr(cls, name, instrument(group, '{}.{}'.format(cls.__name__, name))(member))
+        return cls
+    return _instrument_methods
+
+
+def record_query(duration):
+    stats = _request_stats.get(currentThread())
+    if stats is None:
+        return
+    stats['sql']['count'] += 1
+    stats['sql']['time'] += duration
+    found_groups = set()
+    for group, name in reversed(stats['stack']):
+        if group in found_groups:
+            continue
+        found_groups.add(group)
+        record = stats['scopes'][group, name]
+        record['queries'] += 1
+        record['sql_time'] += duration
+
+
+def record_cache(name, hit):
+    stats = _request_stats.get(currentThread())
+    if stats is None:
+        return
+    stats['caches'][name]['hits' if hit else 'misses'] += 1
+
+
+def get_request_stats():
+    """
+    Returns:
+        dict: JSON with the statistics of the currently processed request,
+        times are in milliseconds
+    """
+    stats = _request_stats[currentThread()]
+    scopes = defaultdict(dict)
+    for (group, name), record in stats['scopes'].items():
+        scopes[group][name] = {
+            'calls': record['calls'],
+            'time': _to_ms(record['time']),
+            'queries': record['queries'],
+            'sql_time': _to_ms(record['sql_time']),
+        }
+    return {
+        'view': stats['view'],
+        'time': _to_ms(time() - stats['start']),
+        'sql': {'count': stats['sql']['count'], 'time': _to_ms(stats['sql']['time'])},
+        'scopes': dict(scopes),
+        'caches': {
+            name: dict(record, ratio=record['hits'] / float(record['hits'] + record['misses']))
+            for name, record in stats['caches'].items()
+        },
+    }
+
+
+def get_histograms():
+    """
+    Returns:
+        dict: view -> number of requests and histograms of the number of
+        queries, the SQL time and the whole time of the requests (bucket upper
+        bound -> number of requests, None stands for the unbounded bucket)
+    """
+    with _histograms_lock:
+        return {
+            view: {
+                'requests': histogram['requests'],
+                'queries': _buckets_to_json(QUERIES_BUCKETS, histogram['queries']),
+                'sql_time': _buckets_to_json(MILLISECONDS_BUCKETS, histogram['sql_time']),
+                'time': _buckets_to_json(MILLISECONDS_BUCKETS, histogram['time']),
+            }
+            for view, histogram in _histograms.items()
+        }
+
+
+def reset_histograms():
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def server_timing(request_stats):
+    """
+    Returns:
+        str: value of the Server-Timing header for the given statistics (see
+        :py:func:`get_request_stats`)
+    """
+    entries = [
+        'total;dur={}'.format(request_stats['time']),
+        'sql;dur={};desc="{} queries"'.format(request_stats['sql']['time'], request_stats['sql']['count']),
+    ]
+    for group in SERVER_TIMING_GROUPS:
+        records = request_stats['scopes'].get(group, {}).values()
+        if len(records) > 0:
+            entries.append('{}-sql;dur={};desc="{} queries"'.format(
+                group, round(sum([r['sql_time'] for r in records]), 3), sum([r['queries'] for r in records])))
+    return ', '.join(entries)
+
+
+class InstrumentedCursor:
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def execute(self, sql, params=None):
+        return self._measure(self._cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._measure(self._cursor.executemany, sql, param_list)
+
+    def callproc(self, procname, params=None):
+        return self._measure(self._cursor.callproc, procname, params)
+
+    def _measure(self, func, *args):
+        start = time()
+        try:
+            return func(*args)
+        finally:
+            record_query(time() - start)
+
+
+class InstrumentationMiddleware(object):
+
+    def __init__(self):
+        global _installed_middleware
+        _installed_middleware = True
+
+    def process_request(self, request):
+        for connection in connections.all():
+            _instrument_connection(connection)
+        _request_stats[currentThread()] = {
+            'start': time(),
+            'view': None,
+            'stack': [],
+            'sql': {'count': 0, 'time': 0.0},
+            'scopes': defaultdict(lambda: {'calls': 0, 'time': 0.0, 'queries': 0, 'sql_time': 0.0}),
+            'caches': defaultdict(lambda: {'hits': 0, 'misses': 0}),
+        }
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stats = _request_stats.get(currentThread())
+        if stats is None:
+            return
+        stats['view'] = '{}.{}'.format(view_func.__module__, getattr(view_func, '__name__', view_func.__class__.__name__))
+        # the view scope stays open until the response is processed
+        stats['stack'] = [('view', stats['view'])]
+
+    def process_response(self, request, response):
+        if currentThread() not in _request_stats:
+            return response
+        request_stats = get_request_stats()
+        del _request_stats[currentThread()]
+        _update_histograms(request_stats)
+        response['Server-Timing'] = server_timing(request_stats)
+        return response
+
+
+def _instrument_connection(connection):
+    if getattr(connection, '_proso_instrumented', False):
+        return
+    cursor = connection.cursor
+
+    @wraps(cursor)
+    def _cursor(*args, **kwargs):
+        if currentThread() not in _request_stats:
+            return cursor(*args, **kwargs)
+        return InstrumentedCursor(cursor(*args, **kwargs))
+
+    connection.cursor = _cursor
+    connection._proso_instrumented = True
+
+
+def _update_histograms(request_stats):
+    with _histograms_lock:
+        histogram = _histograms.setdefault(request_stats['view'], {
+            'requests': 0,
+            'queries': [0] * (len(QUERIES_BUCKETS) + 1),
+            'sql_time': [0] * (len(MILLISECONDS_BUCKETS) + 1),
+            'time': [0] * (len(MILLISECONDS_BUCKETS) + 1),
+        })
+        histogram['requests'] += 1
+        histogram['queries'][_bucket(QUERIES_BUCKETS, request_stats['sql']['count'])] += 1
+        histogram['sql_time'][_bucket(MILLISECONDS_BUCKETS, request_stats['sql']['time'])] += 1
+        histogram['time'][_bucket(MILLISECONDS_BUCKETS, request_stats['time'])] += 1
+
+
+def _bucket(buckets, value):
+    for i, upper_bound in enumerate(buckets):
+        if value <= upper_bound:
+            return i
+    return len(buckets)
+
+
+def _buckets_to_json(buckets, counts):
+    return [[upper_bound, count] for upper_bound, count in zip(buckets + [None], counts) if count > 0]
+
+
+def _to_ms(seconds):
+    return round(seconds * 1000, 3)
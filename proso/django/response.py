@@ -6,6 +6,7 @@ from time import time
 import json as simplejson
 import logging
 import markdown
+import proso.django.instrumentation
 import proso.django.log
 import proso.release
 
@@ -55,6 +56,8 @@ def render_json(request, json, template=None, status=None, help_text=None, versi
         LOGGER.warning('%s: %s', json['error_type'], json['error'])
     if 'debug' in request.GET and request.user.is_staff and proso.django.log.is_log_prepared():
         json['debug_log'] = proso.django.log.get_request_log()
+    if 'debug' in request.GET and request.user.is_staff and proso.django.instrumentation.is_active():
+        json['debug_instrumentation'] = proso.django.instrumentation.get_request_stats()
     if 'html' in request.GET:
         if help_text is not None:
             help_text = markdown.markdown(help_text)
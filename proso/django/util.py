@@ -5,6 +5,7 @@ from functools import wraps
 
 
 from proso.django.cache import get_request_cache, is_cache_prepared
+from proso.django.instrumentation import record_cache
 import hashlib
 import logging
 import re
@@ -40,14 +41,17 @@ def cache_pure(f, expiration=60 * 60 * 24 * 30):
         if is_cache_prepared():
             value = get_request_cache().get(hash_key, CACHE_MISS)
             if value != CACHE_MISS:
+                record_cache('cache_pure', True)
                 LOGGER.debug("loaded function result (%s...) form REQUEST CACHE; key: %s..., hash %s", str(value)[:300], key[:300], hash_key)
                 return value
 
         value = cache.get(hash_key, CACHE_MISS)
         if value != CACHE_MISS:
+            record_cache('cache_pure', True)
             LOGGER.debug("loaded function result (%s...) form CACHE; key: %s..., hash %s", str(value)[:300], key[:300], hash_key)
             return value
 
+        record_cache('cache_pure', False)
         value = f(*args, **kwargs)
         LOGGER.debug("saved function result (%s...) to CACHE; key: %s..., hash %s", str(value)[:300], key[:300], hash_key)
         cache.set(hash_key, value, expiration)
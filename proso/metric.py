@@ -28,3 +28,34 @@ def confidence_value_to_json(confidence_value):
 
 def format_number(x):
     return float('{0:.2f}'.format(x))
+
+
+def rmse(observed, predicted):
+    observed = numpy.asarray(observed, dtype=float)
+    predicted = numpy.asarray(predicted, dtype=float)
+    return float(numpy.sqrt(numpy.mean((observed - predicted) ** 2)))
+
+
+def log_loss(observed, predicted, eps=1e-15):
+    observed = numpy.asarray(observed, dtype=float)
+    predicted = numpy.clip(numpy.asarray(predicted, dtype=float), eps, 1 - eps)
+    return float(-numpy.mean(observed * numpy.log(predicted) + (1 - observed) * numpy.log(1 - predicted)))
+
+
+def auc(observed, predicted):
+    """
+    Area under the ROC curve computed from the ranks of the predictions
+    (Mann-Whitney U statistic), ties get the average rank.
+
+    Returns:
+        float: AUC, or NaN if only one class is observed
+    """
+    observed = numpy.asarray(observed, dtype=bool)
+    predicted = numpy.asarray(predicted, dtype=float)
+    positive = observed.sum()
+    negative = len(observed) - positive
+    if positive == 0 or negative == 0:
+        return float('nan')
+    _, inverse, counts = numpy.unique(predicted, return_inverse=True, return_counts=True)
+    ranks = (numpy.cumsum(counts) - (counts - 1) / 2.0)[inverse]
+    return float((ranks[observed].sum() - positive * (positive + 1) / 2.0) / (positive * negative))
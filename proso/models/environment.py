@@ -1,8 +1,20 @@
 # -*- coding: utf-8 -*-
 import abc
+import array
 import unittest
 import datetime
-from collections import defaultdict
+import itertools
+import json
+import numpy
+import os
+from collections import defaultdict, deque
+
+
+_IN_MEMORY_ENVIRONMENT_IDS = itertools.count()
+
+READ_MANY_KEYS_ANSWERS = ['number_of_answers', 'number_of_correct_answers', 'number_of_first_answers', 'last_answer_time']
+
+_EPOCH = datetime.datetime(1970, 1, 1)
 
 
 ################################################################################
@@ -49,6 +61,35 @@ class Environment(metaclass=abc.ABCMeta):
     def get_items_with_values_more_items(self, key, items, user=None):
         pass
 
+    @abc.abstractmethod
+    def get_all_items_with_values(self, key, user=None):
+        """
+        Returns all (not only the given ones) items having a value for the
+        given key together with the secondary items and the values.
+
+        Args:
+            key (str):
+                name of the variable, e.g. 'parent'
+            user (int):
+                identifier of the user, or None for global variables
+
+        Returns:
+            dict: item -> [(item_secondary, value)]
+        """
+        pass
+
+    def items_with_values_version(self, key):
+        """
+        Returns a hashable version of the values for the given key. The version
+        changes whenever the values are changed, so it can be used to cache
+        structures computed from :py:meth:`get_all_items_with_values`.
+
+        Returns:
+            hashable object, or None if the version is unknown and the values
+            should not be cached
+        """
+        return None
+
     @abc.abstractmethod
     def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
         pass
@@ -57,6 +98,79 @@ class Environment(metaclass=abc.ABCMeta):
     def read_more_items(self, key, items, user=None, item=None, default=None, symmetric=True):
         pass
 
+    def read_many_keys(self, keys_spec, items, user=None):
+        """
+        Reads values of more keys for the given user and items at once. The
+        default implementation calls the other methods one by one, but
+        the implementation can fetch all the values in one round-trip.
+
+        Args:
+            keys_spec (dict):
+                name -> specification (dict) with the following fields:
+                    'key': name of the variable, or
+                    'answers': 'number_of_answers', 'number_of_correct_answers',
+                        'number_of_first_answers' or 'last_answer_time',
+                    'user': False for global values (True by default),
+                    'items': False for values not related to items, or list
+                        of items to use instead of the given ones (True by default),
+                    'time': True to read the time of the last update of the
+                        variable instead of its value (False by default),
+                    'default': default value of the variable (None by default)
+            items (list):
+                identifiers of items
+            user (int):
+                identifier of the user
+
+        Returns:
+            dict: name -> value, or list of values ordered as the items
+        """
+        result = {}
+        for name, spec in keys_spec.items():
+            spec_user, spec_items = self._read_many_keys_target(spec, items, user)
+            if 'answers' in spec:
+                if spec_items is None:
+                    result[name] = getattr(self, spec['answers'])(user=spec_user)
+                else:
+                    result[name] = getattr(self, spec['answers'] + '_more_items')(items=spec_items, user=spec_user)
+            elif spec.get('time', False):
+                if spec_items is None:
+                    result[name] = self.time(spec['key'], user=spec_user)
+                else:
+                    result[name] = self.time_more_items(spec['key'], items=spec_items, user=spec_user)
+            else:
+                if spec_items is None:
+                    result[name] = self.read(spec['key'], user=spec_user, default=spec.get('default'))
+                else:
+                    result[name] = self.read_more_items(
+                        spec['key'], items=spec_items, user=spec_user, default=spec.get('default'))
+        return result
+
+    def read_many_keys_more_users(self, keys_spec, items, users):
+        """
+        Reads values of more keys for the given users and items at once (see
+        :py:meth:`read_many_keys`). The default implementation reads the values
+        for the users one by one.
+
+        Args:
+            keys_spec (dict): name -> specification (see :py:meth:`read_many_keys`)
+            items (list): identifiers of items
+            users (list): identifiers of users
+
+        Returns:
+            list: dicts (name -> value, or list of values ordered as the items)
+            ordered as the users
+        """
+        return [self.read_many_keys(keys_spec, items, user=user) for user in users]
+
+    def read_more_users_more_items(self, key, items, users, default=None):
+        """
+        Returns:
+            list: list of values (ordered as the items) for each of the given
+            users
+        """
+        fetched = self.read_many_keys_more_users({'values': {'key': key, 'default': default}}, items, users)
+        return [user_fetched['values'] for user_fetched in fetched]
+
     @abc.abstractmethod
     def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=True, answer=None):
         pass
@@ -97,6 +211,18 @@ class Environment(metaclass=abc.ABCMeta):
         """
         pass
 
+    def _read_many_keys_target(self, spec, items, user):
+        if 'answers' in spec and spec['answers'] not in READ_MANY_KEYS_ANSWERS:
+            raise Exception('Unsupported answers specification: {}'.format(spec['answers']))
+        if 'answers' not in spec and 'key' not in spec:
+            raise Exception('Either key or answers has to be specified')
+        spec_items = spec.get('items', True)
+        if spec_items is True:
+            spec_items = items
+        elif spec_items is False:
+            spec_items = None
+        return (user if spec.get('user', True) else None), spec_items
+
 
 class CommonEnvironment(Environment):
 
@@ -124,6 +250,22 @@ class CommonEnvironment(Environment):
     def number_of_first_answers_more_items(self, items, user=None):
         pass
 
+    def number_of_answers_more_users_more_items(self, items, users):
+        """
+        Returns:
+            list: list of numbers of answers (ordered as the items) for each of
+            the given users
+        """
+        return self._answers_more_users_more_items('number_of_answers', items, users)
+
+    def number_of_correct_answers_more_users_more_items(self, items, users):
+        """
+        Returns:
+            list: list of numbers of correct answers (ordered as the items) for
+            each of the given users
+        """
+        return self._answers_more_users_more_items('number_of_correct_answers', items, users)
+
     @abc.abstractmethod
     def last_answer_time(self, user=None, item=None, context=None):
         pass
@@ -144,22 +286,51 @@ class CommonEnvironment(Environment):
     def rolling_success(self, user, window_size=10):
         pass
 
+    def _answers_more_users_more_items(self, answers, items, users):
+        fetched = self.read_many_keys_more_users({answers: {'answers': answers}}, items, users)
+        return [user_fetched[answers] for user_fetched in fetched]
+
 
 ################################################################################
 # Implementation
 ################################################################################
 
-class InMemoryEnvironment(CommonEnvironment):
+class AbstractInMemoryEnvironment(CommonEnvironment):
+
+    """
+    Base class for the environments keeping the data in the memory, the
+    subclasses only define how the variables are stored (see
+    :py:meth:`_get`).
+    """
 
     NUMBER_OF_ANSWERS = 'number_of_answers'
     NUMBER_OF_CORRECT_ANSWERS = 'number_of_correct_answers'
     NUMBER_OF_FIRST_ANSWERS = 'number_of_first_answers'
     LAST_CORRECTNESS = 'last_correctness'
     CONFUSING_FACTOR = 'confusing_factor'
+    AUDIT_SPILL = 'spill'
 
-    def __init__(self):
-        # key -> user -> item_primary -> item_secondary -> [(permanent, time, value)]
-        self._data = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(list))))
+    def __init__(self, audit_retention=None, audit_spill=None):
+        """
+        Args:
+            audit_retention (dict):
+                key -> retention policy of the audit history for variables
+                with the given key: number of the kept records (0 means only
+                the current value is kept) or 'spill' (only the current value
+                is kept and the records are passed to the audit_spill), the
+                history for the other keys is unbounded
+            audit_spill (function):
+                function called with (key, user, item_primary, item_secondary,
+                time, answer, value) for each audit record of the keys with
+                'spill' policy
+        """
+        # key -> number of changes
+        self._versions = defaultdict(int)
+        self._environment_id = next(_IN_MEMORY_ENVIRONMENT_IDS)
+        self._audit_retention = audit_retention if audit_retention else {}
+        self._audit_spill = audit_spill
+        if self.AUDIT_SPILL in self._audit_retention.values() and audit_spill is None:
+            raise Exception("The audit spill has to be specified for keys with 'spill' retention policy.")
 
     def process_answer(self, user, item, asked, answered, time, answer, response_time, guess, **kwargs):
         if time is None:
@@ -181,25 +352,12 @@ class InMemoryEnvironment(CommonEnvironment):
             self.update(self.CONFUSING_FACTOR, 0, increment, item=asked, item_secondary=answered, answer=answer)
             self.update(self.CONFUSING_FACTOR, 0, increment, item=asked, item_secondary=answered, user=user, answer=answer)
 
-    def audit(self, key, user=None, item=None, item_secondary=None, limit=None, symmetric=True):
-        items = [item_secondary, item]
-        if symmetric and item is not None and item_secondary is not None:
-            items.sort()
-        found = self._data[key][user][items[1]][items[0]]
-        if found and found[0][0]:
-            return []
-        found = [(x[1], x[3]) for x in found]
-        if limit is not None:
-            found = found[-limit:]
-        found.reverse()
-        return found
-
-    def get_items_with_values(self, key, item, user=None):
-        return [(i_l[0], i_l[1][-1][3]) for i_l in list(self._data[key][user][item].items())]
-
     def get_items_with_values_more_items(self, key, items, user=None):
         return [self.get_items_with_values(key, i, user) for i in items]
 
+    def items_with_values_version(self, key):
+        return (self._environment_id, key, self._versions[key])
+
     def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
         found = self._get(key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
         if found:
@@ -210,40 +368,6 @@ class InMemoryEnvironment(CommonEnvironment):
     def read_more_items(self, key, items, user=None, item=None, default=None, symmetric=True):
         return [self.read(key, user, i, item, default, symmetric) for i in items]
 
-    def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
-        value = float(value)
-        if permanent:
-            audit = False
-        items = [item_secondary, item]
-        if symmetric and item is not None and item_secondary is not None:
-            items.sort()
-        if time is None:
-            time = datetime.datetime.now()
-        found = self._data[key][user][items[1]][items[0]]
-        if len(found) and found[-1][0] != permanent:
-            raise Exception("The variable %s for items %s, %s and user %s changed permamency from %s to %s" % (
-                key, item, item_secondary, user, found[-1][0], permanent
-            ))
-        if audit or not found:
-            found.append((permanent, time, answer, value))
-        else:
-            found[-1] = (permanent, time, answer, value)
-
-    def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
-        items = [item_secondary, item]
-        if symmetric and item is not None and item_secondary is not None:
-            items.sort()
-        found = self._data[key][user][items[1]][items[0]]
-        if len(found) and not found[-1][0]:
-            raise Exception("Can't delete variable %s which is not permanent." % key)
-        del self._data[key][user][items[1]][items[0]]
-        if len(self._data[key][user][items[1]]) == 0:
-            del self._data[key][user][items[1]]
-            if len(self._data[key][user]) == 0:
-                del self._data[key][user]
-                if len(self._data[key]):
-                    del self._data[key]
-
     def time(self, key, user=None, item=None, item_secondary=None, symmetric=True):
         found = self._get(key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
         if found:
@@ -302,6 +426,87 @@ class InMemoryEnvironment(CommonEnvironment):
     def confusing_factor_more_items(self, item, items, user=None):
         return self.read_more_items(self.CONFUSING_FACTOR, item=item, items=items, user=user, default=0)
 
+    @abc.abstractmethod
+    def _get(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        """
+        Returns:
+            tuple: (permanent, time, answer, value) of the variable, None
+            if there is no such variable
+        """
+        pass
+
+
+class InMemoryEnvironment(AbstractInMemoryEnvironment):
+
+    def __init__(self, audit_retention=None, audit_spill=None):
+        AbstractInMemoryEnvironment.__init__(self, audit_retention=audit_retention, audit_spill=audit_spill)
+        # key -> user -> item_primary -> item_secondary -> [(permanent, time, value)]
+        self._data = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(list))))
+
+    def audit(self, key, user=None, item=None, item_secondary=None, limit=None, symmetric=True):
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items.sort()
+        found = self._data[key][user][items[1]][items[0]]
+        if found and found[0][0]:
+            return []
+        found = [(x[1], x[3]) for x in found]
+        if limit is not None:
+            found = found[-limit:]
+        found.reverse()
+        return found
+
+    def get_items_with_values(self, key, item, user=None):
+        return [(i_l[0], i_l[1][-1][3]) for i_l in list(self._data[key][user][item].items())]
+
+    def get_all_items_with_values(self, key, user=None):
+        return {
+            item: [(i_l[0], i_l[1][-1][3]) for i_l in secondaries.items() if i_l[1]]
+            for item, secondaries in self._data[key][user].items()
+        }
+
+    def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
+        value = float(value)
+        if permanent:
+            audit = False
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items.sort()
+        if time is None:
+            time = datetime.datetime.now()
+        found = self._data[key][user][items[1]][items[0]]
+        if len(found) and found[-1][0] != permanent:
+            raise Exception("The variable %s for items %s, %s and user %s changed permamency from %s to %s" % (
+                key, item, item_secondary, user, found[-1][0], permanent
+            ))
+        if audit or not found:
+            if not found and key in self._audit_retention:
+                retention = self._audit_retention[key]
+                found = deque(maxlen=1 if retention == self.AUDIT_SPILL else max(1, retention))
+                self._data[key][user][items[1]][items[0]] = found
+            found.append((permanent, time, answer, value))
+            if not permanent and self._audit_retention.get(key) == self.AUDIT_SPILL:
+                self._audit_spill(key, user, items[1], items[0], time, answer, value)
+        else:
+            found[-1] = (permanent, time, answer, value)
+        self._versions[key] += 1
+
+    def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items.sort()
+        found = self._data[key][user][items[1]][items[0]]
+        if len(found) and not found[-1][0]:
+            raise Exception("Can't delete variable %s which is not permanent." % key)
+        self._versions[key] += 1
+        del self._data[key][user][items[1]][items[0]]
+        if len(self._data[key][user][items[1]]) == 0:
+            del self._data[key][user][items[1]]
+            if len(self._data[key][user]) == 0:
+                del self._data[key][user]
+                if len(self._data[key]):
+                    del self._data[key]
+
     def export_values(self):
         for key, users in self._data.items():
             for user, primaries in users.items():
@@ -312,7 +517,13 @@ class InMemoryEnvironment(CommonEnvironment):
                             yield (key, user, item_primary, item_secondary, permanent, time, answer, value)
 
     def export_audit(self):
+        """
+        Yields the kept audit records, records for the keys with 'spill'
+        retention policy have been already passed to the audit spill.
+        """
         for key, users in self._data.items():
+            if self._audit_retention.get(key) == self.AUDIT_SPILL:
+                continue
             for user, primaries in users.items():
                 for item_primary, secondaries in primaries.items():
                     for item_secondary, values in secondaries.items():
@@ -331,6 +542,427 @@ class InMemoryEnvironment(CommonEnvironment):
             return None
 
 
+class CompactInMemoryEnvironment(AbstractInMemoryEnvironment):
+
+    """
+    In-memory environment with the same semantics as
+    :py:class:`InMemoryEnvironment`, but storing the data compactly. The keys
+    are interned and there is only one flat index (key, user, item_primary,
+    item_secondary) -> row. The current values are stored in array-backed
+    columns and the audit history in separate append-only arrays where each
+    record points to the previous record of the same variable. The records
+    dropped because of the audit retention policy and the rows of the deleted
+    variables are reused.
+    """
+
+    _NONE = -2 ** 63
+
+    def __init__(self, audit_retention=None, audit_spill=None):
+        AbstractInMemoryEnvironment.__init__(self, audit_retention=audit_retention, audit_spill=audit_spill)
+        self._key_ids = {}
+        self._key_names = []
+        # (key id, user, item_primary, item_secondary) -> row
+        self._index = {}
+        # (key id, user, item_primary) -> [item_secondary], only for not None secondary items
+        self._secondaries = {}
+        # current values
+        self._values = array.array('d')
+        self._times = array.array('q')
+        self._answers = array.array('q')
+        self._permanent = array.array('b')
+        self._last_audit = array.array('q')
+        # rows of the deleted variables
+        self._free_rows = array.array('q')
+        # audit history
+        self._audit_values = array.array('d')
+        self._audit_times = array.array('q')
+        self._audit_answers = array.array('q')
+        self._audit_previous = array.array('q')
+        # positions of the dropped audit records
+        self._audit_free = array.array('q')
+
+    def audit(self, key, user=None, item=None, item_secondary=None, limit=None, symmetric=True):
+        row = self._row(key, user, item, item_secondary, symmetric)
+        if row is None or self._permanent[row]:
+            return []
+        found = []
+        position = self._last_audit[row]
+        while position >= 0 and (limit is None or len(found) < limit):
+            found.append((_microseconds_to_datetime(self._audit_times[position]), self._audit_values[position]))
+            position = self._audit_previous[position]
+        return found
+
+    def get_items_with_values(self, key, item, user=None):
+        key_id = self._key_ids.get(key)
+        if key_id is None:
+            return []
+        secondaries = self._secondaries.get((key_id, user, item), [])
+        found = [None] if (key_id, user, item, None) in self._index else []
+        return [(i, self._values[self._index[key_id, user, item, i]]) for i in found + secondaries]
+
+    def get_all_items_with_values(self, key, user=None):
+        key_id = self._key_ids.get(key)
+        result = {}
+        for (k, u, item_primary, item_secondary), row in self._index.items():
+            if k == key_id and u == user:
+                result.setdefault(item_primary, []).append((item_secondary, self._values[row]))
+        return result
+
+    def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
+        value = float(value)
+        if permanent:
+            audit = False
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items.sort()
+        if time is None:
+            time = datetime.datetime.now()
+        time = _datetime_to_microseconds(time)
+        answer = self._NONE if answer is None else answer
+        key_id = self._key_ids.get(key)
+        if key_id is None:
+            key_id = self._key_ids[key] = len(self._key_names)
+            self._key_names.append(key)
+        index_key = (key_id, user, items[1], items[0])
+        row = self._index.get(index_key)
+        if row is None:
+            row = self._index[index_key] = self._new_row(value, time, answer, permanent)
+            if items[0] is not None:
+                self._secondaries.setdefault((key_id, user, items[1]), []).append(items[0])
+            audit = not permanent
+        elif self._permanent[row] != permanent:
+            raise Exception("The variable %s for items %s, %s and user %s changed permamency from %s to %s" % (
+                key, item, item_secondary, user, bool(self._permanent[row]), permanent
+            ))
+        self._values[row] = value
+        self._times[row] = time
+        self._answers[row] = answer
+        if permanent:
+            self._versions[key] += 1
+            return
+        retention = self._audit_retention.get(key)
+        if retention == self.AUDIT_SPILL and audit:
+            self._audit_spill(key, user, items[1], items[0], _microseconds_to_datetime(time), self._to_answer(answer), value)
+        if audit and retention not in (0, self.AUDIT_SPILL):
+            self._last_audit[row] = self._new_audit_record(value, time, answer, self._last_audit[row])
+            if retention is not None:
+                self._drop_audit_records(self._last_audit[row], retention)
+        elif self._last_audit[row] < 0:
+            self._last_audit[row] = self._new_audit_record(value, time, answer, -1)
+        else:
+            position = self._last_audit[row]
+            self._audit_values[position] = value
+            self._audit_times[position] = time
+            self._audit_answers[position] = answer
+        self._versions[key] += 1
+
+    def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items.sort()
+        key_id = self._key_ids.get(key)
+        row = self._index.get((key_id, user, items[1], items[0]))
+        if row is None:
+            return
+        if not self._permanent[row]:
+            raise Exception("Can't delete variable %s which is not permanent." % key)
+        self._versions[key] += 1
+        del self._index[key_id, user, items[1], items[0]]
+        if items[0] is not None:
+            secondaries = self._secondaries[key_id, user, items[1]]
+            secondaries.remove(items[0])
+            if len(secondaries) == 0:
+                del self._secondaries[key_id, user, items[1]]
+        self._free_rows.append(row)
+
+    def export_values(self):
+        for (key_id, user, item_primary, item_secondary), row in self._index.items():
+            yield (
+                self._key_names[key_id], user, item_primary, item_secondary, bool(self._permanent[row]),
+                _microseconds_to_datetime(self._times[row]), self._to_answer(self._answers[row]), self._values[row])
+
+    def export_audit(self):
+        for (key_id, user, item_primary, item_secondary), row in self._index.items():
+            if self._audit_retention.get(self._key_names[key_id]) == self.AUDIT_SPILL:
+                continue
+            positions = []
+            position = self._last_audit[row]
+            while position >= 0:
+                positions.append(position)
+                position = self._audit_previous[position]
+            for position in reversed(positions):
+                yield (
+                    self._key_names[key_id], user, item_primary, item_secondary,
+                    _microseconds_to_datetime(self._audit_times[position]), self._to_answer(self._audit_answers[position]),
+                    self._audit_values[position])
+
+    def _get(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        row = self._row(key, user, item, item_secondary, symmetric)
+        if row is None:
+            return None
+        return (
+            bool(self._permanent[row]), _microseconds_to_datetime(self._times[row]),
+            self._to_answer(self._answers[row]), self._values[row])
+
+    def _new_row(self, value, time, answer, permanent):
+        if len(self._free_rows) > 0:
+            row = self._free_rows.pop()
+            self._values[row] = value
+            self._times[row] = time
+            self._answers[row] = answer
+            self._permanent[row] = permanent
+            self._last_audit[row] = -1
+            return row
+        self._values.append(value)
+        self._times.append(time)
+        self._answers.append(answer)
+        self._permanent.append(permanent)
+        self._last_audit.append(-1)
+        return len(self._values) - 1
+
+    def _new_audit_record(self, value, time, answer, previous):
+        if len(self._audit_free) > 0:
+            position = self._audit_free.pop()
+            self._audit_values[position] = value
+            self._audit_times[position] = time
+            self._audit_answers[position] = answer
+            self._audit_previous[position] = previous
+            return position
+        self._audit_values.append(value)
+        self._audit_times.append(time)
+        self._audit_answers.append(answer)
+        self._audit_previous.append(previous)
+        return len(self._audit_values) - 1
+
+    def _drop_audit_records(self, position, retention):
+        for i in range(retention - 1):
+            position = self._audit_previous[position]
+            if position < 0:
+                return
+        while self._audit_previous[position] >= 0:
+            dropped = self._audit_previous[position]
+            self._audit_previous[position] = -1
+            self._audit_free.append(dropped)
+            position = dropped
+
+    def _row(self, key, user, item, item_secondary, symmetric):
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items.sort()
+        return self._index.get((self._key_ids.get(key), user, items[1], items[0]))
+
+    def _to_answer(self, answer):
+        return None if answer == self._NONE else answer
+
+
+def _datetime_to_microseconds(time):
+    """
+    Returns:
+        int: number of microseconds since the epoch, the aware datetimes are
+        converted to UTC, the naive ones are taken as they are
+    """
+    if time.tzinfo is not None:
+        time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (time - _EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _microseconds_to_datetime(microseconds):
+    return _EPOCH + datetime.timedelta(microseconds=int(microseconds))
+
+
+def save_snapshot(directory, values):
+    """
+    Saves the given values of variables into a columnar binary snapshot which
+    can be memory-mapped by :py:class:`MappedEnvironment`. The snapshot is a
+    directory with one .npy file per column sorted by (key, user,
+    item_primary, item_secondary) and 'meta.json' with the names of keys.
+
+    Args:
+        directory (str): path to the directory (created if it does not exist)
+        values (iterable):
+            tuples (key, user, item_primary, item_secondary, permanent, time,
+            answer, value) as yielded by :py:meth:`Environment.export_values`
+    """
+    key_ids = {}
+    columns = {name: array.array(typecode) for name, typecode in MappedEnvironment.COLUMNS}
+    for (key, user, item_primary, item_secondary, permanent, time, answer, value) in values:
+        key_id = key_ids.get(key)
+        if key_id is None:
+            key_id = key_ids[key] = len(key_ids)
+        columns['key'].append(key_id)
+        columns['user'].append(MappedEnvironment._from_optional(user))
+        columns['item_primary'].append(MappedEnvironment._from_optional(item_primary))
+        columns['item_secondary'].append(MappedEnvironment._from_optional(item_secondary))
+        columns['permanent'].append(permanent)
+        columns['time'].append(_datetime_to_microseconds(time))
+        columns['answer'].append(MappedEnvironment._from_optional(answer))
+        columns['value'].append(value)
+    columns = {name: numpy.asarray(column) for name, column in columns.items()}
+    order = numpy.lexsort([columns[name] for name in ['item_secondary', 'item_primary', 'user', 'key']])
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for name, column in columns.items():
+        numpy.save(os.path.join(directory, name + '.npy'), column[order])
+    with open(os.path.join(directory, 'meta.json'), 'w') as meta_file:
+        json.dump({'keys': sorted(key_ids.keys(), key=lambda k: key_ids[k])}, meta_file)
+
+
+class MappedEnvironment(AbstractInMemoryEnvironment):
+
+    """
+    Read-only environment serving the values from the snapshot created by
+    :py:func:`save_snapshot`. The columns are memory-mapped, so the pages
+    are shared by all processes reading the same snapshot, and the variables
+    are found by binary search. The audit contains only the current values.
+    """
+
+    COLUMNS = [
+        ('key', 'i'),
+        ('user', 'q'),
+        ('item_primary', 'q'),
+        ('item_secondary', 'q'),
+        ('permanent', 'b'),
+        ('time', 'q'),
+        ('answer', 'q'),
+        ('value', 'd'),
+    ]
+    _NONE = -2 ** 63
+
+    def __init__(self, directory):
+        AbstractInMemoryEnvironment.__init__(self)
+        self._directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r') as meta_file:
+            self._key_ids = {key: key_id for key_id, key in enumerate(json.load(meta_file)['keys'])}
+        self._key_names = sorted(self._key_ids.keys(), key=lambda k: self._key_ids[k])
+        self._columns = {
+            name: numpy.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+            for name, typecode in self.COLUMNS
+        }
+
+    def audit(self, key, user=None, item=None, item_secondary=None, limit=None, symmetric=True):
+        found = self._get(key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
+        if found is None or found[0] or limit == 0:
+            return []
+        return [(found[1], found[3])]
+
+    def get_items_with_values(self, key, item, user=None):
+        start, stop = self._range(key, user)
+        primaries = self._columns['item_primary'][start:stop]
+        item = self._from_optional(item)
+        first = start + numpy.searchsorted(primaries, item, 'left')
+        last = start + numpy.searchsorted(primaries, item, 'right')
+        return [(self._to_optional(self._columns['item_secondary'][row]), float(self._columns['value'][row])) for row in range(first, last)]
+
+    def get_all_items_with_values(self, key, user=None):
+        start, stop = self._range(key, user)
+        result = {}
+        for row in range(start, stop):
+            result.setdefault(self._to_optional(self._columns['item_primary'][row]), []).append(
+                (self._to_optional(self._columns['item_secondary'][row]), float(self._columns['value'][row])))
+        return result
+
+    def items_with_values_version(self, key):
+        return ('mapped', self._directory, key)
+
+    def read_more_items(self, key, items, user=None, item=None, default=None, symmetric=True):
+        return self._column_more_items('value', key, items, user, item, symmetric, default)
+
+    def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
+        raise Exception('The mapped environment is read-only.')
+
+    def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        raise Exception('The mapped environment is read-only.')
+
+    def time_more_items(self, key, items, user=None, item=None, symmetric=True):
+        found = self._column_more_items('time', key, items, user, item, symmetric, None)
+        return [None if time is None else _microseconds_to_datetime(time) for time in found]
+
+    def export_values(self):
+        for row in range(len(self._columns['key'])):
+            yield (
+                self._key_names[self._columns['key'][row]],
+                self._to_optional(self._columns['user'][row]),
+                self._to_optional(self._columns['item_primary'][row]),
+                self._to_optional(self._columns['item_secondary'][row]),
+                bool(self._columns['permanent'][row]),
+                _microseconds_to_datetime(self._columns['time'][row]),
+                self._to_optional(self._columns['answer'][row]),
+                float(self._columns['value'][row]))
+
+    def export_audit(self):
+        for (key, user, item_primary, item_secondary, permanent, time, answer, value) in self.export_values():
+            if not permanent:
+                yield (key, user, item_primary, item_secondary, time, answer, value)
+
+    def _get(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        row = self._rows(key, [item], user, item_secondary, symmetric)[0]
+        if row < 0:
+            return None
+        return (
+            bool(self._columns['permanent'][row]), _microseconds_to_datetime(self._columns['time'][row]),
+            self._to_optional(self._columns['answer'][row]), float(self._columns['value'][row]))
+
+    def _column_more_items(self, column, key, items, user, item_secondary, symmetric, default):
+        rows = self._rows(key, items, user, item_secondary, symmetric)
+        found = numpy.flatnonzero(rows >= 0)
+        result = [default] * len(items)
+        for i, value in zip(found.tolist(), self._columns[column][rows[found]].tolist()):
+            result[i] = value
+        return result
+
+    def _range(self, key, user):
+        key_id = self._key_ids.get(key)
+        if key_id is None:
+            return 0, 0
+        keys = self._columns['key']
+        start, stop = numpy.searchsorted(keys, key_id, 'left'), numpy.searchsorted(keys, key_id, 'right')
+        users = self._columns['user'][start:stop]
+        user = self._from_optional(user)
+        return start + numpy.searchsorted(users, user, 'left'), start + numpy.searchsorted(users, user, 'right')
+
+    def _rows(self, key, items, user, item_secondary, symmetric):
+        """
+        Returns:
+            numpy.array: rows of the variables for the given items (as primary
+            items) and the secondary item, -1 for the missing variables
+        """
+        start, stop = self._range(key, user)
+        primaries = self._columns['item_primary'][start:stop]
+        secondaries = self._columns['item_secondary'][start:stop]
+        pairs = []
+        for item in items:
+            pair = [item_secondary, item]
+            if symmetric and item is not None and item_secondary is not None:
+                pair.sort()
+            pairs.append((self._from_optional(pair[1]), self._from_optional(pair[0])))
+        targets = numpy.array([p for p, s in pairs], dtype=numpy.int64)
+        first = numpy.searchsorted(primaries, targets, 'left')
+        last = numpy.searchsorted(primaries, targets, 'right')
+        rows = numpy.full(len(pairs), -1, dtype=numpy.int64)
+        if all([s == self._NONE for p, s in pairs]):
+            # the variables without secondary item are the first ones within the primary item
+            candidates = numpy.flatnonzero(first < last)
+            candidates = candidates[secondaries[first[candidates]] == self._NONE]
+            rows[candidates] = start + first[candidates]
+            return rows
+        for i, (first_row, last_row, (primary, secondary)) in enumerate(zip(first.tolist(), last.tolist(), pairs)):
+            if first_row == last_row:
+                continue
+            # the secondary items are sorted within the primary item
+            found = first_row + numpy.searchsorted(secondaries[first_row:last_row], secondary, 'left')
+            if found < last_row and secondaries[found] == secondary:
+                rows[i] = start + found
+        return rows
+
+    @staticmethod
+    def _from_optional(value):
+        return MappedEnvironment._NONE if value is None else value
+
+    @staticmethod
+    def _to_optional(value):
+        return None if value == MappedEnvironment._NONE else int(value)
+
+
 ################################################################################
 # Tests
 ################################################################################
@@ -533,6 +1165,68 @@ class TestCommonEnvironment(TestEnvironment, metaclass=abc.ABCMeta):
         self.assertIsNotNone(env.number_of_first_answers(item=items[0]))
         self.assertNotEqual(env.number_of_first_answers_more_items(items), [None for i in items])
 
+    def test_read_many_keys(self):
+        env = self.generate_environment()
+        user = self.generate_user()
+        items = [self.generate_item() for i in range(3)]
+        other_item = self.generate_item()
+        # the keys are not written by the predictive model which is updated
+        # by the database environments when the answers are saved
+        env.write('test_prior_skill', 1, user=user)
+        env.write('test_difficulty', 2, item=items[0])
+        env.write('test_current_skill', 3, user=user, item=items[1])
+        env.write('test_skill', 4, user=user, item=other_item)
+        for i in items[:2]:
+            env.process_answer(user, i, i, i, datetime.datetime.now(), self.generate_answer_id(), 1000, 0)
+        env.process_answer(user, items[0], items[0], items[1], datetime.datetime.now(), self.generate_answer_id(), 1000, 0)
+        found = env.read_many_keys({
+            'prior_skill': {'key': 'test_prior_skill', 'items': False, 'default': 0},
+            'difficulties': {'key': 'test_difficulty', 'user': False, 'default': 0},
+            'current_skills': {'key': 'test_current_skill'},
+            'current_skill_times': {'key': 'test_current_skill', 'time': True},
+            'skills': {'key': 'test_skill', 'items': [other_item, items[0]]},
+            'answers': {'answers': 'number_of_answers'},
+            'correct_answers': {'answers': 'number_of_correct_answers'},
+            'first_answers': {'answers': 'number_of_first_answers', 'user': False, 'items': False},
+            'last_times': {'answers': 'last_answer_time'},
+        }, items, user)
+        self.assertEqual(found['prior_skill'], 1)
+        self.assertEqual(found['difficulties'], [2, 0, 0])
+        self.assertEqual(found['current_skills'], [None, 3, None])
+        self.assertEqual([t is None for t in found['current_skill_times']], [True, False, True])
+        self.assertEqual(found['skills'], [4, None])
+        self.assertEqual(found['answers'], [2, 1, 0])
+        self.assertEqual(found['correct_answers'], [1, 1, 0])
+        self.assertEqual(found['first_answers'], 2)
+        self.assertEqual([t is None for t in found['last_times']], [False, False, True])
+        self.assertEqual(env.read_many_keys({}, items, user), {})
+
+    def test_read_many_keys_more_users(self):
+        env = self.generate_environment()
+        users = [self.generate_user() for i in range(3)]
+        items = [self.generate_item() for i in range(3)]
+        # the keys are not written by the predictive model (see test_read_many_keys)
+        env.write('test_difficulty', 2, item=items[0])
+        for i, user in enumerate(users[:2]):
+            env.write('test_prior_skill', i, user=user)
+            env.write('test_current_skill', i, user=user, item=items[i])
+            for item in items[i:]:
+                env.process_answer(user, item, item, items[0], datetime.datetime.now(), self.generate_answer_id(), 1000, 0)
+        keys_spec = {
+            'prior_skill': {'key': 'test_prior_skill', 'items': False, 'default': 0},
+            'difficulties': {'key': 'test_difficulty', 'user': False, 'default': 0},
+            'current_skills': {'key': 'test_current_skill'},
+            'answers': {'answers': 'number_of_answers'},
+            'user_answers': {'answers': 'number_of_answers', 'items': False},
+            'last_times': {'answers': 'last_answer_time'},
+        }
+        found = env.read_many_keys_more_users(keys_spec, items, users)
+        self.assertEqual(found, [env.read_many_keys(keys_spec, items, user) for user in users])
+        self.assertEqual(found[1]['current_skills'], [None, 1, None])
+        self.assertEqual(env.number_of_answers_more_users_more_items(items, users), [[1, 1, 1], [0, 1, 1], [0, 0, 0]])
+        self.assertEqual(env.number_of_correct_answers_more_users_more_items(items, users), [[1, 0, 0], [0, 0, 0], [0, 0, 0]])
+        self.assertEqual(env.read_more_users_more_items('test_current_skill', items, users, default=-1), [[0, -1, -1], [-1, 1, -1], [-1, -1, -1]])
+
     def test_rolling_success(self):
         env = self.generate_environment()
         user_1 = self.generate_user()
@@ -591,3 +1285,19 @@ class TestCommonEnvironment(TestEnvironment, metaclass=abc.ABCMeta):
         self.assertEqual(
             env.get_items_with_values_more_items('parent', items=items),
             [[], [(items[0], 20)]])
+
+    def test_get_all_items_with_values(self):
+        env = self.generate_environment()
+        users = [self.generate_user() for i in range(2)]
+        items = [self.generate_item() for i in range(3)]
+        version = env.items_with_values_version('parent')
+        env.write('parent', 10, user=users[0], item=items[0], item_secondary=items[1], symmetric=False)
+        env.write('parent', 20, item=items[1], item_secondary=items[0], symmetric=False, permanent=True)
+        env.write('parent', 30, item=items[1], item_secondary=items[2], symmetric=False, permanent=True)
+        if version is not None:
+            self.assertNotEqual(version, env.items_with_values_version('parent'))
+        self.assertEqual(env.get_all_items_with_values('parent', user=users[0]), {items[0]: [(items[1], 10)]})
+        self.assertEqual(env.get_all_items_with_values('parent', user=users[1]), {})
+        found = env.get_all_items_with_values('parent')
+        self.assertEqual(list(found.keys()), [items[1]])
+        self.assertEqual(sorted(found[items[1]]), [(items[0], 20), (items[2], 30)])
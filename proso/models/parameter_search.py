@@ -0,0 +1,202 @@
+"""
+Offline search for the parameters of predictive models. The answers are
+loaded only once into a compact numpy array and they are replayed through
+:py:class:`proso.models.environment.InMemoryEnvironment` for each configuration
+of the predictive model in a pool of processes.
+"""
+from .environment import InMemoryEnvironment
+import csv
+import datetime
+import itertools
+import multiprocessing
+import numpy
+import proso.metric
+import proso.util
+import random
+
+
+ANSWER_DTYPE = numpy.dtype([
+    ('id', numpy.int64),
+    ('user', numpy.int64),
+    ('item', numpy.int64),
+    ('item_asked', numpy.int64),
+    # -1 if the user answered "I don't know"
+    ('item_answered', numpy.int64),
+    # seconds since epoch
+    ('time', numpy.int64),
+    ('response_time', numpy.int64),
+    ('guess', numpy.float64),
+])
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# answers shared by the worker processes
+_worker_answers = None
+
+
+def answers_from_rows(rows):
+    """
+    Creates a compact array of answers from the given rows.
+
+    Args:
+        rows (iterable):
+            tuples (id, user, item, item_asked, item_answered, time,
+            response_time, guess) where the item_answered can be None and the
+            time is datetime.datetime
+
+    Returns:
+        numpy.array: answers sorted by id (see ANSWER_DTYPE)
+    """
+    answers = numpy.array([
+        (answer_id, user, item, asked, -1 if answered is None else answered, datetime_to_seconds(time), response_time, guess)
+        for (answer_id, user, item, asked, answered, time, response_time, guess) in rows
+    ], dtype=ANSWER_DTYPE)
+    return numpy.sort(answers, order='id')
+
+
+def answers_from_csv(filename, limit=None):
+    """
+    Loads answers from the CSV file created by 'table2csv' command (the table
+    proso_models_answer).
+    """
+    with open(filename, 'r') as csv_file:
+        reader = csv.DictReader(csv_file)
+        rows = (
+            (
+                int(row['id']),
+                int(row['user']),
+                int(row['item']),
+                int(row['item_asked']),
+                None if row['item_answered'] in ('', 'None') else int(row['item_answered']),
+                datetime.datetime.strptime(row['time'][:19], '%Y-%m-%d %H:%M:%S'),
+                int(row['response_time']),
+                0.0 if row['guess'] in ('', 'None') else float(row['guess']),
+            )
+            for row in reader
+        )
+        if limit is not None:
+            rows = itertools.islice(rows, limit)
+        return answers_from_rows(rows)
+
+
+def datetime_to_seconds(time):
+    return int((time.replace(tzinfo=None) - _EPOCH).total_seconds())
+
+
+def replay(answers, predictive_model, environment=None):
+    """
+    Replays the given answers through the predictive model in the same way as
+    'recompute_model' command does.
+
+    Args:
+        answers (numpy.array): answers (see ANSWER_DTYPE)
+        predictive_model (proso.models.prediction.PredictiveModel): model to evaluate
+        environment (proso.models.environment.Environment):
+            environment to use, new InMemoryEnvironment by default
+
+    Returns:
+        numpy.array: predictions made before the answers were processed
+    """
+    if environment is None:
+        environment = InMemoryEnvironment()
+    predictions = numpy.empty(len(answers))
+    for i, (answer_id, user, item, asked, answered, seconds, response_time, guess) in enumerate(answers.tolist()):
+        answered = None if answered < 0 else answered
+        time = _EPOCH + datetime.timedelta(seconds=seconds)
+        predictions[i] = predictive_model.predict_and_update(
+            environment,
+            user,
+            item,
+            asked == answered,
+            time,
+            item_answered=answered,
+            item_asked=asked,
+            guess=guess,
+            answer_id=answer_id)
+        environment.process_answer(user, item, asked, answered, time, answer_id, response_time, guess)
+    return predictions
+
+
+def evaluate(answers, predictive_model):
+    """
+    Returns:
+        dict: RMSE, log-loss and AUC of the predictions made by the given
+        model during the replay of the answers
+    """
+    predictions = replay(answers, predictive_model)
+    observed = answers['item_asked'] == answers['item_answered']
+    return {
+        'rmse': proso.metric.rmse(observed, predictions),
+        'log_loss': proso.metric.log_loss(observed, predictions),
+        'auc': proso.metric.auc(observed, predictions),
+    }
+
+
+def grid(parameters):
+    """
+    Args:
+        parameters (dict): name -> list of values
+
+    Returns:
+        list: all combinations of the given values (dicts name -> value)
+    """
+    names = sorted(parameters.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[parameters[n] for n in names])]
+
+
+def random_sample(parameters, size, seed=None):
+    """
+    Args:
+        parameters (dict): name -> (min, max)
+        size (int): number of configurations
+        seed (int): seed of the random generator
+
+    Returns:
+        list: configurations with values sampled uniformly from the given
+        intervals (dicts name -> value)
+    """
+    generator = random.Random(seed)
+    names = sorted(parameters.keys())
+    return [
+        {n: generator.uniform(*parameters[n]) for n in names}
+        for i in range(size)
+    ]
+
+
+def search(answers, model_class, configs, base_parameters=None, processes=None):
+    """
+    Evaluates the predictive model for all the given configurations. The
+    configurations are distributed over the pool of processes, each of them
+    receives the answers only once.
+
+    Args:
+        answers (numpy.array): answers (see ANSWER_DTYPE)
+        model_class (str): class of the predictive model, e.g. 'proso.models.prediction.PriorCurrentPredictiveModel'
+        configs (list): list of dicts (parameter name -> value)
+        base_parameters (dict): parameters shared by all configurations
+        processes (int): number of processes, number of CPUs by default
+
+    Returns:
+        list: dicts with the parameters and the metrics (rmse, log_loss, auc)
+        in the same order as the given configurations
+    """
+    if base_parameters is None:
+        base_parameters = {}
+    tasks = [(model_class, dict(base_parameters, **config)) for config in configs]
+    if processes == 1:
+        _init_worker(answers)
+        return [_evaluate_task(task) for task in tasks]
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(answers,)) as pool:
+        return pool.map(_evaluate_task, tasks, chunksize=1)
+
+
+def _init_worker(answers):
+    global _worker_answers
+    _worker_answers = answers
+
+
+def _evaluate_task(task):
+    model_class, parameters = task
+    result = evaluate(_worker_answers, proso.util.instantiate(model_class, **parameters))
+    result['parameters'] = parameters
+    return result
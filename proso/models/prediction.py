@@ -1,7 +1,6 @@
 import abc
-import operator
+import numpy
 from math import exp
-from functools import reduce
 from proso.util import timeit
 
 
@@ -21,6 +20,16 @@ class PredictiveModel(metaclass=abc.ABCMeta):
         data = self.prepare_phase_more_items(environment, user, items, time, **kwargs)
         return self.predict_phase_more_items(data, user, items, time, **kwargs)
 
+    def predict_more_users_more_items(self, environment, users, items, time, **kwargs):
+        """
+        Returns:
+            list: list of predictions (ordered as the items) for each of the
+            given users, the data for all the users are prepared at once (see
+            :py:meth:`prepare_phase_more_users_more_items`)
+        """
+        data = self.prepare_phase_more_users_more_items(environment, users, items, time, **kwargs)
+        return [self.predict_phase_more_items(d, user, items, time, **kwargs) for user, d in zip(users, data)]
+
     def predict(self, environment, user, item, time, **kwargs):
         data = self.prepare_phase(environment, user, item, time, **kwargs)
         return self.predict_phase(data, user, item, time, **kwargs)
@@ -32,6 +41,40 @@ class PredictiveModel(metaclass=abc.ABCMeta):
             environment, data, prediction, user, item, correct, time, answer_id, **kwargs)
         return prediction
 
+    def predict_and_update_many(self, environment, answers):
+        """
+        Updates the model after more answers at once. The answers are processed
+        in the given order and after each update the answer is passed to
+        :py:meth:`proso.models.environment.Environment.process_answer`, so the
+        environment can track it in memory and persist all the changes at the
+        end (see :py:meth:`proso.models.environment.Environment.flush`).
+
+        Args:
+            environment (proso.models.environment.Environment):
+                environment where all the important data are persist
+            answers (list):
+                list of dicts with the following keys: user, item,
+                item_asked, item_answered, time, answer_id and optionally
+                response_time; other keys are passed to
+                :py:meth:`predict_and_update` as kwargs
+
+        Returns:
+            list: predictions for the given answers
+        """
+        predictions = []
+        for answer in answers:
+            kwargs = dict(answer)
+            user = kwargs.pop('user')
+            item = kwargs.pop('item')
+            time = kwargs.pop('time')
+            answer_id = kwargs.pop('answer_id')
+            response_time = kwargs.pop('response_time', None)
+            predictions.append(self.predict_and_update(
+                environment, user, item, kwargs['item_asked'] == kwargs['item_answered'], time, answer_id, **kwargs))
+            environment.process_answer(
+                user, item, kwargs['item_asked'], kwargs['item_answered'], time, answer_id, response_time, kwargs.get('guess'))
+        return predictions
+
     @abc.abstractmethod
     def prepare_phase(self, environment, user, item, time, **kwargs):
         """
@@ -59,6 +102,14 @@ class PredictiveModel(metaclass=abc.ABCMeta):
     def prepare_phase_more_items(self, environment, user, items, time, **kwargs):
         pass
 
+    def prepare_phase_more_users_more_items(self, environment, users, items, time, **kwargs):
+        """
+        Returns:
+            list: data from :py:meth:`prepare_phase_more_items` for each of the
+            given users, the default implementation prepares them one by one
+        """
+        return [self.prepare_phase_more_items(environment, user, items, time, **kwargs) for user in users]
+
     @abc.abstractmethod
     def predict_phase(self, data, user, item, time, **kwargs):
         """
@@ -172,25 +223,38 @@ class PriorCurrentPredictiveModel(PredictiveModel):
         self._elo_dynamic_alpha = elo_dynamic_alpha
 
     def prepare_phase(self, environment, user, item, time, **kwargs):
+        fetched = environment.read_many_keys({
+            'prior_skill': {'key': 'prior_skill', 'items': False, 'default': 0},
+            'difficulty': {'key': 'difficulty', 'user': False, 'default': 0},
+            'current_skill': {'key': 'current_skill'},
+            'user_first_answers': {'answers': 'number_of_first_answers', 'items': False},
+            'item_first_answers': {'answers': 'number_of_first_answers', 'user': False},
+            'last_time': {'answers': 'last_answer_time'},
+        }, [item], user)
         result = {}
-        result['prior_skill'] = environment.read('prior_skill', user=user, default=0)
-        result['difficulty'] = environment.read('difficulty', item=item, default=0)
-        result['current_skill'] = environment.read('current_skill', user=user, item=item)
+        result['prior_skill'] = fetched['prior_skill']
+        result['difficulty'] = fetched['difficulty'][0]
+        result['current_skill'] = fetched['current_skill'][0]
         result['use_prior'] = result['current_skill'] is None
         if result['use_prior']:
-            result['user_first_answers'] = environment.number_of_first_answers(user=user)
-            result['item_first_answers'] = environment.number_of_first_answers(item=item)
+            result['user_first_answers'] = fetched['user_first_answers']
+            result['item_first_answers'] = fetched['item_first_answers'][0]
         else:
-            result['last_time'] = environment.last_answer_time(user=user, item=item)
+            result['last_time'] = fetched['last_time'][0]
         return result
 
+    KEYS_SPEC_MORE_ITEMS = {
+        'prior_skill': {'key': 'prior_skill', 'items': False, 'default': 0},
+        'difficulties': {'key': 'difficulty', 'user': False, 'default': 0},
+        'current_skills': {'key': 'current_skill'},
+        'last_times': {'answers': 'last_answer_time'},
+    }
+
     def prepare_phase_more_items(self, environment, user, items, time, **kwargs):
-        result = {}
-        result['prior_skill'] = environment.read('prior_skill', user=user, default=0)
-        result['difficulties'] = environment.read_more_items('difficulty', items=items, default=0)
-        result['current_skills'] = environment.read_more_items('current_skill', user=user, items=items)
-        result['last_times'] = environment.last_answer_time_more_items(user=user, items=items)
-        return result
+        return environment.read_many_keys(self.KEYS_SPEC_MORE_ITEMS, items, user)
+
+    def prepare_phase_more_users_more_items(self, environment, users, items, time, **kwargs):
+        return environment.read_many_keys_more_users(self.KEYS_SPEC_MORE_ITEMS, items, users)
 
     def predict_phase(self, data, user, item, time, **kwargs):
         if data['current_skill'] is None:
@@ -204,18 +268,22 @@ class PriorCurrentPredictiveModel(PredictiveModel):
             guess=kwargs.get('guess'))[0]
 
     def predict_phase_more_items(self, data, user, items, time, **kwargs):
-        preds = []
-        to_iter = list(zip(
-            items, data['difficulties'],
-            data['current_skills'], data['last_times']))
-        for i, d, c, t in to_iter:
-            preds.append(self.predict_phase({
-                'prior_skill': data['prior_skill'],
-                'difficulty': d,
-                'current_skill': c,
-                'last_time': t
-            }, user, i, time, **kwargs))
-        return preds
+        difficulties = numpy.array(data['difficulties'], dtype=float)
+        # None values (the user has not answered the item yet) become NaNs
+        current_skills = numpy.array(data['current_skills'], dtype=float)
+        seconds_ago = numpy.array([
+            numpy.nan if last_time is None or time is None else _total_seconds_diff(time, last_time)
+            for last_time in data['last_times']
+        ], dtype=float)
+        seconds_ago[numpy.isnan(seconds_ago)] = 315460000
+        skills = numpy.where(
+            numpy.isnan(current_skills),
+            data['prior_skill'] - difficulties,
+            current_skills + self._time_shift / numpy.maximum(seconds_ago, 0.001))
+        return predict_simple_more_items(
+            skills,
+            number_of_options=len(kwargs['options']) if 'options' in kwargs else 0,
+            guess=kwargs.get('guess')).tolist()
 
     def update_phase(self, environment, data, prediction, user, item, correct, time, answer_id, **kwargs):
         result = correct
@@ -252,22 +320,32 @@ class AlwaysLearningPredictiveModel(PredictiveModel):
         return self.prepare_phase_more_items(environment, user, [item], time, **kwargs)
 
     def prepare_phase_more_items(self, environment, user, items, time, **kwargs):
-        parents = self._load_parents(environment, items, user)
-        all_items = list(set(items + [i for ps in list(parents.values()) for (i, v) in ps]))
-        return {
-            'skills': dict(list(zip(
-                all_items, environment.read_more_items('skill', items=all_items, user=user, default=0)))),
-            'first_answers': dict(list(zip(
-                items, environment.number_of_first_answers_more_items(items=items)))),
-            'difficulties': dict(list(zip(
-                items, environment.read_more_items('difficulty', items=items, default=0)))),
-            'last_times': dict(list(zip(
-                items, environment.last_answer_time_more_items(items=items, user=user)))),
-            'parents': parents
-        }
+        return self.prepare_phase_more_users_more_items(environment, [user], items, time, **kwargs)[0]
+
+    def prepare_phase_more_users_more_items(self, environment, users, items, time, **kwargs):
+        skill_matrix = get_skill_matrix(environment, items)
+        ancestors = skill_matrix.ancestors(items)
+        fetched = environment.read_many_keys_more_users({
+            'skills': {'key': 'skill', 'items': [skill_matrix.nodes[a] for a in ancestors], 'default': 0},
+            'first_answers': {'answers': 'number_of_first_answers', 'user': False},
+            'difficulties': {'key': 'difficulty', 'user': False, 'default': 0},
+            'last_times': {'answers': 'last_answer_time'},
+        }, items, users)
+        result = []
+        for user_fetched in fetched:
+            skills = numpy.zeros(len(skill_matrix.nodes))
+            skills[ancestors] = user_fetched['skills']
+            result.append({
+                'skill_matrix': skill_matrix,
+                'skills': skills,
+                'first_answers': dict(list(zip(items, user_fetched['first_answers']))),
+                'difficulties': dict(list(zip(items, user_fetched['difficulties']))),
+                'last_times': dict(list(zip(items, user_fetched['last_times']))),
+            })
+        return result
 
     def predict_phase(self, data, user, item, time, **kwargs):
-        skill = self._load_skill(item, data)
+        skill = data['skill_matrix'].skill(item, data['skills'])
         difficulty = data['difficulties'][item]
         return predict_simple(
             skill - difficulty,
@@ -275,7 +353,12 @@ class AlwaysLearningPredictiveModel(PredictiveModel):
             guess=kwargs.get('guess'))[0]
 
     def predict_phase_more_items(self, data, user, items, time, **kwargs):
-        return [self.predict_phase(data, user, i, time, **kwargs) for i in items]
+        skills = data['skill_matrix'].skills(items, data['skills'])
+        difficulties = numpy.array([data['difficulties'][i] for i in items], dtype=float)
+        return predict_simple_more_items(
+            skills - difficulties,
+            number_of_options=len(kwargs['options']) if 'options' in kwargs else 0,
+            guess=kwargs.get('guess')).tolist()
 
     def update_phase(self, environment, data, prediction, user, item, correct, time, answer_id, **kwargs):
         if data['last_times'][item] is None:
@@ -283,47 +366,167 @@ class AlwaysLearningPredictiveModel(PredictiveModel):
             difficulty_alpha = alpha_fun(data['first_answers'][item])
             data['difficulties'][item] -= difficulty_alpha * (correct - prediction)
             environment.write('difficulty', data['difficulties'][item], item=item, time=time, answer=answer_id)
-        parents_per_level = [
-            list(set([i_w[0] for i_w in parents])) for parents in self._iterate_parents_per_level(item, data)]
-        parents_per_level = list(zip(list(range(len(parents_per_level))), parents_per_level))
-        parents_per_level.reverse()
-        level_decay = lambda level: 1.0 / 3 ** level
+        skill_matrix = data['skill_matrix']
+        skills = data['skills']
         update_const = self._pfae_good if correct else self._pfae_bad
         difficulty = data['difficulties'][item]
-        for level, parents in parents_per_level:
-            for parent in parents:
+        for decay, ancestors in skill_matrix.update_plan(item):
+            for ancestor in ancestors:
                 parent_prediction = predict_simple(
-                    self._load_skill(parent, data) - difficulty,
+                    skill_matrix.row_dot(ancestor, skills) - difficulty,
                     number_of_options=len(kwargs['options']) if 'options' in kwargs else 0,
                     guess=kwargs.get('guess'))[0]
-                data['skills'][parent] += level_decay(level) * update_const * (correct - parent_prediction)
-                environment.write('skill', data['skills'][parent], item=parent, user=user, time=time, answer=answer_id)
-
-    def _load_parents(self, environment, items, user):
-        parents = {}
-        while len(items) > 0:
-            found = environment.get_items_with_values_more_items('parent', items)
-            new_items = set()
-            for i, ps in zip(items, found):
-                new_items = new_items.union([x[0] for x in ps])
-                if len(ps) == 0:
-                    ps.append((None, 1))
-                parents[i] = ps
-            items = list(new_items)
-        return parents
-
-    def _load_skill(self, item, data):
-        skill = 0
-        for skill_items in self._iterate_parents_per_level(item, data):
-            weights = float(sum([i_w1[1] for i_w1 in skill_items]))
-            skill += sum([data['skills'][i_w3[0]] * i_w3[1] / weights for i_w3 in skill_items])
-        return skill
-
-    def _iterate_parents_per_level(self, item, data):
+                skills[ancestor] += decay * update_const * (correct - parent_prediction)
+                environment.write(
+                    'skill', float(skills[ancestor]), item=skill_matrix.nodes[ancestor],
+                    user=user, time=time, answer=answer_id)
+
+
+class SkillMatrix:
+
+    """
+    Compiled 'parent' hierarchy of items used by
+    :py:class:`AlwaysLearningPredictiveModel`. Each row of the sparse matrix
+    (CSR format) maps a node of the hierarchy to its weighted ancestors
+    (including itself), so the skill for the node is a dot product of its row
+    and the vector of skills of all nodes. The root of the hierarchy (global
+    skill) is represented by None.
+
+    Args:
+        parents (dict):
+            item -> [(parent, weight)], the items without parents are
+            considered to be children of the root
+        items (list):
+            additional items which have to be present in the matrix
+    """
+
+    LEVEL_DECAY = 1.0 / 3
+
+    def __init__(self, parents, items=None):
+        parents = {
+            item: [(p, w) for (p, w) in ps if p is not None]
+            for item, ps in parents.items() if item is not None
+        }
+        nodes = set(parents.keys()) | {p for ps in parents.values() for (p, w) in ps} | set(items if items else [])
+        nodes.discard(None)
+        self.nodes = [None] + sorted(nodes)
+        self._index = {node: i for i, node in enumerate(self.nodes)}
+        self._update_plans = []
+        indptr = [0]
+        indices = []
+        data = []
+        for node in self.nodes:
+            row = {}
+            update_plan = []
+            for level, level_items in enumerate(self._iterate_parents_per_level(node, parents)):
+                weights = float(sum([w for (i, w) in level_items]))
+                for i, w in level_items:
+                    row[self._index[i]] = row.get(self._index[i], 0) + w / weights
+                update_plan.append((self.LEVEL_DECAY ** level, sorted({self._index[i] for (i, w) in level_items})))
+            update_plan.reverse()
+            self._update_plans.append(update_plan)
+            indices += sorted(row.keys())
+            data += [row[i] for i in sorted(row.keys())]
+            indptr.append(len(indices))
+        self._indptr = numpy.array(indptr, dtype=int)
+        self._indices = numpy.array(indices, dtype=int)
+        self._data = numpy.array(data, dtype=float)
+
+    def covers(self, items):
+        return all([i in self._index for i in items])
+
+    def ancestors(self, items):
+        """
+        Returns sorted positions of all the ancestors of the given items
+        (including the items themselves).
+        """
+        rows = [self._index[i] for i in items]
+        if len(rows) == 0:
+            return []
+        return numpy.unique(numpy.concatenate([
+            self._indices[self._indptr[r]:self._indptr[r + 1]] for r in rows
+        ])).tolist()
+
+    def skill(self, item, skills):
+        return self.row_dot(self._index[item], skills)
+
+    def skills(self, items, skills):
+        """
+        Computes skills for the given items (sparse matrix-vector product
+        restricted to the rows of the given items).
+
+        Args:
+            items (list): items to compute skills for
+            skills (numpy.array): skills of all nodes indexed by positions
+
+        Returns:
+            numpy.array: skills for the given items
+        """
+        if len(items) == 0:
+            return numpy.array([], dtype=float)
+        rows = numpy.array([self._index[i] for i in items], dtype=int)
+        starts = self._indptr[rows]
+        lengths = self._indptr[rows + 1] - starts
+        offsets = numpy.cumsum(lengths) - lengths
+        positions = numpy.repeat(starts - offsets, lengths) + numpy.arange(lengths.sum())
+        return numpy.add.reduceat(self._data[positions] * skills[self._indices[positions]], offsets)
+
+    def row_dot(self, position, skills):
+        start, end = self._indptr[position], self._indptr[position + 1]
+        return float(numpy.dot(self._data[start:end], skills[self._indices[start:end]]))
+
+    def update_plan(self, item):
+        """
+        Returns the order in which the skills have to be updated after the
+        answer to the given item: list of (level decay, [positions]) starting
+        with the most distant ancestors.
+        """
+        return self._update_plans[self._index[item]]
+
+    def _iterate_parents_per_level(self, item, parents):
         to_find = [(item, 1)]
         while len(to_find) > 0:
             yield to_find
-            to_find = [iw for ps in [[] if i_w2[0] is None else data['parents'][i_w2[0]] for i_w2 in to_find] for iw in ps]
+            to_find = [
+                iw for ps in [[] if i is None else parents.get(i) or [(None, 1)] for (i, w) in to_find]
+                for iw in ps
+            ]
+
+
+_skill_matrices = {}
+
+
+def get_skill_matrix(environment, items):
+    """
+    Returns the skill matrix compiled from the 'parent' variables in the given
+    environment. The matrix is cached until the version of the 'parent'
+    variables changes. If the environment does not know the version, only
+    the ancestors of the given items are loaded (level by level) and
+    compiled.
+    """
+    version = environment.items_with_values_version('parent')
+    if version is None:
+        return SkillMatrix(_load_ancestors(environment, items), items=items)
+    skill_matrix = _skill_matrices.get(version) if version is not None else None
+    if skill_matrix is None or not skill_matrix.covers(items):
+        skill_matrix = SkillMatrix(
+            environment.get_all_items_with_values('parent'),
+            items=list(items) + ([] if skill_matrix is None else skill_matrix.nodes))
+        if version is not None:
+            _skill_matrices.clear()
+            _skill_matrices[version] = skill_matrix
+    return skill_matrix
+
+
+def _load_ancestors(environment, items):
+    parents = {}
+    to_find = {i for i in items if i is not None}
+    while len(to_find) > 0:
+        to_find = sorted(to_find)
+        found = environment.get_items_with_values_more_items('parent', to_find)
+        parents.update(zip(to_find, found))
+        to_find = {p for ps in found for (p, w) in ps if p is not None and p not in parents}
+    return parents
 
 
 class ShiftedPredictiveModel(PredictiveModel):
@@ -368,6 +571,32 @@ def predict_simple(skill_asked, number_of_options=None, guess=None):
     return (guess + (1 - guess) * _sigmoid(skill_asked), [])
 
 
+def predict_simple_more_items(skills_asked, number_of_options=None, guess=None):
+    """
+    Vectorized version of :py:func:`predict_simple` computing predictions for
+    more items at once.
+
+    Args:
+        skills_asked (numpy.array):
+            knowledge of the given user for the asked items
+        number_of_options (int|numpy.array):
+            number of options, either the same for all items or per item
+        guess (float|numpy.array):
+            probability of guessing, either the same for all items or per item
+
+    Returns:
+        numpy.array: probabilities of the correct answers
+    """
+    if guess is None and number_of_options is None:
+        raise Exception('Either guess parameter or number of options has to be specified.')
+    if guess is None:
+        number_of_options = numpy.asarray(number_of_options, dtype=float)
+        with numpy.errstate(divide='ignore'):
+            guess = numpy.where(number_of_options > 0, 1.0 / number_of_options, 0.0)
+    guess = numpy.asarray(guess, dtype=float)
+    return guess + (1 - guess) * _sigmoid_more_items(numpy.asarray(skills_asked, dtype=float))
+
+
 def predict(skill_asked, option_skills):
     """
     Returns the probability of correct answer.
@@ -389,37 +618,61 @@ def predict(skill_asked, option_skills):
     if len(option_skills) == 0:
         return (_sigmoid(skill_asked), [])
 
-    probs = [_sigmoid(x) for x in [skill_asked] + option_skills]
-    items = 2 ** len(probs)
-    asked_prob = 0
-    opt_wrong_probs = [0 for i in option_skills]
-
-    for i in range(items):
-        knows = _to_binary_reverse_list(i, len(probs))
-        guess_options = 1 if knows[0] else sum([1 - x for x in knows])
-        current_prob = reduce(
-            operator.mul,
-            [p_k[0] if p_k[1] else 1 - p_k[0] for p_k in zip(probs, knows)],
-            1)
-        asked_prob += (1.0 / guess_options) * current_prob
-        if guess_options > 1:
-            for j in range(0, len(option_skills)):
-                if knows[j + 1]:
-                    continue
-                opt_wrong_probs[j] += 1.0 / guess_options * current_prob
+    # The user knows the asked item, or guesses uniformly among the asked item
+    # and the options they do not know. Instead of enumerating all knowledge
+    # combinations, it is enough to know the distribution of the number of
+    # unknown options.
+    prob_asked = _sigmoid(skill_asked)
+    probs = [_sigmoid(x) for x in option_skills]
+    unknown = _unknown_options_distribution(probs)
+    asked_prob = prob_asked + (1 - prob_asked) * sum([p / (k + 1.0) for k, p in enumerate(unknown)])
+    opt_wrong_probs = []
+    for prob in probs:
+        unknown_others = _remove_from_unknown_options_distribution(unknown, prob)
+        opt_wrong_probs.append(
+            (1 - prob_asked) * (1 - prob) * sum([p / (k + 2.0) for k, p in enumerate(unknown_others)]))
     return (asked_prob, opt_wrong_probs)
 
 
+def _unknown_options_distribution(probs):
+    """
+    Returns a list where the k-th value is the probability that exactly k
+    options are unknown, computed in O(n^2).
+    """
+    result = [1.0]
+    for prob in probs:
+        new_result = [0.0] * (len(result) + 1)
+        for k, p in enumerate(result):
+            new_result[k] += p * prob
+            new_result[k + 1] += p * (1 - prob)
+        result = new_result
+    return result
+
+
+def _remove_from_unknown_options_distribution(distribution, prob):
+    """
+    Inverse operation to adding one option with the given probability to the
+    distribution computed by _unknown_options_distribution in O(n). The
+    direction of the division is chosen to keep it numerically stable.
+    """
+    length = len(distribution) - 1
+    result = [0.0] * length
+    if prob >= 0.5:
+        for k in range(length):
+            result[k] = (distribution[k] - (1 - prob) * (result[k - 1] if k > 0 else 0.0)) / prob
+    else:
+        for k in reversed(range(length)):
+            result[k] = (distribution[k + 1] - prob * (result[k + 1] if k + 1 < length else 0.0)) / (1 - prob)
+    return [max(p, 0.0) for p in result]
+
+
 def _sigmoid(x):
     return 1.0 / (1 + exp(-x))
 
 
-def _to_binary_reverse_list(number, length):
-    binary = []
-    for j in range(length):
-        binary.append(number % 2)
-        number = number / 2
-    return binary
+def _sigmoid_more_items(xs):
+    with numpy.errstate(over='ignore'):
+        return 1.0 / (1 + numpy.exp(-xs))
 
 
 def _total_seconds_diff(a, b):
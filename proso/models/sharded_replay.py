@@ -0,0 +1,209 @@
+"""
+Parallel replay of answers sharded by users. The variables of users are
+independent, so each shard of users is replayed by its own process in its
+own :py:class:`proso.models.environment.InMemoryEnvironment`. The variables
+without user (e.g. difficulties of items or counters of answers) are shared,
+the shards synchronize them after each epoch (a fixed number of answers in
+the order of their ids): the changes made by the shards during the epoch are
+summed up and the merged values are sent to all shards (bulk-synchronous
+merge). The shared variables missing at the beginning of the epoch are
+treated as zero.
+
+The result differs from the sequential replay, because the shards do not see
+the changes of the shared variables made by the others during the epoch,
+the difference can be measured by :py:func:`compare_with_sequential`.
+
+The audit of the shared variables is coarser than the one of the sequential
+replay: only the merged value at the end of each epoch is written (one record
+per changed variable and epoch, with the time and the answer of its last
+change), the intermediate changes made by the shards are not recorded. The
+audit of the variables of users is complete.
+"""
+from .environment import InMemoryEnvironment
+from .parameter_search import replay
+import multiprocessing
+import numpy
+import proso.metric
+
+
+def replay_sharded(answers, predictive_model, shards=2, epoch_size=10000, initial_values=None, environment=None):
+    """
+    Replays the given answers through the predictive model in the given
+    number of processes.
+
+    Args:
+        answers (numpy.array): answers sorted by id (see proso.models.parameter_search.ANSWER_DTYPE)
+        predictive_model (proso.models.prediction.PredictiveModel): model to replay
+        shards (int): number of shards (processes)
+        epoch_size (int): number of answers between synchronizations of the shared variables
+        initial_values (list): values of variables (tuples as yielded by
+            :py:meth:`proso.models.environment.Environment.export_values`)
+            available to all shards from the beginning, e.g. the permanent
+            variables with item relations, they are not written to the
+            environment
+        environment (proso.models.environment.Environment):
+            environment where the resulting variables and their audit are
+            written
+
+    Returns:
+        numpy.array: predictions made before the answers were processed
+    """
+    if initial_values is None:
+        initial_values = []
+    positions = [numpy.flatnonzero(answers['user'] % shards == shard) for shard in range(shards)]
+    boundaries = list(range(epoch_size, len(answers), epoch_size)) + [len(answers)]
+    connections = []
+    processes = []
+    for shard_positions in positions:
+        parent_connection, child_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_run_shard, args=(
+            child_connection,
+            answers[shard_positions],
+            numpy.searchsorted(shard_positions, boundaries).tolist(),
+            predictive_model,
+            initial_values,
+        ))
+        process.daemon = True
+        process.start()
+        child_connection.close()
+        connections.append(parent_connection)
+        processes.append(process)
+    try:
+        merged = {}
+        changed = {}
+        for boundary in boundaries:
+            for connection in connections:
+                connection.send(changed)
+            changed = _merge(merged, [_receive(connection, shard) for shard, connection in enumerate(connections)])
+            if environment is not None:
+                for (key, item_primary, item_secondary), (time, answer, value) in sorted(changed.items(), key=lambda x: x[1][0]):
+                    environment.write(
+                        key, value, item=item_primary, item_secondary=item_secondary,
+                        time=time, symmetric=False, answer=answer)
+        predictions = numpy.empty(len(answers))
+        for shard, connection in enumerate(connections):
+            connection.send(changed)
+            shard_predictions, values, audit = _receive(connection, shard)
+            predictions[positions[shard]] = shard_predictions
+            if environment is not None:
+                _write_user_variables(environment, values, audit)
+    finally:
+        for connection in connections:
+            connection.close()
+        for process in processes:
+            process.join()
+    return predictions
+
+
+def compare_with_sequential(answers, predictions, predictive_model):
+    """
+    Replays the answers sequentially and compares the predictions.
+
+    Returns:
+        dict: the maximal and the mean absolute difference of the predictions,
+        the differences of RMSE and AUC (sharded - sequential)
+    """
+    expected = replay(answers, predictive_model)
+    differences = numpy.abs(predictions - expected)
+    observed = answers['item_asked'] == answers['item_answered']
+    return {
+        'max_difference': float(differences.max()) if len(differences) > 0 else 0.0,
+        'mean_difference': float(differences.mean()) if len(differences) > 0 else 0.0,
+        'rmse_difference': proso.metric.rmse(observed, predictions) - proso.metric.rmse(observed, expected),
+        'auc_difference': proso.metric.auc(observed, predictions) - proso.metric.auc(observed, expected),
+    }
+
+
+class _ShardEnvironment(InMemoryEnvironment):
+
+    def __init__(self):
+        InMemoryEnvironment.__init__(self)
+        # (key, item_primary, item_secondary) of shared variables written during the epoch
+        self._touched = set()
+
+    def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
+        InMemoryEnvironment.write(
+            self, key, value, user=user, item=item, item_secondary=item_secondary,
+            time=time, audit=audit, symmetric=symmetric, permanent=permanent, answer=answer)
+        if user is None and not permanent:
+            items = [item_secondary, item]
+            if symmetric and item is not None and item_secondary is not None:
+                items.sort()
+            self._touched.add((key, items[1], items[0]))
+
+    def apply(self, values):
+        for (key, item_primary, item_secondary), (time, answer, value) in values.items():
+            InMemoryEnvironment.write(
+                self, key, value, item=item_primary, item_secondary=item_secondary,
+                time=time, audit=False, symmetric=False, answer=answer)
+
+    def pop_touched(self):
+        touched = {}
+        for (key, item_primary, item_secondary) in self._touched:
+            permanent, time, answer, value = self._get(key, None, item_primary, item_secondary, False)
+            touched[key, item_primary, item_secondary] = (time, answer, value)
+        self._touched = set()
+        return touched
+
+
+def _run_shard(connection, answers, epoch_ends, predictive_model, initial_values):
+    environment = _ShardEnvironment()
+    for (key, user, item_primary, item_secondary, permanent, time, answer, value) in initial_values:
+        InMemoryEnvironment.write(
+            environment, key, value, user=user, item=item_primary, item_secondary=item_secondary,
+            time=time, audit=False, symmetric=False, permanent=permanent, answer=answer)
+    predictions = []
+    start = 0
+    for end in epoch_ends:
+        environment.apply(connection.recv())
+        predictions.append(replay(answers[start:end], predictive_model, environment))
+        connection.send(environment.pop_touched())
+        start = end
+    environment.apply(connection.recv())
+    connection.send((
+        numpy.concatenate(predictions) if predictions else numpy.empty(0),
+        [v for v in environment.export_values() if v[1] is not None and not v[4]],
+        [a for a in environment.export_audit() if a[1] is not None],
+    ))
+    connection.close()
+
+
+def _receive(connection, shard):
+    try:
+        return connection.recv()
+    except EOFError:
+        raise Exception('The process replaying the shard {} failed.'.format(shard))
+
+
+def _merge(merged, touched_by_shards):
+    changed = {}
+    for touched in touched_by_shards:
+        for variable, (time, answer, value) in touched.items():
+            base = merged.get(variable)
+            base_value = 0.0 if base is None else base[2]
+            found = changed.get(variable)
+            if found is None:
+                changed[variable] = (time, answer, value)
+                continue
+            found_time, found_answer, found_value = found
+            changed[variable] = (
+                max(found_time, time),
+                answer if found_answer is None or (answer is not None and answer > found_answer) else found_answer,
+                found_value + value - base_value,
+            )
+    merged.update(changed)
+    return changed
+
+
+def _write_user_variables(environment, values, audit):
+    audited = set()
+    for (key, user, item_primary, item_secondary, time, answer, value) in audit:
+        audited.add((key, user, item_primary, item_secondary))
+        environment.write(
+            key, value, user=user, item=item_primary, item_secondary=item_secondary,
+            time=time, symmetric=False, answer=answer)
+    for (key, user, item_primary, item_secondary, permanent, time, answer, value) in values:
+        if (key, user, item_primary, item_secondary) not in audited:
+            environment.write(
+                key, value, user=user, item=item_primary, item_secondary=item_secondary,
+                time=time, audit=False, symmetric=False, answer=answer)
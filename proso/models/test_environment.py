@@ -1,5 +1,11 @@
 #  -*- coding: utf-8 -*-
 from . import environment as environment
+import datetime
+import random
+import shutil
+import tempfile
+import tracemalloc
+import unittest
 
 
 class InMemoryEnvironmentTest(environment.TestCommonEnvironment):
@@ -20,5 +26,116 @@ class InMemoryEnvironmentTest(environment.TestCommonEnvironment):
         self._answer += 1
         return self._answer
 
-    def generate_environment(self):
-        return environment.InMemoryEnvironment()
+    def generate_environment(self, **kwargs):
+        return environment.InMemoryEnvironment(**kwargs)
+
+    def test_audit_retention(self):
+        spilled = []
+        env = self.generate_environment(
+            audit_retention={'last': 3, 'current': 0, 'spilled': 'spill'},
+            audit_spill=lambda *record: spilled.append(record))
+        for value in range(10):
+            for key in ['last', 'current', 'spilled', 'all']:
+                env.write(key, value, user=1, item=2, answer=value)
+                env.write(key, value, user=2, item=2, answer=value)
+        env.write('last', 10, user=1, item=2, audit=False)
+        self.assertEqual([10, 8, 7], [v for (t, v) in env.audit('last', user=1, item=2)])
+        self.assertEqual([9, 8, 7], [v for (t, v) in env.audit('last', user=2, item=2)])
+        self.assertEqual([9], [v for (t, v) in env.audit('current', user=1, item=2)])
+        self.assertEqual([9], [v for (t, v) in env.audit('spilled', user=1, item=2)])
+        self.assertEqual(10, len(env.audit('all', user=1, item=2)))
+        self.assertEqual(9, env.read('spilled', user=1, item=2))
+        self.assertEqual(
+            [(1, 2, None, value, value) for value in range(10)],
+            [(u, i_p, i_s, a, v) for (k, u, i_p, i_s, t, a, v) in spilled if k == 'spilled' and u == 1])
+        exported = [(k, u, v) for (k, u, i_p, i_s, t, a, v) in env.export_audit()]
+        self.assertEqual(sorted(exported, key=str), sorted(
+            [('last', 1, v) for v in [7, 8, 10]] + [('last', 2, v) for v in [7, 8, 9]] +
+            [('current', u, 9) for u in [1, 2]] + [('all', u, v) for u in [1, 2] for v in range(10)],
+            key=str))
+        with self.assertRaises(Exception):
+            self.generate_environment(audit_retention={'spilled': 'spill'})
+
+
+class CompactInMemoryEnvironmentTest(InMemoryEnvironmentTest):
+
+    def generate_environment(self, **kwargs):
+        return environment.CompactInMemoryEnvironment(**kwargs)
+
+    def test_memory(self):
+        def _measure(env):
+            tracemalloc.start()
+            time = datetime.datetime(2016, 1, 1)
+            for answer in range(10000):
+                user = answer % 100
+                item = answer % 53
+                time += datetime.timedelta(seconds=10)
+                env.write('skill', answer / 1000.0, user=user, item=item, time=time, answer=answer)
+                env.write('difficulty', answer / 1000.0, item=item, time=time, answer=answer)
+                env.write('prior_skill', answer / 1000.0, user=user, time=time, answer=answer)
+            found = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            return found
+        in_memory = _measure(environment.InMemoryEnvironment())
+        compact = _measure(environment.CompactInMemoryEnvironment())
+        self.assertGreater(in_memory / compact, 3)
+
+    def test_delete_reuses_rows(self):
+        env = self.generate_environment()
+        env.write('parent', 1, item=1, item_secondary=2, symmetric=False, permanent=True)
+        env.delete('parent', item=1, item_secondary=2, symmetric=False)
+        env.write('parent', 1, item=1, item_secondary=3, symmetric=False, permanent=True)
+        self.assertEqual([(3, 1)], env.get_items_with_values('parent', 1))
+        self.assertEqual(1, len(list(env.export_values())))
+        self.assertEqual(1, len(env._values))
+
+
+class MappedEnvironmentTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(42)
+        self._env = environment.InMemoryEnvironment()
+        time = datetime.datetime(2016, 1, 1, 12)
+        for answer in range(500):
+            user = random.randint(1, 5)
+            item, item_secondary = random.randint(1, 20), random.randint(1, 20)
+            time += datetime.timedelta(seconds=random.randint(1, 100))
+            self._env.write('skill', random.gauss(0, 1), user=user, item=item, time=time, answer=answer)
+            self._env.write('difficulty', random.gauss(0, 1), item=item, time=time, answer=answer)
+            self._env.write('confusing', answer, item=item, item_secondary=item_secondary, time=time, answer=answer)
+        for item in range(1, 10):
+            self._env.write('parent', 1, item=item, item_secondary=item + 100, symmetric=False, permanent=True)
+        self._directory = tempfile.mkdtemp()
+        environment.save_snapshot(self._directory, self._env.export_values())
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_read(self):
+        mapped = environment.MappedEnvironment(self._directory)
+        items = list(range(0, 25))
+        for user in [None] + list(range(1, 7)):
+            for key in ['skill', 'difficulty', 'missing']:
+                self.assertEqual(
+                    self._env.read_more_items(key, items, user=user, default=-1),
+                    mapped.read_more_items(key, items, user=user, default=-1))
+                self.assertEqual(self._env.time_more_items(key, items, user=user), mapped.time_more_items(key, items, user=user))
+        for item in items:
+            self.assertEqual(
+                self._env.read_more_items('confusing', items, item=item, default=0),
+                mapped.read_more_items('confusing', items, item=item, default=0))
+            self.assertEqual(self._env.get_items_with_values('parent', item), mapped.get_items_with_values('parent', item))
+        self.assertEqual(self._env.read('skill', user=1, item=3), mapped.read('skill', user=1, item=3))
+        self.assertEqual(self._env.time('difficulty', item=4), mapped.time('difficulty', item=4))
+        self.assertEqual(
+            {i: values for i, values in self._env.get_all_items_with_values('parent').items() if values},
+            mapped.get_all_items_with_values('parent'))
+        self.assertEqual(sorted(self._env.export_values(), key=str), sorted(mapped.export_values(), key=str))
+        with self.assertRaises(Exception):
+            mapped.write('skill', 1, user=1)
+
+    def test_aware_time(self):
+        time = datetime.datetime(2016, 1, 1, 12, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+        environment.save_snapshot(self._directory, [('skill', 1, None, None, False, time, 1, 0.5)])
+        mapped = environment.MappedEnvironment(self._directory)
+        self.assertEqual(datetime.datetime(2016, 1, 1, 10), mapped.time('skill', user=1))
@@ -0,0 +1,71 @@
+from . import parameter_search
+import datetime
+import os
+import proso.metric
+import random
+import tempfile
+import unittest
+
+
+class ParameterSearchTest(unittest.TestCase):
+
+    MODEL_CLASS = 'proso.models.prediction.PriorCurrentPredictiveModel'
+
+    def setUp(self):
+        random.seed(42)
+        time = datetime.datetime(2016, 1, 1, 12)
+        self._rows = []
+        for answer_id in range(1, 301):
+            item = random.randint(1, 10)
+            self._rows.append((
+                answer_id,
+                random.randint(1, 5),
+                item,
+                item,
+                item if random.random() < 0.7 else random.choice([None, random.randint(1, 10)]),
+                time + datetime.timedelta(seconds=random.randint(0, 10 ** 6)),
+                random.randint(500, 5000),
+                random.choice([0.0, 0.25]),
+            ))
+        self._rows.sort(key=lambda row: row[5])
+
+    def test_answers_from_csv(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv_file:
+            csv_file.write('id,user,session,item,item_asked,item_answered,time,response_time,guess,config,context,metainfo,type,lang\n')
+            for (answer_id, user, item, asked, answered, time, response_time, guess) in reversed(self._rows):
+                csv_file.write('{},{},None,{},{},{},{},{},{},1,None,None,,cs\n'.format(
+                    answer_id, user, item, asked, answered, time, response_time, guess))
+        try:
+            found = parameter_search.answers_from_csv(csv_file.name)
+        finally:
+            os.remove(csv_file.name)
+        expected = parameter_search.answers_from_rows(self._rows)
+        self.assertEqual(expected.tolist(), found.tolist())
+        self.assertEqual(list(range(1, 301)), found['id'].tolist())
+
+    def test_search(self):
+        answers = parameter_search.answers_from_rows(self._rows)
+        configs = parameter_search.grid({'pfae_good': [1.0, 3.4], 'time_shift': [20, 80]})
+        self.assertEqual(4, len(configs))
+        found = parameter_search.search(answers, self.MODEL_CLASS, configs, base_parameters={'elo_alpha': 0.5}, processes=2)
+        expected = parameter_search.search(answers, self.MODEL_CLASS, configs, base_parameters={'elo_alpha': 0.5}, processes=1)
+        self.assertEqual(expected, found)
+        for config, result in zip(configs, found):
+            self.assertEqual(dict(config, elo_alpha=0.5), result['parameters'])
+            self.assertTrue(0 < result['rmse'] < 1)
+            self.assertTrue(0 < result['auc'] < 1)
+
+    def test_random_sample(self):
+        configs = parameter_search.random_sample({'elo_alpha': (0.1, 1.0), 'pfae_bad': (0.1, 0.5)}, 10, seed=1)
+        self.assertEqual(10, len(configs))
+        self.assertEqual(configs, parameter_search.random_sample({'elo_alpha': (0.1, 1.0), 'pfae_bad': (0.1, 0.5)}, 10, seed=1))
+        for config in configs:
+            self.assertTrue(0.1 <= config['elo_alpha'] <= 1.0)
+            self.assertTrue(0.1 <= config['pfae_bad'] <= 0.5)
+
+    def test_auc(self):
+        observed = [random.random() < 0.5 for i in range(200)]
+        predicted = [round(random.random(), 1) for i in range(200)]
+        pairs = [(p, n) for p, o_p in zip(predicted, observed) if o_p for n, o_n in zip(predicted, observed) if not o_n]
+        expected = sum([1.0 if p > n else 0.5 if p == n else 0.0 for p, n in pairs]) / len(pairs)
+        self.assertAlmostEqual(expected, proso.metric.auc(observed, predicted), places=10)
@@ -0,0 +1,233 @@
+from . import prediction as prediction
+from .environment import InMemoryEnvironment
+import datetime
+import itertools
+import numpy
+import os
+import random
+import time as time_lib
+import unittest
+import unittest.mock as mock
+
+
+class PriorCurrentPredictiveModelTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(42)
+        self._model = prediction.PriorCurrentPredictiveModel()
+        self._time = datetime.datetime(2016, 1, 1, 12)
+
+    def generate_data(self, number_of_items):
+        def _generate_last_time():
+            return self._time - datetime.timedelta(seconds=random.randint(0, 10 ** 6))
+        current_skills = [None if random.random() < 0.5 else random.gauss(0, 2) for i in range(number_of_items)]
+        return {
+            'prior_skill': random.gauss(0, 1),
+            'difficulties': [random.gauss(0, 2) for i in range(number_of_items)],
+            'current_skills': current_skills,
+            'last_times': [None if c is None else _generate_last_time() for c in current_skills],
+        }
+
+    def predict_phase_more_items_scalar(self, data, items, time, **kwargs):
+        return [
+            self._model.predict_phase({
+                'prior_skill': data['prior_skill'],
+                'difficulty': d,
+                'current_skill': c,
+                'last_time': t,
+            }, None, i, time, **kwargs)
+            for i, d, c, t in zip(items, data['difficulties'], data['current_skills'], data['last_times'])
+        ]
+
+    def test_predict_phase_more_items(self):
+        items = list(range(1000))
+        data = self.generate_data(len(items))
+        for time in [self._time, None]:
+            for kwargs in [{}, {'options': [1, 2, 3]}, {'guess': 0.25}]:
+                expected = self.predict_phase_more_items_scalar(data, items, time, **kwargs)
+                found = self._model.predict_phase_more_items(data, None, items, time, **kwargs)
+                self.assertEqual(len(expected), len(found))
+                for e, f in zip(expected, found):
+                    self.assertAlmostEqual(e, f, places=12)
+
+    def test_predict_phase_more_items_vectorized(self):
+        items = list(range(1000))
+        data = self.generate_data(len(items))
+        with mock.patch.object(prediction, 'predict_simple', wraps=prediction.predict_simple) as scalar, \
+                mock.patch.object(prediction, 'predict_simple_more_items', wraps=prediction.predict_simple_more_items) as vectorized:
+            self._model.predict_phase_more_items(data, None, items, self._time)
+        self.assertEqual(0, scalar.call_count)
+        self.assertEqual(1, vectorized.call_count)
+
+    @unittest.skipUnless(os.getenv('PROSO_BENCHMARK'), 'set PROSO_BENCHMARK environment variable to run benchmarks')
+    def test_predict_phase_more_items_benchmark(self):
+        items = list(range(10000))
+        data = self.generate_data(len(items))
+        time_start = time_lib.time()
+        self.predict_phase_more_items_scalar(data, items, self._time)
+        scalar_time = time_lib.time() - time_start
+        time_start = time_lib.time()
+        self._model.predict_phase_more_items(data, None, items, self._time)
+        vectorized_time = time_lib.time() - time_start
+        print('\n -- prediction of {} items, scalar: {:.4f} seconds, vectorized: {:.4f} seconds, speedup: {:.1f}x'.format(
+            len(items), scalar_time, vectorized_time, scalar_time / max(vectorized_time, 1e-9)))
+        self.assertLess(vectorized_time, scalar_time)
+
+    def test_predict_and_update_many(self):
+        answers = []
+        for answer_id in range(100):
+            item = random.randint(0, 9)
+            answers.append({
+                'user': random.randint(0, 2),
+                'item': item,
+                'item_asked': item,
+                'item_answered': item if random.random() < 0.6 else None,
+                'time': self._time + datetime.timedelta(minutes=answer_id),
+                'answer_id': answer_id,
+                'response_time': 1000,
+                'guess': 0,
+            })
+        expected_env = InMemoryEnvironment()
+        expected = []
+        for a in answers:
+            expected.append(self._model.predict_and_update(
+                expected_env, a['user'], a['item'], a['item_asked'] == a['item_answered'], a['time'], a['answer_id'],
+                item_asked=a['item_asked'], item_answered=a['item_answered'], guess=a['guess']))
+            expected_env.process_answer(
+                a['user'], a['item'], a['item_asked'], a['item_answered'], a['time'], a['answer_id'], a['response_time'], a['guess'])
+        found_env = InMemoryEnvironment()
+        self.assertEqual(expected, self._model.predict_and_update_many(found_env, answers))
+        # the time is not compared, because some variables are written with the current time
+        export = lambda env: sorted([(k, u, i_p, i_s, v) for (k, u, i_p, i_s, p, t, a, v) in env.export_values()], key=str)
+        self.assertEqual(export(expected_env), export(found_env))
+
+
+class AlwaysLearningPredictiveModelTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(42)
+        self._model = prediction.AlwaysLearningPredictiveModel()
+        self._time = datetime.datetime(2016, 1, 1, 12)
+
+    def generate_environment(self):
+        env = InMemoryEnvironment()
+        # leaves: 0-29, categories: 100-104, super categories: 200-201
+        # items 30-39 have no parents
+        for leaf in range(30):
+            for parent in random.sample(range(100, 105), random.randint(1, 2)):
+                env.write('parent', 1, item=leaf, item_secondary=parent, symmetric=False, permanent=True)
+        for category in range(100, 105):
+            for parent in random.sample(range(200, 202), random.randint(1, 2)):
+                env.write('parent', 1, item=category, item_secondary=parent, symmetric=False, permanent=True)
+        return env
+
+    def load_skill_per_level(self, env, user, item):
+        skill = 0
+        for level_items in self.iterate_parents_per_level(env, item):
+            weights = float(sum([w for (i, w) in level_items]))
+            skill += sum([env.read('skill', user=user, item=i, default=0) * w / weights for (i, w) in level_items])
+        return skill
+
+    def iterate_parents_per_level(self, env, item):
+        to_find = [(item, 1)]
+        while len(to_find) > 0:
+            yield to_find
+            to_find = [
+                iw for ps in [[] if i is None else env.get_items_with_values('parent', i) or [(None, 1)] for (i, w) in to_find]
+                for iw in ps
+            ]
+
+    def test_predict_more_items(self):
+        env = self.generate_environment()
+        items = list(range(40))
+        for answer_id in range(300):
+            user = random.randint(0, 2)
+            item = random.choice(items)
+            self._model.predict_and_update(env, user, item, random.random() < 0.6, self._time, answer_id, guess=0)
+            env.process_answer(user, item, item, item, self._time, answer_id, 1000, 0)
+        for user in range(3):
+            found = self._model.predict_more_items(env, user, items, self._time, guess=0)
+            for item, f in zip(items, found):
+                expected = prediction.predict_simple(
+                    self.load_skill_per_level(env, user, item) - env.read('difficulty', item=item, default=0),
+                    guess=0)[0]
+                self.assertAlmostEqual(expected, f, places=10)
+                self.assertAlmostEqual(self._model.predict(env, user, item, self._time, guess=0), f, places=10)
+        self.assertEqual(
+            [self._model.predict_more_items(env, user, items, self._time, guess=0) for user in range(3)],
+            self._model.predict_more_users_more_items(env, list(range(3)), items, self._time, guess=0))
+
+    def test_update_phase(self):
+        env = self.generate_environment()
+        user = 1
+        skills_before = {i: random.gauss(0, 1) for i in [None] + list(range(40)) + list(range(100, 105)) + [200, 201]}
+        for i, skill in skills_before.items():
+            env.write('skill', skill, user=user, item=i)
+        item = 7
+        prediction_before = self._model.predict(env, user, item, self._time, guess=0)
+        self._model.predict_and_update(env, user, item, True, self._time, 1, guess=0)
+        changed = {i for i, skill in skills_before.items() if env.read('skill', user=user, item=i) != skill}
+        expected = {i for level_items in self.iterate_parents_per_level(env, item) for (i, w) in level_items}
+        self.assertEqual(changed, expected)
+        self.assertGreater(self._model.predict(env, user, item, self._time, guess=0), prediction_before)
+
+    def test_skill_matrix_version(self):
+        env = self.generate_environment()
+        skill_matrix = prediction.get_skill_matrix(env, [0, 1])
+        self.assertIs(skill_matrix, prediction.get_skill_matrix(env, [0, 1, 100]))
+        env.write('parent', 1, item=0, item_secondary=200, symmetric=False, permanent=True)
+        new_skill_matrix = prediction.get_skill_matrix(env, [0, 1])
+        self.assertIsNot(skill_matrix, new_skill_matrix)
+        self.assertIn(new_skill_matrix.nodes.index(200), new_skill_matrix.ancestors([0]))
+        self.assertTrue(prediction.get_skill_matrix(env, [1000]).covers([0, 1000]))
+
+    def test_skill_matrix_without_version(self):
+        env = self.generate_environment()
+        expected = prediction.get_skill_matrix(env, [0, 1])
+        with mock.patch.object(env, 'items_with_values_version', return_value=None), \
+                mock.patch.object(env, 'get_all_items_with_values', side_effect=AssertionError):
+            found = prediction.get_skill_matrix(env, [0, 1])
+        self.assertEqual(
+            sorted([expected.nodes[a] for a in expected.ancestors([0, 1])], key=str),
+            sorted([found.nodes[a] for a in found.ancestors([0, 1])], key=str))
+        skills = numpy.random.rand(len(expected.nodes))
+        found_skills = numpy.array([skills[expected.nodes.index(n)] for n in found.nodes])
+        for item in [0, 1]:
+            self.assertAlmostEqual(expected.skill(item, skills), found.skill(item, found_skills))
+
+
+class PredictTest(unittest.TestCase):
+
+    def predict_enumeration(self, skill_asked, option_skills):
+        probs = [prediction._sigmoid(x) for x in [skill_asked] + option_skills]
+        asked_prob = 0
+        opt_wrong_probs = [0 for i in option_skills]
+        for knows in itertools.product([False, True], repeat=len(probs)):
+            guess_options = 1 if knows[0] else sum([1 - x for x in knows])
+            current_prob = 1.0
+            for p, k in zip(probs, knows):
+                current_prob *= p if k else 1 - p
+            asked_prob += current_prob / guess_options
+            if guess_options > 1:
+                for j in range(len(option_skills)):
+                    if not knows[j + 1]:
+                        opt_wrong_probs[j] += current_prob / guess_options
+        return asked_prob, opt_wrong_probs
+
+    def test_predict(self):
+        random.seed(42)
+        self.assertEqual(prediction.predict(0.5, []), (prediction._sigmoid(0.5), []))
+        for number_of_options in range(1, 10):
+            for i in range(20):
+                skill_asked = random.gauss(0, 3)
+                option_skills = [random.gauss(0, 3) for j in range(number_of_options)]
+                expected_asked, expected_options = self.predict_enumeration(skill_asked, option_skills)
+                found_asked, found_options = prediction.predict(skill_asked, option_skills)
+                self.assertAlmostEqual(expected_asked, found_asked, places=10)
+                self.assertEqual(len(expected_options), len(found_options))
+                for e, f in zip(expected_options, found_options):
+                    self.assertAlmostEqual(e, f, places=10)
+
+    def test_predict_many_options(self):
+        asked_prob, opt_wrong_probs = prediction.predict(0.0, [0.0 for i in range(100)])
+        self.assertAlmostEqual(asked_prob + sum(opt_wrong_probs), 1.0, places=10)
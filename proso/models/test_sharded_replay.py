@@ -0,0 +1,48 @@
+from . import parameter_search
+from . import sharded_replay
+from .environment import InMemoryEnvironment
+from .prediction import PriorCurrentPredictiveModel
+import datetime
+import random
+import unittest
+
+
+class ShardedReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(42)
+        time = datetime.datetime(2016, 1, 1, 12)
+        self._answers = parameter_search.answers_from_rows([
+            (
+                answer_id,
+                random.randint(1, 10),
+                item,
+                item,
+                item if random.random() < 0.7 else random.choice([None, random.randint(1, 10)]),
+                time + datetime.timedelta(minutes=answer_id),
+                1000,
+                0.0,
+            )
+            for answer_id, item in [(i, random.randint(1, 10)) for i in range(1, 401)]
+        ])
+
+    def test_one_shard_is_sequential(self):
+        predictions = sharded_replay.replay_sharded(self._answers, PriorCurrentPredictiveModel(), shards=1, epoch_size=50)
+        comparison = sharded_replay.compare_with_sequential(self._answers, predictions, PriorCurrentPredictiveModel())
+        self.assertEqual(0, comparison['max_difference'])
+
+    def test_replay_sharded(self):
+        environment = InMemoryEnvironment()
+        predictions = sharded_replay.replay_sharded(
+            self._answers, PriorCurrentPredictiveModel(), shards=3, epoch_size=50, environment=environment)
+        sequential = InMemoryEnvironment()
+        parameter_search.replay(self._answers, PriorCurrentPredictiveModel(), sequential)
+        self.assertEqual(400, environment.number_of_answers())
+        for i in range(1, 11):
+            self.assertEqual(sequential.number_of_answers(item=i), environment.number_of_answers(item=i))
+            self.assertEqual(sequential.number_of_answers(user=i), environment.number_of_answers(user=i))
+            self.assertEqual(sequential.rolling_success(i), environment.rolling_success(i))
+        comparison = sharded_replay.compare_with_sequential(self._answers, predictions, PriorCurrentPredictiveModel())
+        self.assertTrue(0 < comparison['max_difference'])
+        self.assertTrue(comparison['mean_difference'] < 0.05)
+        self.assertTrue(abs(comparison['rmse_difference']) < 0.01)
@@ -1,6 +1,7 @@
 from django.contrib.auth.models import User
 from django.core.management import call_command
 from proso.django.config import reset_overridden
+from proso.django.instrumentation import reset_histograms
 from proso.django.test import TestCase
 import json
 
@@ -51,6 +52,21 @@ class CommonAPITest(TestCase):
                 response = self.client.get(csv_item['url'])
                 self.assertTrue(response.status_code in [200, 204], 'The CSV file can be downloaded or is empty.')
 
+    def testInstrumentation(self):
+        reset_histograms()
+        response = self.client.get('/common/instrumentation/')
+        self.assertEqual(response.status_code, 401, "Non-staff user can't get the instrumentation.")
+        self.assertIn('sql;dur=', response['Server-Timing'])
+        self.client.login(username='admin', password='admin')
+        response = self.client.get('/common/config/?debug=true')
+        debug = json.loads(response.content.decode("utf-8"))['debug_instrumentation']
+        self.assertEqual(debug['view'], 'proso_common.views.config')
+        self.assertEqual(set(debug['sql'].keys()), {'count', 'time'})
+        response = self.client.get('/common/instrumentation/')
+        self.assertEqual(response.status_code, 200, "Staff user can get the instrumentation.")
+        histograms = json.loads(response.content.decode("utf-8"))['data']
+        self.assertEqual(histograms['proso_common.views.config']['requests'], 1)
+
     def testLanguages(self):
         response = self.client.get('/common/languages/')
         self.assertDictEqual(json.loads(response.content.decode("utf-8"))['data'], settings.LANGUAGE_DOMAINS,
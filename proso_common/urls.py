@@ -8,6 +8,7 @@ urlpatterns = patterns(
     url(r'^csv/$', 'csv', name='csv_list'),
     url(r'^csv/(?P<filename>\w+)', 'csv', name='csv_table'),
     url(r'^log/$', 'log', name='log'),
+    url(r'^instrumentation/$', 'instrumentation', name='instrumentation'),
     url(r'^analysis/$', 'analysis', name='analysis'),
     url(r'^analysis/(?P<app_name>\w+)$', 'analysis', name='analysis'),
     url(r'^config_bar/$', (TemplateView.as_view(template_name="common_config_bar.html")), name='config_bar'),
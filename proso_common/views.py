@@ -13,6 +13,7 @@ import hashlib
 from django.core.cache import cache
 import json as json_lib
 import logging
+import proso.django.instrumentation
 from proso.django.config import get_global_config
 from django.db.models.sql.datastructures import EmptyResultSet
 from django.views.decorators.csrf import ensure_csrf_cookie
@@ -156,6 +157,25 @@ def config(request):
     return render_json(request, get_global_config(), template='common_json.html')
 
 
+def instrumentation(request):
+    """
+    Return histograms of the number of SQL queries, the SQL time and the
+    whole time of the requests processed by this process, grouped by view.
+
+    GET parameters:
+      reset:
+        clear the histograms after they are returned
+    """
+    if not request.user.is_staff:
+        response = {
+            "error": "Permission denied: you need to be staff member. If you think you should be able to access the instrumentation, contact admins."}
+        return render_json(request, response, status=401, template='common_json.html')
+    histograms = proso.django.instrumentation.get_histograms()
+    if 'reset' in request.GET:
+        proso.django.instrumentation.reset_histograms()
+    return render_json(request, histograms, template='common_json.html', help_text=instrumentation.__doc__)
+
+
 def languages(request):
     """
     Returns languages that are available in the system.
@@ -1,11 +1,12 @@
 import json
 import logging
 from collections import defaultdict
+from functools import reduce
 from hashlib import sha1
 from time import time as time_lib
 from django.contrib.auth.models import User
 from django.db import models
-from django.db.models import Q, Count, Sum, Max, Min
+from django.db.models import Q, Sum, Max, Min
 from django.db.models.signals import pre_save
 from django.dispatch import receiver
 
@@ -16,6 +17,9 @@ from proso_models.models import Answer, Item, get_environment, get_mastery_trash
 
 LOGGER = logging.getLogger('django.request')
 
+# stats computed only from the answers, they are kept if there is no answer
+TIME_STATS = ['time_spent', 'session_count', 'time_first', 'time_last']
+
 
 class TagManager(models.Manager):
     def prepare_related(self):
@@ -234,7 +238,7 @@ class UserStatManager(models.Manager):
     def prepare_related(self):
         return self.select_related('concept')
 
-    def recalculate_concepts(self, concepts, lang=None):
+    def recalculate_concepts(self, concepts, lang=None, user_chunk_size=100):
         """
         Recalculated given concepts for given users
 
@@ -242,6 +246,9 @@ class UserStatManager(models.Manager):
             concepts (dict): user id (int -> set of concepts to recalculate)
             lang(Optional[str]): language used to get items in all concepts (cached).
                 Defaults to None, in that case are get items only in used concepts
+            user_chunk_size (int): number of users recalculated at once, the
+                number of queries does not depend on the number of users and
+                concepts within one chunk
         """
         if len(concepts) == 0:
             return
@@ -251,41 +258,60 @@ class UserStatManager(models.Manager):
         else:
             items = Concept.objects.get_concept_item_mapping(lang=lang)
 
+        users = sorted(concepts.keys())
+        for i in range(0, len(users), user_chunk_size):
+            self._recalculate_concepts_chunk({u: concepts[u] for u in users[i:i + user_chunk_size]}, items)
+
+    def _recalculate_concepts_chunk(self, concepts, items):
         environment = get_environment()
         mastery_threshold = get_mastery_trashold()
-        for user, concepts in concepts.items():
-            all_items = list(set(flatten([items[c] for c in concepts])))
-            answer_counts = dict(list(zip(all_items, environment.number_of_answers_more_items(all_items, user))))
-            correct_answer_counts = dict(list(zip(all_items,
-                                                  environment.number_of_correct_answers_more_items(all_items, user))))
-            predictions = dict(list(zip(all_items, get_predictive_model().
-                                        predict_more_items(environment, user, all_items, time=None))))
-            new_user_stats = []
-            stats_to_delete_condition = Q()
-            for concept in concepts:
-                answer_aggregates = Answer.objects.filter(user=user, item__in=items[concept]).aggregate(
-                    time_spent=Sum("response_time"),
-                    sessions=Count("session", True),
-                    time_first=Min("time"),
-                    time_last=Max("time"),
-                )
+        users = list(concepts.keys())
+        all_items = list(set(flatten([items[c] for user_concepts in concepts.values() for c in user_concepts])))
+        answer_counts = environment.number_of_answers_more_users_more_items(all_items, users)
+        correct_answer_counts = environment.number_of_correct_answers_more_users_more_items(all_items, users)
+        predictions = get_predictive_model().predict_more_users_more_items(environment, users, all_items, time=None)
+        # user -> item -> [aggregates per session]
+        answer_aggregates = defaultdict(lambda: defaultdict(list))
+        for aggregate in Answer.objects.filter(user__in=users, item__in=all_items).values('user', 'item', 'session').annotate(
+                time_spent=Sum("response_time"),
+                time_first=Min("time"),
+                time_last=Max("time")).order_by():
+            answer_aggregates[aggregate['user']][aggregate['item']].append(aggregate)
+        new_user_stats = []
+        # concept -> users, the time stats of the concepts without answers are kept
+        recalculated = defaultdict(list)
+        recalculated_without_time = defaultdict(list)
+        for user, user_answer_counts, user_correct_answer_counts, user_predictions in zip(users, answer_counts, correct_answer_counts, predictions):
+            user_answer_counts = dict(list(zip(all_items, user_answer_counts)))
+            user_correct_answer_counts = dict(list(zip(all_items, user_correct_answer_counts)))
+            user_predictions = dict(list(zip(all_items, user_predictions)))
+            for concept in concepts[user]:
+                concept_aggregates = [a for i in items[concept] for a in answer_aggregates[user][i]]
                 stats = {
-                    "answer_count": sum(answer_counts[i] for i in items[concept]),
-                    "correct_answer_count": sum(correct_answer_counts[i] for i in items[concept]),
+                    "answer_count": sum(user_answer_counts[i] for i in items[concept]),
+                    "correct_answer_count": sum(user_correct_answer_counts[i] for i in items[concept]),
                     "item_count": len(items[concept]),
-                    "practiced_items_count": sum([answer_counts[i] > 0 for i in items[concept]]),
-                    "mastered_items_count": sum([predictions[i] >= mastery_threshold for i in items[concept]]),
-                    "prediction": sum([predictions[i] for i in items[concept]]) / len(items[concept]),
-                    "time_spent": answer_aggregates["time_spent"] / 1000,
-                    "session_count": answer_aggregates["sessions"],
-                    "time_first": answer_aggregates["time_first"].timestamp(),
-                    "time_last": answer_aggregates["time_last"].timestamp(),
+                    "practiced_items_count": sum([user_answer_counts[i] > 0 for i in items[concept]]),
+                    "mastered_items_count": sum([user_predictions[i] >= mastery_threshold for i in items[concept]]),
+                    "prediction": sum([user_predictions[i] for i in items[concept]]) / len(items[concept]),
                 }
-                stats_to_delete_condition |= Q(user=user, concept=concept)
+                if len(concept_aggregates) > 0:
+                    stats.update({
+                        "time_spent": sum([a["time_spent"] for a in concept_aggregates]) / 1000,
+                        "session_count": len({a["session"] for a in concept_aggregates if a["session"] is not None}),
+                        "time_first": min([a["time_first"] for a in concept_aggregates]).timestamp(),
+                        "time_last": max([a["time_last"] for a in concept_aggregates]).timestamp(),
+                    })
+                    recalculated[concept].append(user)
+                else:
+                    recalculated_without_time[concept].append(user)
                 for stat_name, value in stats.items():
                     new_user_stats.append(UserStat(user_id=user, concept_id=concept, stat=stat_name, value=value))
-            self.filter(stats_to_delete_condition).delete()
-            self.bulk_create(new_user_stats)
+        if recalculated:
+            self.filter(_concepts_users_condition(recalculated)).delete()
+        if recalculated_without_time:
+            self.filter(_concepts_users_condition(recalculated_without_time)).exclude(stat__in=TIME_STATS).delete()
+        self.bulk_create(new_user_stats)
 
     def get_user_stats(self, users, lang=None, concepts=None, since=None, recalculate=True):
         """
@@ -369,3 +395,8 @@ def generate_identifier(sender, instance, **kwargs):
     if qs.count() > 0:
         raise ValueError("Concept identifier conflict")
     instance.identifier = identifier
+
+
+def _concepts_users_condition(concepts_users):
+    # concept -> users, one condition for all the concepts
+    return reduce(lambda a, b: a | b, [Q(concept=concept, user__in=users) for concept, users in concepts_users.items()])
@@ -1,6 +1,7 @@
 from django.conf import settings
 from functools import wraps
 from proso.django.cache import get_request_cache, is_cache_prepared
+from proso.django.instrumentation import record_cache
 import inspect
 
 
@@ -30,8 +31,10 @@ class cache_environment_for_item:
                 cache_key = cache_keys[item]
                 if not _cache_has_key(cache_key):
                     other_items.append(item)
+                    record_cache('cache_environment_for_item', False)
                 else:
                     cached_items[item] = _cache_get(cache_key, default)
+                    record_cache('cache_environment_for_item', True)
             if len(other_items) > 0:
                 args_dict['items'] = other_items
                 inner_result = dict(list(zip(other_items, func(self, **args_dict))))
@@ -1,26 +1,62 @@
 from .decorator import cache_environment_for_item
-from .models import Answer, Variable
-from collections import defaultdict
+from .models import Answer, Audit, Variable, get_item_relation_version, bump_item_relation_version, save_audits, close_audit_intervals, has_uncommitted_item_relations, is_item_relation_version_shared, ROLLING_SUCCESS_SIZE
+from .partitions import next_variable_id, partition_table
+from collections import defaultdict, OrderedDict
 from contextlib import closing
 from datetime import datetime
 from django.conf import settings
 from django.core.cache import cache
 from django.db import connection
 from django.db import transaction
+from proso.django.cache import get_from_request_permenent_cache, set_to_request_permanent_cache
 from proso.django.config import get_config
+from proso.django.instrumentation import instrument_methods
+from proso.db import copy_rows, delete_by_ids
 from proso.django.util import is_on_postgresql
-from proso.models.environment import CommonEnvironment, InMemoryEnvironment
+from proso.models.environment import CommonEnvironment, CompactInMemoryEnvironment, InMemoryEnvironment, MappedEnvironment, save_snapshot
+from itertools import groupby
+import json
 import logging
+import numpy
 import os.path
 import re
+import shutil
 
 LOGGER = logging.getLogger('django.request')
 
 # This is hack to emulate TRUE value on both psql and sqlite
 DATABASE_TRUE = '1 = 1'
 
+ITEM_RELATION_SNAPSHOT_EXPIRATION = 24 * 60 * 60
+ITEM_RELATION_SNAPSHOTS_CACHE_KEY = 'proso_models_item_relation_snapshots'
 
-class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
+# key of the item relation -> (version, item -> [(item secondary, value)])
+_item_relation_snapshots = {}
+
+
+def ensure_is_datetime(value):
+    """
+    Converts the value of the datetime column fetched by the raw query (it is
+    a string on SQLite) to the naive datetime.
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    else:
+        matched = re.match(r'([\d -\:]*)\.\d+', value)
+        if matched is not None:
+            value = matched.groups()[0]
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+class DatabaseFlushMixin(object):
+
+    """
+    Flushes the variables of the in-memory environment (see
+    :py:class:`proso.models.environment.AbstractInMemoryEnvironment`) into the
+    database, it has to precede the in-memory environment in the bases.
+    """
 
     DROP_KEYS = [
         InMemoryEnvironment.NUMBER_OF_ANSWERS,
@@ -30,12 +66,65 @@ class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
         InMemoryEnvironment.CONFUSING_FACTOR
     ]
 
-    def __init__(self, info):
+    AUDIT_COLUMNS = ['key', 'user_id', 'item_primary_id', 'item_secondary_id', 'time', 'answer_id', 'value', 'info_id']
+    VARIABLE_COLUMNS = ['key', 'user_id', 'item_primary_id', 'item_secondary_id', 'value', 'audit', 'updated', 'answer_id', 'permanent', 'info_id']
+
+    # the audit of the dropped keys is not flushed, only the last correctness
+    # is needed for the rolling success
+    DEFAULT_AUDIT_RETENTION = dict(
+        [(key, 0) for key in DROP_KEYS if key != InMemoryEnvironment.LAST_CORRECTNESS] +
+        [(InMemoryEnvironment.LAST_CORRECTNESS, 10)]
+    )
+
+    def __init__(self, info, audit_retention=None):
+        """
+        Args:
+            info (proso_models.models.EnvironmentInfo): recomputed environment
+            audit_retention (dict):
+                key -> audit retention policy (see
+                :py:class:`proso.models.environment.InMemoryEnvironment`), the
+                records of the keys with 'spill' policy are streamed straight
+                to the file with the audit loaded during the flush
+        """
         # key -> user -> item_primary -> item_secondary -> [(time, value)]
-        InMemoryEnvironment.__init__(self)
+        super(DatabaseFlushMixin, self).__init__(
+            audit_retention=dict(self.DEFAULT_AUDIT_RETENTION, **(audit_retention if audit_retention else {})),
+            audit_spill=self._spill_audit)
         self._prefetched = {}
         self._info_id = info.id
         self._to_delete = []
+        self._filename_audit = os.path.join(settings.DATA_DIR, 'environment_flush_audit.csv')
+        self._file_audit = None
+        # incremental checkpoints, see start_checkpoints()
+        self._checkpoints = False
+        self._dirty = set()
+        # prefetched key -> id of the variable saved by the last checkpoint
+        self._checkpointed = {}
+
+    def start_checkpoints(self, directory=None):
+        """
+        Switches the environment to the incremental mode used by
+        'recompute_model --follow': all the variables of the environment info
+        are prefetched and each :py:meth:`checkpoint` saves only the changes
+        since the previous one, so the environment can stay resident.
+
+        Args:
+            directory (str): directory for the local state (see
+                :py:meth:`save_state`), the audit records waiting for the
+                checkpoint are stored there
+        """
+        self._checkpoints = True
+        if directory is not None:
+            self._use_state_directory(directory, 0)
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT key, user_id, item_primary_id, item_secondary_id, updated, value, id
+                FROM proso_models_variable
+                WHERE info_id = %s OR permanent
+                ''', [self._info_id])
+            for row in cursor:
+                self._prefetched[row[0], row[1], row[2], row[3]] = (row[4].replace(tzinfo=None), row[5], row[6])
 
     def prefetch(self, users, items):
         if len(users) == 0 and len(items) == 0:
@@ -68,69 +157,260 @@ class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
         if prefetched:
             return prefetched[1]
         else:
-            return InMemoryEnvironment.read(
-                self, key, user=user, item=item, item_secondary=item_secondary,
+            return super(DatabaseFlushMixin, self).read(
+                key, user=user, item=item, item_secondary=item_secondary,
                 default=default, symmetric=symmetric
             )
 
+    def get_all_items_with_values(self, key, user=None):
+        result = DatabaseEnvironment(self._info_id).get_all_items_with_values(key, user=user)
+        for item, values in super(DatabaseFlushMixin, self).get_all_items_with_values(key, user=user).items():
+            merged = dict(result.get(item, []))
+            merged.update(values)
+            result[item] = list(merged.items())
+        return result
+
     def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
         prefetched_key = self._prefetched_key(key, user, item, item_secondary, symmetric)
         prefetched = self._prefetched.get(prefetched_key)
         if prefetched is not None:
             self._to_delete.append(prefetched[2])
             del self._prefetched[prefetched_key]
-        InMemoryEnvironment.write(
-            self, key, value, user=user, item=item,
-            item_secondary=item_secondary, time=time, audit=audit,
+        if not self._checkpoints:
+            super(DatabaseFlushMixin, self).write(
+                key, value, user=user, item=item,
+                item_secondary=item_secondary, time=time, audit=audit,
+                symmetric=symmetric, permanent=permanent, answer=answer
+            )
+            return
+        if time is None:
+            time = datetime.now()
+        new_record = not permanent and (audit or self._get(key, user, item, item_secondary, symmetric) is None)
+        # the audit records are saved by the checkpoints, only the history
+        # of the keys with the retention policy is kept in the memory
+        super(DatabaseFlushMixin, self).write(
+            key, value, user=user, item=item,
+            item_secondary=item_secondary, time=time, audit=audit and key in self._audit_retention,
             symmetric=symmetric, permanent=permanent, answer=answer
         )
+        self._dirty.add(prefetched_key)
+        # the records of the keys with 'spill' policy are already spilled
+        if new_record and self._audit_retention.get(key) != self.AUDIT_SPILL:
+            self._spill_audit(key, user, prefetched_key[2], prefetched_key[3], time, answer, float(value))
 
     def time(self, key, user=None, item=None, item_secondary=None, symmetric=True):
         prefetched = self._get_prefetched(key, user, item, item_secondary, symmetric)
         if prefetched:
             return prefetched[0]
         else:
-            return InMemoryEnvironment.time(
-                self, key, user=user, item=item,
+            return super(DatabaseFlushMixin, self).time(
+                key, user=user, item=item,
                 item_secondary=item_secondary, symmetric=symmetric
             )
 
     def flush(self, clean):
-        filename_audit = os.path.join(settings.DATA_DIR, 'environment_flush_audit.csv')
-        filename_variable = os.path.join(settings.DATA_DIR, 'environment_flush_variable.csv')
-        with open(filename_audit, 'w') as file_audit:
-            for (key, u, i_p, i_s, t, a, v) in self.export_audit():
-                if key in self.DROP_KEYS:
-                    continue
-                file_audit.write(
-                    '%s,%s,%s,%s,%s,%s,%s,%s\n' % (key, u, i_p, i_s, t.strftime('%Y-%m-%d %H:%M:%S'), a, v, self._info_id))
-        with open(filename_variable, 'w') as file_variable:
-            for (key, u, i_p, i_s, p, t, a, v) in self.export_values():
-                file_variable.write(
-                    '%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n' % (key, u, i_p, i_s, v, 0, t, a, p, self._info_id))
+        spilled = self._close_spilled_audit()
+        with transaction.atomic():
+            self._load_flushed(self.export_values(), self._audit_rows(spilled, self.export_audit()), self._to_delete, clean)
+        self._clear_spilled_audit(spilled)
+
+    def checkpoint(self, clean=False):
+        """
+        Saves the audit records and the current values of the variables
+        written since the previous checkpoint, the values saved by the
+        previous checkpoints are replaced. Available only after
+        :py:meth:`start_checkpoints`.
+
+        Args:
+            clean (bool): delete the variables which are not needed when the
+                environment is active (see DROP_KEYS)
+        """
+        if not self._checkpoints:
+            raise Exception('The checkpoints have not been started.')
+        spilled = self._close_spilled_audit()
+        to_delete = self._to_delete + [self._checkpointed[k] for k in self._dirty if k in self._checkpointed]
         with transaction.atomic():
             with closing(connection.cursor()) as cursor:
+                cursor.execute('SELECT MAX(id) FROM proso_models_variable WHERE info_id = %s', [self._info_id])
+                last_id = cursor.fetchone()[0]
+                self._load_flushed(self._export_dirty_values(), self._audit_rows(spilled, []), to_delete, clean)
+                cursor.execute(
+                    '''
+                    SELECT key, user_id, item_primary_id, item_secondary_id, id
+                    FROM proso_models_variable
+                    WHERE info_id = %s AND id > %s
+                    ''', [self._info_id, 0 if last_id is None else last_id])
+                checkpointed = {(k, u, i_p, i_s): v_id for (k, u, i_p, i_s, v_id) in cursor}
+        self._clear_spilled_audit(spilled)
+        self._checkpointed.update(checkpointed)
+        self._to_delete = []
+        self._dirty = set()
+
+    @staticmethod
+    def state_meta(directory):
+        """
+        Returns:
+            dict: meta data of the local state saved by :py:meth:`save_state`
+            (including 'info' with the identifier of the environment info), or
+            None if there is no state in the given directory
+        """
+        filename = os.path.join(directory, 'state', 'meta.json')
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'r') as meta_file:
+            return json.load(meta_file)
+
+    def save_state(self, directory, **meta):
+        """
+        Saves the state of the environment in the incremental mode into the
+        local directory, so the next run can continue by :py:meth:`load_state`
+        instead of prefetching the variables from the database. The state is
+        stored as binary snapshots (see
+        :py:func:`proso.models.environment.save_snapshot`).
+
+        Args:
+            directory (str): the same directory as passed to
+                :py:meth:`start_checkpoints` or :py:meth:`load_state`
+            meta: additional JSON serializable data, see :py:meth:`state_meta`
+        """
+        if not self._checkpoints or self._filename_audit != os.path.join(directory, 'audit.csv'):
+            raise Exception('The checkpoints have not been started with the state directory {}.'.format(directory))
+        if self._file_audit is not None:
+            self._file_audit.flush()
+        target = os.path.join(directory, 'state')
+        tmp = target + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        save_snapshot(os.path.join(tmp, 'values'), self.export_values())
+        save_snapshot(os.path.join(tmp, 'audit'), (
+            (key, u, i_p, i_s, False, t, a, v)
+            for (key, u, i_p, i_s, t, a, v) in self.export_audit()
+            if self._audit_retention.get(key, 0) != 0
+        ))
+        save_snapshot(os.path.join(tmp, 'dirty'), self._export_dirty_values())
+        # the answer column contains the identifier of the saved variable
+        save_snapshot(os.path.join(tmp, 'prefetched'), (
+            (key, u, i_p, i_s, False, t, v_id, v)
+            for ((key, u, i_p, i_s), (t, v, v_id)) in self._prefetched.items()
+        ))
+        save_snapshot(os.path.join(tmp, 'checkpointed'), (
+            (key, u, i_p, i_s, False, datetime(1970, 1, 1), v_id, 0)
+            for ((key, u, i_p, i_s), v_id) in self._checkpointed.items()
+        ))
+        numpy.save(os.path.join(tmp, 'to_delete.npy'), numpy.array(self._to_delete, dtype=numpy.int64))
+        filename_audit = os.path.join(directory, 'audit.csv')
+        with open(os.path.join(tmp, 'meta.json'), 'w') as meta_file:
+            json.dump(dict(meta, info=self._info_id, audit_size=os.path.getsize(filename_audit) if os.path.exists(filename_audit) else 0), meta_file)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        os.rename(tmp, target)
+
+    def load_state(self, directory):
+        """
+        Restores the state saved by :py:meth:`save_state` and switches the
+        environment to the incremental mode.
+
+        Returns:
+            dict: meta data of the state
+        """
+        meta = self.state_meta(directory)
+        if meta is None:
+            raise Exception('There is no state in the directory {}.'.format(directory))
+        if meta['info'] != self._info_id:
+            raise Exception('The state in the directory {} belongs to the environment info {}.'.format(directory, meta['info']))
+        state = os.path.join(directory, 'state')
+        audited = set()
+        for (key, u, i_p, i_s, p, t, a, v) in MappedEnvironment(os.path.join(state, 'audit')).export_values():
+            audited.add((key, u, i_p, i_s))
+            super(DatabaseFlushMixin, self).write(
+                key, v, user=u, item=i_p, item_secondary=i_s, time=t, audit=True, symmetric=False, answer=a)
+        for (key, u, i_p, i_s, p, t, a, v) in MappedEnvironment(os.path.join(state, 'values')).export_values():
+            if (key, u, i_p, i_s) not in audited:
+                super(DatabaseFlushMixin, self).write(
+                    key, v, user=u, item=i_p, item_secondary=i_s, time=t, audit=False, symmetric=False, permanent=p, answer=a)
+        self._dirty = {
+            (key, u, i_p, i_s)
+            for (key, u, i_p, i_s, p, t, a, v) in MappedEnvironment(os.path.join(state, 'dirty')).export_values()
+        }
+        self._prefetched = {
+            (key, u, i_p, i_s): (t, v, v_id)
+            for (key, u, i_p, i_s, p, t, v_id, v) in MappedEnvironment(os.path.join(state, 'prefetched')).export_values()
+        }
+        self._checkpointed = {
+            (key, u, i_p, i_s): v_id
+            for (key, u, i_p, i_s, p, t, v_id, v) in MappedEnvironment(os.path.join(state, 'checkpointed')).export_values()
+        }
+        self._to_delete = numpy.load(os.path.join(state, 'to_delete.npy')).tolist()
+        self._checkpoints = True
+        self._use_state_directory(directory, meta['audit_size'])
+        return meta
+
+    def _use_state_directory(self, directory, audit_size):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._filename_audit = os.path.join(directory, 'audit.csv')
+        if os.path.exists(self._filename_audit) and os.path.getsize(self._filename_audit) >= audit_size:
+            # drop the records written after the state was saved
+            with open(self._filename_audit, 'a') as file_audit:
+                file_audit.truncate(audit_size)
+        elif audit_size > 0:
+            raise Exception('The audit records of the state in the directory {} are missing.'.format(directory))
+        self._file_audit = open(self._filename_audit, 'a')
+
+    def _export_dirty_values(self):
+        for (key, user, item_primary, item_secondary) in self._dirty:
+            found = self._get(key, user, item_primary, item_secondary, False)
+            if found is not None:
+                yield (key, user, item_primary, item_secondary) + tuple(found)
+
+    def _load_flushed(self, values, audit, to_delete, clean):
+        # both the tables are loaded in the current transaction, so the audit
+        # records are never committed without the variables
+        audit_table = partition_table('proso_models_audit', self._info_id)
+        variable_table = partition_table('proso_models_variable', self._info_id)
+        with closing(connection.cursor()) as cursor:
+            if is_on_postgresql():
                 cursor.execute('SET CONSTRAINTS ALL DEFERRED')
-                if self._to_delete:
-                    cursor.execute('DELETE FROM proso_models_variable WHERE id IN (' + ','.join(map(str, self._to_delete)) + ')')
-                if clean:
-                    cursor.execute('DELETE FROM proso_models_variable WHERE key IN (' + ','.join(['%s' for k in self.DROP_KEYS]) + ') AND info_id = %s', self.DROP_KEYS + [self._info_id])
-                with open(filename_audit, 'r') as file_audit:
-                    cursor.copy_from(
-                        file_audit,
-                        'proso_models_audit',
-                        sep=',',
-                        null='None',
-                        columns=['key', 'user_id', 'item_primary_id', 'item_secondary_id', 'time', 'answer_id', 'value', 'info_id']
-                    )
-                with open(filename_variable, 'r') as file_variable:
-                    cursor.copy_from(
-                        file_variable,
-                        'proso_models_variable',
-                        sep=',',
-                        null='None',
-                        columns=['key', 'user_id', 'item_primary_id', 'item_secondary_id', 'value', 'audit', 'updated', 'answer_id', 'permanent', 'info_id']
-                    )
+            delete_by_ids(cursor, 'proso_models_variable', to_delete)
+            if clean:
+                cursor.execute('DELETE FROM proso_models_variable WHERE key IN (' + ','.join(['%s' for k in self.DROP_KEYS]) + ') AND info_id = %s', self.DROP_KEYS + [self._info_id])
+            copy_rows(cursor, audit_table, self.AUDIT_COLUMNS, audit)
+            copy_rows(cursor, variable_table, self.VARIABLE_COLUMNS, (
+                (key, u, i_p, i_s, v, False, t, a, p, self._info_id)
+                for (key, u, i_p, i_s, p, t, a, v) in values
+            ))
+        close_audit_intervals(self._info_id)
+
+    def _close_spilled_audit(self):
+        if self._file_audit is None:
+            return None
+        self._file_audit.close()
+        self._file_audit = None
+        return self._filename_audit
+
+    def _clear_spilled_audit(self, spilled):
+        if spilled is not None:
+            open(spilled, 'w').close()
+
+    def _audit_rows(self, spilled, exported):
+        if spilled is not None:
+            with open(spilled, 'r') as file_audit:
+                for line in file_audit:
+                    yield [None if value == 'None' else value for value in line.rstrip('\n').split(',')]
+        for (key, u, i_p, i_s, t, a, v) in exported:
+            if key not in self.DROP_KEYS:
+                yield (key, u, i_p, i_s, t.strftime('%Y-%m-%d %H:%M:%S'), a, v, self._info_id)
+
+    def _spill_audit(self, key, user, item_primary, item_secondary, time, answer, value):
+        if self._file_audit is None:
+            self._file_audit = open(self._filename_audit, 'w')
+        self._write_audit(self._file_audit, key, user, item_primary, item_secondary, time, answer, value)
+
+    def _write_audit(self, file_audit, key, user, item_primary, item_secondary, time, answer, value):
+        if key in self.DROP_KEYS:
+            return
+        file_audit.write('%s,%s,%s,%s,%s,%s,%s,%s\n' % (
+            key, user, item_primary, item_secondary, time.strftime('%Y-%m-%d %H:%M:%S'), answer, value, self._info_id))
 
     def _get_prefetched(self, key, user, item, item_secondary, symmetric):
         return self._prefetched.get(self._prefetched_key(key, user, item, item_secondary, symmetric))
@@ -142,15 +422,37 @@ class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
         return (key, user, items[1], items[0])
 
 
+class InMemoryDatabaseFlushEnvironment(DatabaseFlushMixin, InMemoryEnvironment):
+    pass
+
+
+class CompactInMemoryDatabaseFlushEnvironment(DatabaseFlushMixin, CompactInMemoryEnvironment):
+
+    """
+    The same as :py:class:`InMemoryDatabaseFlushEnvironment`, but the data are
+    stored by :py:class:`proso.models.environment.CompactInMemoryEnvironment`
+    which needs significantly less memory. It can be used by 'recompute_model'
+    command via 'proso_models.recompute_environment' config.
+    """
+    pass
+
+
+@instrument_methods('environment')
 class DatabaseEnvironment(CommonEnvironment):
 
+    RELATION_KEYS = ['parent', 'child']
+
     def __init__(self, info_id=None):
         self._time = None
         self._before_answer = None
         self._avoid_audit = False
+        self._answer_counters = True
         self._info_id = info_id
 
     def process_answer(self, user, item, asked, answered, time, answer_id, response_time, guess, **kwargs):
+        if answer_id is not None:
+            # the answer is already saved
+            return
         answer = Answer(
             user_id=user,
             item_id=item,
@@ -174,6 +476,9 @@ class DatabaseEnvironment(CommonEnvironment):
             return result
 
     def get_items_with_values(self, key, item, user=None):
+        snapshot = self._item_relation_snapshot(key, user)
+        if snapshot is not None:
+            return list(snapshot.get(item, []))
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where_single(
                 key, user, item, None, force_null=False, symmetric=False, time_shift=False)
@@ -188,8 +493,38 @@ class DatabaseEnvironment(CommonEnvironment):
                 ''' + where, where_params)
             return cursor.fetchall()
 
+    def get_all_items_with_values(self, key, user=None):
+        with closing(connection.cursor()) as cursor:
+            where, where_params = self._where({
+                'key': key,
+                'user_id': user,
+            }, force_null=['user_id'], time_shift=False)
+            cursor.execute(
+                '''
+                SELECT
+                    item_primary_id,
+                    item_secondary_id,
+                    value
+                FROM
+                    proso_models_variable
+                WHERE
+                ''' + where, where_params)
+            result = defaultdict(list)
+            for p_id, s_id, val in cursor:
+                result[p_id].append((s_id, val))
+            return dict(result)
+
+    def items_with_values_version(self, key):
+        if key not in self.RELATION_KEYS or has_uncommitted_item_relations():
+            return None
+        version = get_item_relation_version()
+        return None if version is None else ('item_relation', key, version)
+
     @cache_environment_for_item()
     def get_items_with_values_more_items(self, key, items, user=None):
+        snapshot = self._item_relation_snapshot(key, user)
+        if snapshot is not None:
+            return [list(snapshot.get(i, [])) for i in items]
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where_more_items(
                 key, items, user, None, force_null=['user_id'], symmetric=False, time_shift=False)
@@ -208,6 +543,43 @@ class DatabaseEnvironment(CommonEnvironment):
                 result[p_id].append((s_id, val))
             return [result[i] for i in items]
 
+    def _item_relation_snapshot(self, key, user):
+        """
+        Returns all the values of the given item relation (item -> list of
+        (item secondary, value)) loaded at most once per version of the
+        item relations in each process, or None if the snapshot can not be
+        used. The snapshot can be also shared by processes via cache (see
+        'proso_models.item_relation_snapshot.shared_cache' config). Without
+        the shared version (see
+        :py:func:`proso_models.models.get_item_relation_version`) the
+        snapshot is kept only for the current request.
+        """
+        if key not in self.RELATION_KEYS or user is not None or has_uncommitted_item_relations():
+            return None
+        version = get_item_relation_version()
+        if version is None:
+            return None
+        if is_item_relation_version_shared():
+            snapshots = _item_relation_snapshots
+            shared = get_config('proso_models', 'item_relation_snapshot.shared_cache', default=False)
+        else:
+            snapshots = get_from_request_permenent_cache(ITEM_RELATION_SNAPSHOTS_CACHE_KEY)
+            if snapshots is None:
+                snapshots = {}
+                set_to_request_permanent_cache(ITEM_RELATION_SNAPSHOTS_CACHE_KEY, snapshots)
+            shared = False
+        cached = snapshots.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        cache_key = 'proso_models_item_relation_snapshot_{}_{}'.format(key, version)
+        snapshot = cache.get(cache_key) if shared else None
+        if snapshot is None:
+            snapshot = self.get_all_items_with_values(key)
+            if shared:
+                cache.set(cache_key, snapshot, ITEM_RELATION_SNAPSHOT_EXPIRATION)
+        snapshots[key] = (version, snapshot)
+        return snapshot
+
     def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where_single(key, user, item, item_secondary, symmetric=symmetric)
@@ -217,6 +589,13 @@ class DatabaseEnvironment(CommonEnvironment):
                     where_params)
                 fetched = cursor.fetchone()
                 return default if fetched is None else fetched[0]
+            elif self._before_answer is None:
+                valid_where, valid_params = self._where_valid()
+                cursor.execute(
+                    'SELECT value FROM proso_models_audit WHERE ' + where + ' AND ' + valid_where,
+                    where_params + valid_params)
+                fetched = cursor.fetchone()
+                return default if fetched is None else fetched[0]
             else:
                 audit = self.audit(key, user, item, item_secondary, limit=1)
                 if len(audit) == 0:
@@ -234,6 +613,13 @@ class DatabaseEnvironment(CommonEnvironment):
                     + where,
                     where_params)
                 result = cursor.fetchall()
+            elif self._before_answer is None:
+                valid_where, valid_params = self._where_valid()
+                cursor.execute(
+                    'SELECT item_primary_id, item_secondary_id, value FROM proso_models_audit WHERE '
+                    + where + ' AND ' + valid_where,
+                    where_params + valid_params)
+                result = cursor.fetchall()
             else:
                 cursor.execute(
                     '''SELECT DISTINCT ON
@@ -259,6 +645,13 @@ class DatabaseEnvironment(CommonEnvironment):
                     where_params)
                 fetched = cursor.fetchone()
                 return None if fetched is None else self._ensure_is_datetime(fetched[0])
+            elif self._before_answer is None:
+                valid_where, valid_params = self._where_valid()
+                cursor.execute(
+                    'SELECT time FROM proso_models_audit WHERE ' + where + ' AND ' + valid_where,
+                    where_params + valid_params)
+                fetched = cursor.fetchone()
+                return None if fetched is None else self._ensure_is_datetime(fetched[0])
             else:
                 audit = self.audit(key, user, item, item_secondary, limit=1)
                 if len(audit) == 0:
@@ -275,6 +668,13 @@ class DatabaseEnvironment(CommonEnvironment):
                     + where,
                     where_params)
                 result = cursor.fetchall()
+            elif self._before_answer is None:
+                valid_where, valid_params = self._where_valid()
+                cursor.execute(
+                    'SELECT item_primary_id, item_secondary_id, time FROM proso_models_audit WHERE '
+                    + where + ' AND ' + valid_where,
+                    where_params + valid_params)
+                result = cursor.fetchall()
             else:
                 cursor.execute(
                     '''SELECT DISTINCT ON
@@ -291,6 +691,76 @@ class DatabaseEnvironment(CommonEnvironment):
             result = dict(result)
             return [result.get(k) for k in items]
 
+    def read_many_keys(self, keys_spec, items, user=None):
+        return self.read_many_keys_more_users(keys_spec, items, [user])[0]
+
+    def read_many_keys_more_users(self, keys_spec, items, users):
+        if not self._use_answer_counters():
+            # the values have to be read from audit or from the answers
+            return [CommonEnvironment.read_many_keys(self, keys_spec, items, user=user) for user in users]
+        queries, params, targets = [], [], []
+        for name, spec in sorted(keys_spec.items()):
+            spec_users, spec_items = self._read_many_keys_target(spec, items, users)
+            targets.append((name, spec, spec_items))
+            if spec_items is not None and len(spec_items) == 0:
+                continue
+            query, query_params = self._read_many_keys_query(len(targets) - 1, spec, spec_items, spec_users)
+            queries.append(query)
+            params += query_params
+        fetched = defaultdict(dict)
+        if len(queries) > 0:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(' UNION ALL '.join(queries), params)
+                for position, user, item, value, time in cursor:
+                    fetched[position][user, item] = (value, self._ensure_is_datetime(time))
+        result = [{} for user in users]
+        for position, (name, spec, spec_items) in enumerate(targets):
+            if 'answers' in spec and spec['answers'] != 'last_answer_time':
+                convert, default = (lambda value_time: int(value_time[0])), 0
+            elif 'answers' in spec or spec.get('time', False):
+                convert, default = (lambda value_time: value_time[1]), None
+            else:
+                convert, default = (lambda value_time: value_time[0]), spec.get('default')
+            values = fetched[position]
+            for user, user_result in zip(users, result):
+                spec_user = user if spec.get('user', True) else None
+                if spec_items is None:
+                    found = values.get((spec_user, None))
+                    user_result[name] = default if found is None else convert(found)
+                else:
+                    user_result[name] = [
+                        convert(values[spec_user, i]) if (spec_user, i) in values else default
+                        for i in spec_items
+                    ]
+        return result
+
+    def _read_many_keys_query(self, position, spec, items, users):
+        if users is not None and all([u is None for u in users]):
+            users = None
+        if 'key' in spec:
+            if items is None:
+                where, where_params = self._where_single(spec['key'], users)
+            else:
+                where, where_params = self._where_more_items(spec['key'], items, users)
+            return (
+                'SELECT %d, user_id, item_primary_id, value, updated FROM proso_models_variable WHERE ' % position + where,
+                where_params
+            )
+        # NULLs are casted, because PostgreSQL resolves types of the columns
+        # for each pair of the united queries separately
+        where, where_params = self._where_answer_counters(users, items)
+        if spec['answers'] == 'last_answer_time':
+            columns = 'CAST(NULL AS DOUBLE PRECISION), ' + ('MAX(last_answer_time)' if items is None else 'last_answer_time')
+        else:
+            value = ('SUM({})' if items is None else '{}').format(spec['answers'])
+            columns = 'CAST({} AS DOUBLE PRECISION), CAST(NULL AS TIMESTAMP)'.format(value)
+        item_column = 'CAST(NULL AS INTEGER)' if items is None else 'item_id'
+        return (
+            'SELECT %d, user_id, %s, %s FROM proso_models_answercounter WHERE ' % (position, item_column, columns) + where +
+            (' GROUP BY user_id' if items is None else ''),
+            where_params
+        )
+
     def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
         if permanent:
             audit = False
@@ -308,13 +778,15 @@ class DatabaseEnvironment(CommonEnvironment):
             'key': key,
         }
         if not permanent:
-            data['info_id'] = self._info_id,
+            data['info_id'] = self._info_id
         # HACK: There is a race condition creating more variables, so it is
         #       not possible to get exactly one. I hope this scenario does
         #       not happen very often.
         variables = list(Variable.objects.filter(**data))
         if len(variables) == 0:
-            variable = Variable(**data)
+            # the variable routed to the partition is not returned by the
+            # database, so its identifier is assigned in advance
+            variable = Variable(id=next_variable_id(data.get('info_id')), **data)
         else:
             if len(variables) == 1:
                 variable = variables[0]
@@ -335,6 +807,8 @@ class DatabaseEnvironment(CommonEnvironment):
             variable.info_id = self._info_id
         variable.updated = datetime.now() if time is None else time
         variable.save()
+        if key in self.RELATION_KEYS:
+            bump_item_relation_version()
 
     def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
         if key is None:
@@ -353,12 +827,16 @@ class DatabaseEnvironment(CommonEnvironment):
             if not variable.permanent:
                 raise Exception("Can't delete variable %s which is not permanent." % key)
             variable.delete()
+            if key in self.RELATION_KEYS:
+                bump_item_relation_version()
         except Variable.DoesNotExist:
             pass
 
     def number_of_answers(self, user=None, item=None, context=None):
         if item is not None and context is not None:
             raise Exception('Either item or context has to be unspecified')
+        if self._use_answer_counters(context):
+            return self._answer_counter('number_of_answers', user, item)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': item, 'context_id': context}, False, for_answers=True)
             cursor.execute(
@@ -369,6 +847,8 @@ class DatabaseEnvironment(CommonEnvironment):
     def number_of_correct_answers(self, user=None, item=None, context=None):
         if item is not None and context is not None:
             raise Exception('Either item or context has to be unspecified')
+        if self._use_answer_counters(context):
+            return self._answer_counter('number_of_correct_answers', user, item)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': item, 'context_id': context}, False, for_answers=True)
             cursor.execute(
@@ -379,6 +859,8 @@ class DatabaseEnvironment(CommonEnvironment):
     def number_of_first_answers(self, user=None, item=None, context=None):
         if item is not None and context is not None:
             raise Exception('Either item or context has to be unspecified')
+        if self._use_answer_counters(context):
+            return self._answer_counter('number_of_first_answers', user, item)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': item, 'context_id': context}, False, for_answers=True)
             cursor.execute(
@@ -389,6 +871,8 @@ class DatabaseEnvironment(CommonEnvironment):
     def last_answer_time(self, user=None, item=None, context=None):
         if item is not None and context is not None:
             raise Exception('Either item or context has to be unspecified')
+        if self._use_answer_counters(context):
+            return self._answer_counter('last_answer_time', user, item)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': item, 'context_id': context}, False, for_answers=True)
             cursor.execute(
@@ -398,6 +882,8 @@ class DatabaseEnvironment(CommonEnvironment):
 
     @cache_environment_for_item(default=0)
     def number_of_answers_more_items(self, items, user=None):
+        if self._use_answer_counters():
+            return self._answer_counter_more_items('number_of_answers', items, user, default=0)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': items}, False, for_answers=True)
             cursor.execute(
@@ -409,6 +895,8 @@ class DatabaseEnvironment(CommonEnvironment):
 
     @cache_environment_for_item(default=0)
     def number_of_correct_answers_more_items(self, items, user=None):
+        if self._use_answer_counters():
+            return self._answer_counter_more_items('number_of_correct_answers', items, user, default=0)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': items}, False, for_answers=True)
             cursor.execute(
@@ -420,6 +908,8 @@ class DatabaseEnvironment(CommonEnvironment):
 
     @cache_environment_for_item(default=0)
     def number_of_first_answers_more_items(self, items, user=None):
+        if self._use_answer_counters():
+            return self._answer_counter_more_items('number_of_first_answers', items, user, default=0)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': items}, False, for_answers=True)
             cursor.execute(
@@ -432,6 +922,8 @@ class DatabaseEnvironment(CommonEnvironment):
 
     @cache_environment_for_item()
     def last_answer_time_more_items(self, items, user=None):
+        if self._use_answer_counters():
+            return self._answer_counter_more_items('last_answer_time', items, user, default=None)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': items}, False, for_answers=True)
             cursor.execute(
@@ -451,7 +943,20 @@ class DatabaseEnvironment(CommonEnvironment):
     def avoid_audit(self, avoid_audit):
         self._avoid_audit = avoid_audit
 
+    def use_answer_counters(self, use_answer_counters):
+        self._answer_counters = use_answer_counters
+
     def rolling_success(self, user, window_size=10, context=None):
+        if self._use_answer_counters() and window_size <= ROLLING_SUCCESS_SIZE and not isinstance(context, list):
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    'SELECT bits, size FROM proso_models_rollingsuccess WHERE user_id = %s AND ' +
+                    ('context_id IS NULL' if context is None else 'context_id = %s'),
+                    [user] if context is None else [user, context])
+                fetched = cursor.fetchone()
+            if fetched is None or fetched[1] < window_size:
+                return None
+            return bin(fetched[0] & ((1 << window_size) - 1)).count('1') / float(window_size)
         where, where_params = self._where({'user_id': user, 'context_id': context}, False, for_answers=True)
         with closing(connection.cursor()) as cursor:
             cursor.execute(
@@ -474,51 +979,28 @@ class DatabaseEnvironment(CommonEnvironment):
         return self.confusing_factor_more_items(item, [item_secondary], user=user)[0]
 
     def confusing_factor_more_items(self, item, items, user=None):
-        cached_all = {}
-        confusing_factor_cache = cache.get('database_environment__confusing_factor', {})
-        for item_secondary in items:
-            _items = self._sorted([item, item_secondary])
-            cache_key = '{}_{}_{}'.format(_items[0], _items[1], user)
-            cached_item = confusing_factor_cache.get(cache_key)
-            if cached_item:
-                cached_all[item_secondary] = int(cached_item)
-        to_find = [i for i in items if i not in list(cached_all.keys())]
-        if len(cached_all) != 0:
-            LOGGER.debug('cache hit for confusing factor, item {}, {} other items and user {}'.format(item, len(cached_all), user))
-        if len(to_find) != 0:
-            LOGGER.debug('cache miss for confusing factor, item {}, {} other items and user {}'.format(item, len(to_find), user))
-            where, where_params = self._where({
-                'item_answered_id': to_find,
-                'item_asked_id': to_find,
-            }, force_null=False, for_answers=True, conjuction=False)
-            user_where, user_params = self._column_comparison('user_id', user, force_null=False)
-            with closing(connection.cursor()) as cursor:
-                cursor.execute(
-                    '''
-                    SELECT
-                        item_asked_id,
-                        item_answered_id,
-                        COUNT(id) AS confusing_factor
-                    FROM
-                        proso_models_answer
-                    WHERE guess = 0 AND (item_asked_id = %s OR item_asked_id = %s) AND
-                    ''' + user_where + ' AND (' + where + ') GROUP BY item_asked_id, item_answered_id', [item, item] + user_params + where_params)
-                found = {}
-                for item_asked, item_answered, count in cursor:
-                    if item_asked == item:
-                        found[item_answered] = found.get(item_answered, 0) + count
-                    else:
-                        found[item_asked] = found.get(item_asked, 0) + count
-                for i in to_find:
-                    found[i] = found.get(i, 0)
-                cache_expiration = get_config('proso_models', 'confusing_factor.cache_expiration', default=24 * 60 * 60)
-                for item_secondary, count in found.items():
-                    _items = self._sorted([item, item_secondary])
-                    cache_key = '{}_{}_{}'.format(_items[0], _items[1], user)
-                    confusing_factor_cache[cache_key] = count
-                    cached_all[item_secondary] = count
-                cache.set('database_environment__confusing_factor', confusing_factor_cache, cache_expiration)
-        return [cached_all[i] for i in items]
+        if len(items) == 0:
+            return []
+        user_where, user_params = self._column_comparison('user_id', user, force_null=True)
+        primary_where, primary_params = self._column_comparison('item_primary_id', items)
+        secondary_where, secondary_params = self._column_comparison('item_secondary_id', items)
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT
+                    item_primary_id,
+                    item_secondary_id,
+                    value
+                FROM
+                    proso_models_confusionpair
+                WHERE
+                ''' + user_where +
+                ' AND ((item_primary_id = %s AND ' + secondary_where + ') OR (item_secondary_id = %s AND ' + primary_where + '))',
+                user_params + [item] + secondary_params + [item] + primary_params)
+            found = {}
+            for item_primary, item_secondary, value in cursor:
+                found[item_secondary if item_primary == item else item_primary] = value
+            return [found.get(i, 0) for i in items]
 
     def export_values():
         pass
@@ -526,6 +1008,51 @@ class DatabaseEnvironment(CommonEnvironment):
     def export_audit():
         pass
 
+    def _use_answer_counters(self, context=None):
+        # The counters contain all the saved answers except the one being
+        # processed by the predictive model (they are updated after the
+        # model), so they can be used unless the environment is shifted to
+        # the past.
+        return (
+            self._answer_counters and context is None and self._time is None and
+            (self._before_answer is None or self._avoid_audit)
+        )
+
+    def _answer_counter(self, column, user=None, item=None):
+        with closing(connection.cursor()) as cursor:
+            where, where_params = self._where_answer_counters(user, item)
+            if column == 'last_answer_time':
+                cursor.execute('SELECT MAX(last_answer_time) FROM proso_models_answercounter WHERE ' + where, where_params)
+                return self._ensure_is_datetime(cursor.fetchone()[0])
+            cursor.execute('SELECT SUM({}) FROM proso_models_answercounter WHERE '.format(column) + where, where_params)
+            fetched = cursor.fetchone()[0]
+            return 0 if fetched is None else int(fetched)
+
+    def _answer_counter_more_items(self, column, items, user=None, default=None):
+        with closing(connection.cursor()) as cursor:
+            where, where_params = self._where_answer_counters(user, items)
+            cursor.execute(
+                'SELECT item_id, {} FROM proso_models_answercounter WHERE '.format(column) + where,
+                where_params)
+            if column == 'last_answer_time':
+                fetched = {i: self._ensure_is_datetime(t) for i, t in cursor.fetchall()}
+            else:
+                fetched = dict(cursor.fetchall())
+            return [fetched.get(i, default) for i in items]
+
+    def _where_answer_counters(self, user, item):
+        # rows without user contain counters of the item over all users and
+        # the statistics of the user are summed over the items
+        conds, params = list(zip(
+            self._column_comparison('user_id', user, force_null=True),
+            self._column_comparison('item_id', item, force_null=False)))
+        return ' AND '.join(conds), [p for ps in params for p in ps]
+
+    def _where_valid(self):
+        # the audit record valid in the shifted time (see Audit.valid_to), the
+        # records created later are filtered by the time shift in _where
+        return '(valid_to IS NULL OR valid_to >= %s)', [self._time.strftime('%Y-%m-%d %H:%M:%S')]
+
     def _where_single(self, key, user=None, item=None, item_secondary=None, force_null=True, symmetric=True, time_shift=True, for_answers=False):
         if key is None:
             raise Exception('Key has to be specified')
@@ -622,16 +1149,510 @@ class DatabaseEnvironment(CommonEnvironment):
             return DATABASE_TRUE, []
 
     def _ensure_is_datetime(self, value):
-        if value is None:
-            return None
-        if isinstance(value, datetime):
-            return value.replace(tzinfo=None)
-        else:
-            matched = re.match(r'([\d -\:]*)\.\d+', value)
-            if matched is not None:
-                value = matched.groups()[0]
-            return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+        return ensure_is_datetime(value)
 
     def _sorted(self, xs):
         inter = sorted([x for x in xs if x is not None])
         return [None] * (len(xs) - len(inter)) + inter
+
+
+@instrument_methods('environment')
+class BufferedDatabaseEnvironment(DatabaseEnvironment):
+    """
+    Database environment collecting the written variables in a buffer of the
+    instance. The buffer is written by :py:meth:`flush` (one bulk upsert into
+    proso_models_variable and one multi-row insert into proso_models_audit),
+    which has to be called within the transaction the values belong to, e.g.
+    the transaction saving the answer. The buffered values are visible to the
+    reads in the meantime. The item relations ('parent', 'child') are written
+    directly.
+    """
+
+    FLUSH_CHUNK_SIZE = 90
+
+    def __init__(self, info_id=None):
+        DatabaseEnvironment.__init__(self, info_id=info_id)
+        # (info, key, user, item primary, item secondary) -> list of written records
+        self._write_buffer = OrderedDict()
+
+    def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
+        if key in self.RELATION_KEYS:
+            return DatabaseEnvironment.write(
+                self, key, value, user=user, item=item, item_secondary=item_secondary, time=time,
+                audit=audit, symmetric=symmetric, permanent=permanent, answer=answer)
+        if permanent:
+            audit = False
+        if key is None:
+            raise Exception('Key has to be specified')
+        if value is None:
+            raise Exception('Value has to be specified')
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items = self._sorted(items)
+        variable_key = (None if permanent else self._info_id, key, user, items[1], items[0])
+        record = (value, datetime.now() if time is None else time, answer, audit, permanent)
+        self._write_buffer.setdefault(variable_key, []).append(record)
+
+    def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        self.flush()
+        DatabaseEnvironment.delete(self, key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
+
+    def audit(self, key, user=None, item=None, item_secondary=None, limit=100000, symmetric=True):
+        self.flush()
+        return DatabaseEnvironment.audit(
+            self, key, user=user, item=item, item_secondary=item_secondary, limit=limit, symmetric=symmetric)
+
+    def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
+        self._flush_if_time_shifted()
+        record = self._buffered(key, user, item, item_secondary, symmetric)
+        if record is not None:
+            return record[0]
+        return DatabaseEnvironment.read(
+            self, key, user=user, item=item, item_secondary=item_secondary, default=default, symmetric=symmetric)
+
+    def read_more_items(self, key, items, user=None, item=None, default=None, symmetric=True):
+        self._flush_if_time_shifted()
+        result = DatabaseEnvironment.read_more_items(
+            self, key, items, user=user, item=item, default=default, symmetric=symmetric)
+        return self._overlay_buffered(result, 0, key, items, user, item, symmetric)
+
+    def time(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        self._flush_if_time_shifted()
+        record = self._buffered(key, user, item, item_secondary, symmetric)
+        if record is not None:
+            return record[1]
+        return DatabaseEnvironment.time(
+            self, key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
+
+    def time_more_items(self, key, items, user=None, item=None, symmetric=True):
+        self._flush_if_time_shifted()
+        result = DatabaseEnvironment.time_more_items(self, key, items, user=user, item=item, symmetric=symmetric)
+        return self._overlay_buffered(result, 1, key, items, user, item, symmetric)
+
+    def read_many_keys_more_users(self, keys_spec, items, users):
+        self._flush_if_time_shifted()
+        result = DatabaseEnvironment.read_many_keys_more_users(self, keys_spec, items, users)
+        for user, user_result in zip(users, result):
+            for name, spec in keys_spec.items():
+                if 'key' not in spec:
+                    continue
+                spec_user, spec_items = self._read_many_keys_target(spec, items, user)
+                field = 1 if spec.get('time', False) else 0
+                if spec_items is None:
+                    record = self._buffered(spec['key'], spec_user, None, None, True)
+                    if record is not None:
+                        user_result[name] = record[field]
+                else:
+                    user_result[name] = self._overlay_buffered(user_result[name], field, spec['key'], spec_items, spec_user, None, True)
+        return result
+
+    def flush(self):
+        if len(self._write_buffer) == 0:
+            return
+        buffer = self._write_buffer
+        self._write_buffer = OrderedDict()
+        stored = self._load_variables(list(buffer.keys()))
+        rows = []
+        audits = []
+        for variable_key, records in buffer.items():
+            info_id, key, user, item_primary, item_secondary = variable_key
+            value, stored_permanent = stored.get(variable_key, (None, None))
+            last_record = None
+            for record in records:
+                if stored_permanent is not None and stored_permanent != record[4]:
+                    raise Exception("Variable %s changed permanency." % key)
+                if record[0] == value:
+                    continue
+                value = record[0]
+                last_record = record
+                if record[3]:
+                    audits.append(Audit(
+                        user_id=user,
+                        item_primary_id=item_primary,
+                        item_secondary_id=item_secondary,
+                        key=key,
+                        value=record[0],
+                        time=record[1],
+                        info_id=info_id,
+                        answer_id=record[2]))
+            if last_record is not None:
+                new_value, time, answer, audit, permanent = last_record
+                rows.append([key, info_id, user, item_primary, item_secondary, new_value, audit, permanent, answer, time])
+        # the partition has its own unique index used by 'ON CONFLICT'
+        tables = {info_id: partition_table('proso_models_variable', info_id) for info_id in set([row[1] for row in rows])}
+        rows.sort(key=lambda row: tables[row[1]])
+        with closing(connection.cursor()) as cursor:
+            for table_name, table_rows in groupby(rows, key=lambda row: tables[row[1]]):
+                self._upsert_variables(cursor, table_name, list(table_rows))
+        save_audits(audits, stored_variables={
+            (key, user, item_primary, item_secondary, info_id)
+            for (info_id, key, user, item_primary, item_secondary) in stored.keys()
+        })
+
+    def _upsert_variables(self, cursor, table_name, rows):
+        for i in range(0, len(rows), self.FLUSH_CHUNK_SIZE):
+            chunk = rows[i:i + self.FLUSH_CHUNK_SIZE]
+            cursor.execute(
+                '''
+                INSERT INTO ''' + table_name + '''
+                    (key, info_id, user_id, item_primary_id, item_secondary_id, value, audit, permanent, answer_id, updated)
+                VALUES
+                ''' + ','.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)' for row in chunk]) +
+                '''
+                ON CONFLICT
+                    (key, (COALESCE(info_id, -1)), (COALESCE(user_id, -1)), (COALESCE(item_primary_id, -1)), (COALESCE(item_secondary_id, -1)))
+                DO UPDATE SET
+                    value = EXCLUDED.value,
+                    audit = EXCLUDED.audit,
+                    permanent = EXCLUDED.permanent,
+                    answer_id = EXCLUDED.answer_id,
+                    updated = EXCLUDED.updated
+                ''', [x for row in chunk for x in row])
+
+    def _load_variables(self, variable_keys):
+        result = {}
+        with closing(connection.cursor()) as cursor:
+            for i in range(0, len(variable_keys), self.FLUSH_CHUNK_SIZE):
+                conditions = []
+                params = []
+                for variable_key in variable_keys[i:i + self.FLUSH_CHUNK_SIZE]:
+                    columns = zip(['info_id', 'key', 'user_id', 'item_primary_id', 'item_secondary_id'], variable_key)
+                    conds, conds_params = list(zip(*[self._column_comparison(c, v) for c, v in columns]))
+                    conditions.append('(' + ' AND '.join(conds) + ')')
+                    params += [p for ps in conds_params for p in ps]
+                cursor.execute(
+                    '''
+                    SELECT
+                        info_id, key, user_id, item_primary_id, item_secondary_id, value, permanent
+                    FROM proso_models_variable
+                    WHERE
+                    ''' + ' OR '.join(conditions), params)
+                for row in cursor:
+                    result[tuple(row[:5])] = (row[5], bool(row[6]))
+        return result
+
+    def _flush_if_time_shifted(self):
+        # the values are read from audit
+        if self._time is not None:
+            self.flush()
+
+    def _buffer(self):
+        return self._write_buffer if len(self._write_buffer) > 0 else None
+
+    def _buffered(self, key, user, item, item_secondary, symmetric):
+        buffer = self._buffer()
+        if buffer is None:
+            return None
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items = self._sorted(items)
+        for info_id in [self._info_id, None]:
+            records = buffer.get((info_id, key, user, items[1], items[0]))
+            if records is not None:
+                return records[-1]
+        return None
+
+    def _overlay_buffered(self, values, field, key, items, user, item, symmetric):
+        if self._buffer() is None:
+            return values
+        records = [self._buffered(key, user, i, item, symmetric) for i in items]
+        return [value if record is None else record[field] for value, record in zip(values, records)]
+
+
+@instrument_methods('environment')
+class BatchDatabaseEnvironment(InMemoryEnvironment):
+
+    """
+    Environment used to update the model after more answers at once (see
+    :py:meth:`proso.models.prediction.PredictiveModel.predict_and_update_many`).
+    The variables and the answer counters for the given users and items are
+    prefetched by a few queries, the answers are processed in memory and the
+    changed variables are written to the database by :py:meth:`flush`.
+    Everything what is not prefetched is read from the database.
+    """
+
+    DROP_KEYS = InMemoryDatabaseFlushEnvironment.DROP_KEYS
+
+    def __init__(self, info_id=None):
+        InMemoryEnvironment.__init__(self)
+        self._info_id = info_id
+        self._database = DatabaseEnvironment(info_id)
+        self._database.avoid_audit(True)
+        # the counters do not contain the answers processed by this environment
+        self._database.use_answer_counters(False)
+        self._prefetched = {}
+        self._users = set()
+        self._items = set()
+        self._counted_items = set()
+
+    def prefetch(self, users, items, before_answer):
+        """
+        Loads the variables and the answer counters for the given users and
+        items (and their ancestors).
+
+        Args:
+            users (list): identifiers of users
+            items (list): identifiers of items
+            before_answer (int): identifier of the first processed answer
+        """
+        if len(users) == 0 or len(items) == 0:
+            return
+        self._database.shift_answers(before_answer)
+        all_items = set(items)
+        to_find = list(items)
+        while len(to_find) > 0:
+            found = self._database.get_items_with_values_more_items('parent', to_find)
+            to_find = list({parent for parents in found for (parent, weight) in parents} - all_items)
+            all_items |= set(to_find)
+        self._users = set(users)
+        self._items = all_items
+        self._counted_items = set(items)
+        users_in = ','.join(map(str, sorted(self._users)))
+        items_in = ','.join(map(str, sorted(self._items)))
+        counted_items_in = ','.join(map(str, sorted(self._counted_items)))
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT key, user_id, item_primary_id, item_secondary_id, updated, value, id
+                FROM proso_models_variable
+                WHERE
+                    (user_id IS NULL OR user_id IN (''' + users_in + '''))
+                AND
+                    (
+                        item_primary_id IS NULL
+                        OR
+                        item_primary_id IN (''' + items_in + ''')
+                        OR
+                        item_secondary_id IN (''' + items_in + ''')
+                    )
+                ''' + ('' if self._info_id is None else 'AND (info_id = %s OR info_id IS NULL)'),
+                [] if self._info_id is None else [self._info_id])
+            for row in cursor:
+                if row[0] in self.DROP_KEYS:
+                    # counters are computed from answers
+                    continue
+                self._prefetched[row[0], row[1], row[2], row[3]] = (self._database._ensure_is_datetime(row[4]), row[5], row[6])
+            correct = 'SUM(CASE WHEN item_asked_id = item_answered_id THEN 1 ELSE 0 END)'
+            cursor.execute(
+                'SELECT user_id, item_id, COUNT(id), ' + correct + ', MAX(time) FROM proso_models_answer '
+                'WHERE id < %s AND user_id IN (' + users_in + ') AND item_id IN (' + counted_items_in + ') '
+                'GROUP BY user_id, item_id', [before_answer])
+            for user, item, answers, correct_answers, time in cursor.fetchall():
+                self._write_counters(user, item, answers, correct_answers, 1, time)
+            cursor.execute(
+                'SELECT user_id, COUNT(id), ' + correct + ', COUNT(DISTINCT item_id), MAX(time) FROM proso_models_answer '
+                'WHERE id < %s AND user_id IN (' + users_in + ') GROUP BY user_id', [before_answer])
+            for user, answers, correct_answers, first_answers, time in cursor.fetchall():
+                self._write_counters(user, None, answers, correct_answers, first_answers, time)
+            cursor.execute(
+                'SELECT item_id, COUNT(id), ' + correct + ', COUNT(DISTINCT user_id), MAX(time) FROM proso_models_answer '
+                'WHERE id < %s AND item_id IN (' + counted_items_in + ') GROUP BY item_id', [before_answer])
+            for item, answers, correct_answers, first_answers, time in cursor.fetchall():
+                self._write_counters(None, item, answers, correct_answers, first_answers, time)
+
+    def process_answer(self, user, item, asked, answered, time, answer, response_time, guess, **kwargs):
+        if not self._is_counted(user, item):
+            raise Exception('The answer of user {} for item {} has not been prefetched.'.format(user, item))
+        if time is None:
+            time = datetime.now()
+        first_answer = self.number_of_answers(user=user, item=item) == 0
+        for u, i in [(user, None), (None, item), (user, item)]:
+            if first_answer:
+                self._increment(self.NUMBER_OF_FIRST_ANSWERS, u, i, time, answer)
+            self._increment(self.NUMBER_OF_ANSWERS, u, i, time, answer)
+            if asked == answered:
+                self._increment(self.NUMBER_OF_CORRECT_ANSWERS, u, i, time, answer)
+        if answer is not None:
+            self._database.shift_answers(answer + 1)
+
+    def audit(self, key, user=None, item=None, item_secondary=None, limit=100000, symmetric=True):
+        return self._database.audit(key, user=user, item=item, item_secondary=item_secondary, limit=limit, symmetric=symmetric)
+
+    def get_items_with_values(self, key, item, user=None):
+        return self._database.get_items_with_values(key, item, user=user)
+
+    def get_items_with_values_more_items(self, key, items, user=None):
+        return self._database.get_items_with_values_more_items(key, items, user=user)
+
+    def get_all_items_with_values(self, key, user=None):
+        return self._database.get_all_items_with_values(key, user=user)
+
+    def items_with_values_version(self, key):
+        return self._database.items_with_values_version(key)
+
+    def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
+        prefetched, found = self._find(key, user, item, item_secondary, symmetric)
+        if not prefetched:
+            return self._database.read(key, user=user, item=item, item_secondary=item_secondary, default=default, symmetric=symmetric)
+        return default if found is None else found[1]
+
+    def read_more_items(self, key, items, user=None, item=None, default=None, symmetric=True):
+        found = [self._find(key, user, i, item, symmetric) for i in items]
+        missing = [i for i, (prefetched, f) in zip(items, found) if not prefetched]
+        if len(missing) > 0:
+            missing = dict(zip(missing, self._database.read_more_items(
+                key, missing, user=user, item=item, default=default, symmetric=symmetric)))
+        return [
+            (default if f is None else f[1]) if prefetched else missing[i]
+            for i, (prefetched, f) in zip(items, found)
+        ]
+
+    def write(self, key, value, user=None, item=None, item_secondary=None, time=None, audit=True, symmetric=True, permanent=False, answer=None):
+        if key in self.DROP_KEYS:
+            raise Exception('The variable {} is computed from answers and can not be written.'.format(key))
+        InMemoryEnvironment.write(
+            self, key, value, user=user, item=item, item_secondary=item_secondary,
+            time=time, audit=audit, symmetric=symmetric, permanent=permanent, answer=answer)
+
+    def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        raise Exception('Deleting variables is not supported in the batch environment.')
+
+    def time(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        prefetched, found = self._find(key, user, item, item_secondary, symmetric)
+        if not prefetched:
+            return self._database.time(key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
+        return None if found is None else found[0]
+
+    def time_more_items(self, key, items, user=None, item=None, symmetric=True):
+        found = [self._find(key, user, i, item, symmetric) for i in items]
+        missing = [i for i, (prefetched, f) in zip(items, found) if not prefetched]
+        if len(missing) > 0:
+            missing = dict(zip(missing, self._database.time_more_items(
+                key, missing, user=user, item=item, symmetric=symmetric)))
+        return [
+            (None if f is None else f[0]) if prefetched else missing[i]
+            for i, (prefetched, f) in zip(items, found)
+        ]
+
+    def number_of_answers(self, user=None, item=None, context=None):
+        if context is None and self._is_counted(user, item):
+            return InMemoryEnvironment.number_of_answers(self, user=user, item=item)
+        return self._database.number_of_answers(user=user, item=item, context=context)
+
+    def number_of_correct_answers(self, user=None, item=None, context=None):
+        if context is None and self._is_counted(user, item):
+            return InMemoryEnvironment.number_of_correct_answers(self, user=user, item=item)
+        return self._database.number_of_correct_answers(user=user, item=item, context=context)
+
+    def number_of_first_answers(self, user=None, item=None, context=None):
+        if context is None and self._is_counted(user, item):
+            return InMemoryEnvironment.number_of_first_answers(self, user=user, item=item)
+        return self._database.number_of_first_answers(user=user, item=item, context=context)
+
+    def last_answer_time(self, user=None, item=None, context=None):
+        if context is None and self._is_counted(user, item):
+            return InMemoryEnvironment.last_answer_time(self, user=user, item=item)
+        return self._database.last_answer_time(user=user, item=item, context=context)
+
+    def number_of_answers_more_items(self, items, user=None):
+        if all([self._is_counted(user, i) for i in items]):
+            return InMemoryEnvironment.number_of_answers_more_items(self, items, user=user)
+        return self._database.number_of_answers_more_items(items, user=user)
+
+    def number_of_correct_answers_more_items(self, items, user=None):
+        if all([self._is_counted(user, i) for i in items]):
+            return InMemoryEnvironment.number_of_correct_answers_more_items(self, items, user=user)
+        return self._database.number_of_correct_answers_more_items(items, user=user)
+
+    def number_of_first_answers_more_items(self, items, user=None):
+        if all([self._is_counted(user, i) for i in items]):
+            return InMemoryEnvironment.number_of_first_answers_more_items(self, items, user=user)
+        return self._database.number_of_first_answers_more_items(items, user=user)
+
+    def last_answer_time_more_items(self, items, user=None):
+        if all([self._is_counted(user, i) for i in items]):
+            return InMemoryEnvironment.last_answer_time_more_items(self, items, user=user)
+        return self._database.last_answer_time_more_items(items, user=user)
+
+    def rolling_success(self, user, window_size=10, context=None):
+        return self._database.rolling_success(user, window_size=window_size, context=context)
+
+    def confusing_factor(self, item, item_secondary, user=None):
+        return self._database.confusing_factor(item, item_secondary, user=user)
+
+    def confusing_factor_more_items(self, item, items, user=None):
+        return self._database.confusing_factor_more_items(item, items, user=user)
+
+    def flush(self):
+        to_delete = []
+        to_delete_not_prefetched = []
+        variables = []
+        for (key, user, item_primary, item_secondary, permanent, time, answer, value) in self.export_values():
+            if key in self.DROP_KEYS:
+                continue
+            prefetched = self._prefetched.get((key, user, item_primary, item_secondary))
+            if prefetched is not None:
+                to_delete.append(prefetched[2])
+            elif not self._is_prefetched(user, item_primary, item_secondary):
+                to_delete_not_prefetched.append((key, user, item_primary, item_secondary, permanent))
+            variables.append(Variable(
+                key=key, user_id=user, item_primary_id=item_primary, item_secondary_id=item_secondary,
+                value=value, audit=not permanent, permanent=permanent, updated=time, answer_id=answer,
+                info_id=None if permanent else self._info_id))
+        audits = []
+        previous = None
+        for (key, user, item_primary, item_secondary, time, answer, value) in self.export_audit():
+            if key in self.DROP_KEYS:
+                continue
+            current = (key, user, item_primary, item_secondary)
+            if previous is None or previous[0] != current:
+                prefetched = self._prefetched.get(current)
+                previous = (current, None if prefetched is None else prefetched[1])
+            if previous[1] == value:
+                # the same as the database environment, unchanged values are not audited
+                continue
+            previous = (current, value)
+            audits.append(Audit(
+                key=key, user_id=user, item_primary_id=item_primary, item_secondary_id=item_secondary,
+                time=time, answer_id=answer, value=value, info_id=self._info_id))
+        with transaction.atomic():
+            if len(to_delete) > 0:
+                with closing(connection.cursor()) as cursor:
+                    delete_by_ids(cursor, 'proso_models_variable', to_delete)
+            for key, user, item_primary, item_secondary, permanent in to_delete_not_prefetched:
+                not_prefetched = Variable.objects.filter(
+                    key=key, user_id=user, item_primary_id=item_primary, item_secondary_id=item_secondary)
+                if not permanent:
+                    not_prefetched = not_prefetched.filter(info_id=self._info_id)
+                not_prefetched.delete()
+            Variable.objects.bulk_create(variables)
+            save_audits(audits)
+        self._prefetched = {}
+        self._data.clear()
+
+    def _find(self, key, user, item, item_secondary, symmetric):
+        found = self._get(key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
+        if found:
+            return True, (found[1], found[3])
+        prefetched_key = self._prefetched_key(key, user, item, item_secondary, symmetric)
+        prefetched = self._prefetched.get(prefetched_key)
+        if prefetched is not None:
+            return True, prefetched
+        return self._is_prefetched(user, prefetched_key[2], prefetched_key[3]), None
+
+    def _is_prefetched(self, user, item_primary, item_secondary):
+        return (user is None or user in self._users) and (
+            item_primary is None or item_primary in self._items or item_secondary in self._items)
+
+    def _is_counted(self, user, item):
+        if user is None and item is None:
+            return False
+        return (user is None or user in self._users) and (item is None or item in self._counted_items)
+
+    def _prefetched_key(self, key, user, item, item_secondary, symmetric):
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items.sort()
+        return (key, user, items[1], items[0])
+
+    def _increment(self, key, user, item, time, answer):
+        value = InMemoryEnvironment.read(self, key, user=user, item=item, default=0)
+        InMemoryEnvironment.write(self, key, value + 1, user=user, item=item, time=time, audit=False, answer=answer)
+
+    def _write_counters(self, user, item, answers, correct_answers, first_answers, time):
+        time = self._database._ensure_is_datetime(time)
+        for key, value in [
+                (self.NUMBER_OF_ANSWERS, answers),
+                (self.NUMBER_OF_CORRECT_ANSWERS, correct_answers),
+                (self.NUMBER_OF_FIRST_ANSWERS, first_answers)]:
+            InMemoryEnvironment.write(self, key, value, user=user, item=item, time=time, audit=False)
@@ -1,9 +1,19 @@
-from .environment import DatabaseEnvironment
-from .models import Item
+from .environment import BufferedDatabaseEnvironment, DatabaseEnvironment, InMemoryDatabaseFlushEnvironment
+from .models import Answer, Audit, EnvironmentInfo, Item, ItemRelation, Variable, defer_predictive_model_update, get_item_relation_version, update_predictive_model
+from datetime import datetime, timedelta
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import reset_queries, transaction
+from proso.django.cache import RequestCacheMiddleware
+from proso_common.models import Config
 import django.test as test
 import proso.models.environment as environment
+from proso.models.prediction import PriorCurrentPredictiveModel
+import os
+import random
+import shutil
+import tempfile
+import unittest.mock as mock
 
 
 class DatabaseEnvironmentTest(test.TestCase, environment.TestCommonEnvironment):
@@ -13,8 +23,20 @@ class DatabaseEnvironmentTest(test.TestCase, environment.TestCommonEnvironment):
     @classmethod
     def setUpClass(cls):
         super(DatabaseEnvironmentTest, cls).setUpClass()
+        cls._debug = settings.DEBUG
         settings.DEBUG = True
 
+    @classmethod
+    def tearDownClass(cls):
+        settings.DEBUG = cls._debug
+        reset_queries()
+        super(DatabaseEnvironmentTest, cls).tearDownClass()
+
+    def setUp(self):
+        # the log of queries is bounded, once it is full, assertNumQueries
+        # does not see any new query
+        reset_queries()
+
     def generate_item(self):
         item = Item()
         item.save()
@@ -31,3 +53,257 @@ class DatabaseEnvironmentTest(test.TestCase, environment.TestCommonEnvironment):
 
     def generate_environment(self):
         return DatabaseEnvironment()
+
+    def test_shift_time(self):
+        env = self.generate_environment()
+        user = self.generate_user()
+        items = [self.generate_item() for i in range(2)]
+        time = datetime(2016, 1, 1, 12)
+        for i in range(5):
+            for j, item in enumerate(items):
+                env.write('skill', 10 * j + i, user=user, item=item, time=time + timedelta(hours=i))
+        env.flush()
+        self.assertEqual(1, Audit.objects.filter(key='skill', item_primary_id=items[0], valid_to__isnull=True).count())
+        env.shift_time(time + timedelta(hours=2, minutes=30))
+        self.assertEqual(2, env.read('skill', user=user, item=items[0]))
+        self.assertEqual([2, 12], env.read_more_items('skill', items, user=user))
+        self.assertEqual(time + timedelta(hours=2), env.time('skill', user=user, item=items[1]))
+        self.assertEqual([time + timedelta(hours=2) for i in items], env.time_more_items('skill', items, user=user))
+        env.shift_time(time)
+        self.assertEqual([None, None], env.read_more_items('skill', items, user=user))
+
+    def test_read_many_keys_in_one_query(self):
+        env = self.generate_environment()
+        user = self.generate_user()
+        items = [self.generate_item() for i in range(3)]
+        with self.assertNumQueries(1):
+            env.read_many_keys({
+                'prior_skill': {'key': 'prior_skill', 'items': False, 'default': 0},
+                'difficulties': {'key': 'difficulty', 'user': False, 'default': 0},
+                'current_skills': {'key': 'current_skill'},
+                'last_times': {'answers': 'last_answer_time'},
+            }, items, user)
+
+    def test_predict_more_users_more_items_in_constant_queries(self):
+        env = self.generate_environment()
+        users = [self.generate_user() for i in range(10)]
+        items = [self.generate_item() for i in range(20)]
+        model = PriorCurrentPredictiveModel()
+        with self.assertNumQueries(1):
+            found = model.predict_more_users_more_items(env, users, items, datetime(2016, 1, 1, 12))
+        self.assertEqual(found, [model.predict_more_items(env, u, items, datetime(2016, 1, 1, 12)) for u in users])
+        with self.assertNumQueries(1):
+            env.number_of_answers_more_users_more_items(items, users)
+
+
+class BufferedDatabaseEnvironmentTest(DatabaseEnvironmentTest):
+
+    def generate_environment(self):
+        return BufferedDatabaseEnvironment()
+
+    def test_flush(self):
+        env = self.generate_environment()
+        user = self.generate_user()
+        items = [self.generate_item() for i in range(10)]
+        with self.assertNumQueries(0):
+            for i, item in enumerate(items):
+                env.write('skill', i, user=user, item=item)
+                env.write('skill', i + 1, user=user, item=item)
+        self.assertEqual(list(range(1, 11)), env.read_more_items('skill', items, user=user))
+        self.assertEqual([None for i in items], DatabaseEnvironment().read_more_items('skill', items, user=user))
+        # the buffer is not shared by other instances
+        self.assertEqual([None for i in items], self.generate_environment().read_more_items('skill', items, user=user))
+        with self.assertNumQueries(3):
+            env.flush()
+        self.assertEqual(list(range(1, 11)), DatabaseEnvironment().read_more_items('skill', items, user=user))
+        self.assertEqual(20, Audit.objects.filter(key='skill').count())
+        env.write('skill', 5, user=user, item=items[0])
+        env.write('skill', 2, user=user, item=items[1])
+        env.flush()
+        self.assertEqual([5, 2], DatabaseEnvironment().read_more_items('skill', items[:2], user=user))
+        self.assertEqual(21, Audit.objects.filter(key='skill').count())
+        self.assertEqual(1, Variable.objects.filter(key='skill', user_id=user, item_primary_id=items[1]).count())
+
+
+class BatchDatabaseEnvironmentTest(test.TestCase):
+
+    def setUp(self):
+        random.seed(42)
+        self._users = [User.objects.create(username=str(i)) for i in range(3)]
+        self._items = [Item.objects.create() for i in range(6)]
+        categories = [Item.objects.create() for i in range(2)]
+        for i, item in enumerate(self._items):
+            ItemRelation.objects.create(parent=categories[i % 2], child=item)
+
+    def test_predict_and_update_many(self):
+        time = datetime(2016, 1, 1, 12)
+        answers = []
+        for i in range(30):
+            item = random.choice(self._items)
+            answers.append(Answer.objects.create(
+                user=random.choice(self._users), item=item, item_asked=item,
+                item_answered=item if random.random() < 0.6 else random.choice(self._items),
+                response_time=1000, time=time + timedelta(minutes=i)))
+        expected_variables = self._load_variables()
+        expected_audit = Audit.objects.count()
+        self.assertTrue(len(expected_variables) > 0)
+        Variable.objects.filter(permanent=False).delete()
+        Audit.objects.all().delete()
+        with defer_predictive_model_update():
+            for answer in answers:
+                update_predictive_model(Answer, answer, created=True)
+            self.assertFalse(Variable.objects.filter(permanent=False).exists())
+        found_variables = self._load_variables()
+        self.assertEqual(sorted(expected_variables.keys()), sorted(found_variables.keys()))
+        for key, value in expected_variables.items():
+            self.assertAlmostEqual(value, found_variables[key], places=10)
+        self.assertEqual(Audit.objects.count(), expected_audit)
+
+    def _load_variables(self):
+        return {
+            (v.key, v.user_id, v.item_primary_id, v.item_secondary_id, v.answer_id): v.value
+            for v in Variable.objects.filter(permanent=False)
+        }
+
+
+class InMemoryDatabaseFlushEnvironmentTest(test.TestCase):
+
+    def setUp(self):
+        self._data_dir = tempfile.mkdtemp()
+        self._settings = self.settings(DATA_DIR=self._data_dir)
+        self._settings.enable()
+
+    def tearDown(self):
+        self._settings.disable()
+        shutil.rmtree(self._data_dir)
+
+    def test_checkpoints(self):
+        user = User.objects.create(username='user').id
+        items = [Item.objects.create().id for i in range(2)]
+        info = EnvironmentInfo.objects.create(config=Config.objects.from_content({}), revision=0)
+        env = InMemoryDatabaseFlushEnvironment(info)
+        env.start_checkpoints()
+        env.write('skill', 1, user=user, item=items[0])
+        env.write('skill', 2, user=user, item=items[0])
+        env.write('difficulty', 1, item=items[1])
+        env.checkpoint()
+        self.assertEqual(2, Audit.objects.filter(key='skill', info=info).count())
+        env.write('skill', 3, user=user, item=items[0])
+        env.checkpoint()
+        env.checkpoint()
+        self.assertEqual([3], [v.value for v in Variable.objects.filter(key='skill', info=info)])
+        self.assertEqual([1], [v.value for v in Variable.objects.filter(key='difficulty', info=info)])
+        self.assertEqual(3, Audit.objects.filter(key='skill', info=info).count())
+        self.assertEqual(3, DatabaseEnvironment(info.id).read('skill', user=user, item=items[0]))
+
+    def test_flush(self):
+        user = User.objects.create(username='user').id
+        items = [Item.objects.create().id for i in range(2)]
+        info = EnvironmentInfo.objects.create(config=Config.objects.from_content({}), revision=0)
+        Variable.objects.create(key='skill', user_id=user, item_primary_id=items[0], value=5, info=info, audit=False)
+        env = InMemoryDatabaseFlushEnvironment(info, audit_retention={'difficulty': environment.InMemoryEnvironment.AUDIT_SPILL})
+        env.prefetch([user], items)
+        env.write('skill', 1, user=user, item=items[0])
+        env.write('skill', 2, user=user, item=items[0])
+        for value in range(3):
+            env.write('difficulty', value, item=items[1])
+        env.process_answer(user, items[0], items[0], items[0], datetime(2016, 1, 1), None, 1000, 0)
+        env.flush(clean=True)
+        self.assertEqual([2], [v.value for v in Variable.objects.filter(key='skill', info=info)])
+        self.assertEqual([2], [v.value for v in Variable.objects.filter(key='difficulty', info=info)])
+        self.assertEqual(2, Audit.objects.filter(key='skill', info=info).count())
+        self.assertEqual(3, Audit.objects.filter(key='difficulty', info=info).count())
+        self.assertFalse(Audit.objects.filter(key=env.NUMBER_OF_ANSWERS, info=info).exists())
+
+    def test_state(self):
+        user = User.objects.create(username='user').id
+        items = [Item.objects.create().id for i in range(2)]
+        info = EnvironmentInfo.objects.create(config=Config.objects.from_content({}), revision=0)
+        Variable.objects.create(key='difficulty', item_primary_id=items[1], value=5, info=info)
+        state = os.path.join(self._data_dir, 'state')
+        env = InMemoryDatabaseFlushEnvironment(info)
+        env.start_checkpoints(state)
+        env.write('skill', 1, user=user, item=items[0])
+        env.checkpoint()
+        env.write('skill', 2, user=user, item=items[0])
+        env.write('difficulty', 3, item=items[1])
+        for correct in [True, False, True]:
+            env.write(env.LAST_CORRECTNESS, correct, user=user)
+        env.save_state(state, last_answer_id=10)
+        env.write('skill', 4, user=user, item=items[0])
+        restored = InMemoryDatabaseFlushEnvironment(info)
+        self.assertEqual(10, restored.load_state(state)['last_answer_id'])
+        self.assertEqual(2, restored.read('skill', user=user, item=items[0]))
+        self.assertEqual(3, restored.read('difficulty', item=items[1]))
+        self.assertAlmostEqual(2 / 3.0, restored.rolling_success(user, window_size=3))
+        restored.checkpoint()
+        self.assertEqual([2], [v.value for v in Variable.objects.filter(key='skill', info=info)])
+        self.assertEqual([3], [v.value for v in Variable.objects.filter(key='difficulty', info=info)])
+        self.assertEqual(2, Audit.objects.filter(key='skill', info=info).count())
+
+
+class ItemRelationSnapshotTest(test.TransactionTestCase):
+
+    def setUp(self):
+        self._cache_dir = tempfile.mkdtemp()
+        self._settings = self.settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': self._cache_dir,
+        }})
+        self._settings.enable()
+
+    def tearDown(self):
+        self._settings.disable()
+        shutil.rmtree(self._cache_dir)
+
+    def test_process_local_cache(self):
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            with mock.patch('proso_models.models.has_request_permanent_cache', return_value=False):
+                self.assertIsNone(get_item_relation_version())
+                self.assertIsNone(DatabaseEnvironment().items_with_values_version('parent'))
+            RequestCacheMiddleware().process_request(None)
+            version = get_item_relation_version()
+            self.assertIsNotNone(version)
+            self.assertEqual(version, get_item_relation_version())
+            RequestCacheMiddleware().process_request(None)
+            self.assertNotEqual(version, get_item_relation_version())
+
+    def test_snapshot(self):
+        items = [Item.objects.create() for i in range(3)]
+        ItemRelation.objects.create(parent=items[0], child=items[1])
+        env = DatabaseEnvironment()
+        self.assertEqual([[(items[0].id, 1)], []], env.get_items_with_values_more_items('parent', [items[1].id, items[2].id]))
+        self.assertEqual([(items[1].id, 1)], env.get_items_with_values('child', items[0].id))
+        with self.assertNumQueries(0):
+            self.assertEqual([[(items[0].id, 1)], []], env.get_items_with_values_more_items('parent', [items[1].id, items[2].id]))
+            self.assertEqual([(items[1].id, 1)], env.get_items_with_values('child', items[0].id))
+        ItemRelation.objects.create(parent=items[0], child=items[2])
+        self.assertEqual([[(items[0].id, 1)], [(items[0].id, 1)]], env.get_items_with_values_more_items('parent', [items[1].id, items[2].id]))
+        try:
+            with transaction.atomic():
+                ItemRelation.objects.filter(child=items[2]).delete()
+                self.assertEqual([], env.get_items_with_values('parent', items[2].id))
+                raise Exception('rollback')
+        except Exception:
+            pass
+        self.assertEqual([(items[0].id, 1)], env.get_items_with_values('parent', items[2].id))
+
+
+class ItemRelationRequestSnapshotTest(test.TransactionTestCase):
+
+    def test_snapshot_without_shared_cache(self):
+        self.assertEqual('django.core.cache.backends.dummy.DummyCache', settings.CACHES['default']['BACKEND'])
+        items = [Item.objects.create() for i in range(3)]
+        ItemRelation.objects.create(parent=items[0], child=items[1])
+        env = DatabaseEnvironment()
+        RequestCacheMiddleware().process_request(None)
+        self.assertEqual([(items[0].id, 1)], env.get_items_with_values('parent', items[1].id))
+        with self.assertNumQueries(0):
+            self.assertEqual([(items[0].id, 1)], env.get_items_with_values('parent', items[1].id))
+            self.assertEqual([[(items[0].id, 1)], []], env.get_items_with_values_more_items('parent', [items[1].id, items[2].id]))
+        ItemRelation.objects.create(parent=items[0], child=items[2])
+        self.assertEqual([[(items[0].id, 1)], [(items[0].id, 1)]], env.get_items_with_values_more_items('parent', [items[1].id, items[2].id]))
+        RequestCacheMiddleware().process_request(None)
+        with self.assertNumQueries(1):
+            self.assertEqual([(items[0].id, 1)], env.get_items_with_values('parent', items[2].id))
+            self.assertEqual([(items[0].id, 1)], env.get_items_with_values('parent', items[1].id))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from optparse import make_option
+from proso.util import timer
+from proso_models.models import EnvironmentInfo, close_audit_intervals
+
+
+class Command(BaseCommand):
+
+    help = '''
+    Close the validity intervals (Audit.valid_to) of the audit records which
+    are followed by other records, e.g., after the migration introducing them.
+    Each environment info is processed in its own transaction.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--info',
+            dest='info',
+            type=int,
+            default=None,
+            help='identifier of the environment info, all of them are processed by default'),
+    )
+
+    def handle(self, *args, **options):
+        infos = EnvironmentInfo.objects.order_by('id')
+        if options['info'] is not None:
+            infos = infos.filter(id=options['info'])
+        for info_id in infos.values_list('id', flat=True):
+            timer('close_audit_intervals')
+            with transaction.atomic():
+                close_audit_intervals(info_id)
+            print(' -- audit intervals of environment info', info_id, 'closed in', timer('close_audit_intervals'), 'seconds')
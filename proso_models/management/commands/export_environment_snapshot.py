@@ -0,0 +1,62 @@
+from contextlib import closing
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from proso.models.environment import save_snapshot
+from proso.util import timer
+from proso_models.environment import ensure_is_datetime
+from proso_models.models import EnvironmentInfo
+
+
+class Command(BaseCommand):
+
+    help = '''
+    Export the current variables of the environment info (the active one by
+    default) together with the permanent variables into a binary snapshot
+    which can be loaded by proso.models.environment.MappedEnvironment.
+
+    Only the variables are exported. The numbers of answers, the confusing
+    factors and the rolling success are stored in dedicated tables
+    (proso_models_answercounter, proso_models_confusionpair and
+    proso_models_rollingsuccess) and they are not part of the snapshot, the
+    mapped environment returns 0 (None for the rolling success) for them.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--info',
+            dest='info',
+            type=int,
+            default=None,
+            help='identifier of the environment info, the active one is used by default'),
+        make_option(
+            '--output',
+            dest='output',
+            type=str,
+            default=None,
+            help='directory to store the snapshot'),
+    )
+
+    def handle(self, *args, **options):
+        if options['output'] is None:
+            raise CommandError('The output directory has to be specified.')
+        try:
+            if options['info'] is None:
+                info = EnvironmentInfo.objects.get(status=EnvironmentInfo.STATUS_ACTIVE)
+            else:
+                info = EnvironmentInfo.objects.get(id=options['info'])
+        except EnvironmentInfo.DoesNotExist:
+            raise CommandError('There is no such environment info.')
+        timer('export_environment_snapshot')
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT key, user_id, item_primary_id, item_secondary_id, permanent, updated, answer_id, value
+                FROM proso_models_variable
+                WHERE info_id = %s OR (info_id IS NULL AND permanent)
+                ''', [info.id])
+            save_snapshot(options['output'], (
+                (key, user, item_primary, item_secondary, permanent, ensure_is_datetime(updated), answer, value)
+                for (key, user, item_primary, item_secondary, permanent, updated, answer, value) in cursor
+            ))
+        print(' -- environment info', info.id, 'exported to', options['output'], 'in', timer('export_environment_snapshot'), 'seconds')
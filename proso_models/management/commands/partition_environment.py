@@ -0,0 +1,95 @@
+from contextlib import closing
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from proso.util import timer
+from proso_models.models import EnvironmentInfo
+from proso_models.partitions import attach_partitions, detach_partitions, is_partitioning_supported, list_partitions
+
+
+class Command(BaseCommand):
+
+    help = '''
+    Attach or detach the partitions of proso_models_variable and
+    proso_models_audit dedicated to the environment info (the active one by
+    default), see proso_models.partitions. Without --attach or --detach the
+    attached partitions are listed. PostgreSQL only.
+
+    Examples:
+        --attach --months 2016-01:2016-12
+        --detach --info 42
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--info',
+            dest='info',
+            type=int,
+            default=None,
+            help='identifier of the environment info, the active one is used by default'),
+        make_option(
+            '--attach',
+            dest='attach',
+            action='store_true',
+            default=False,
+            help='create (or attach the detached) partitions and move the rows there'),
+        make_option(
+            '--detach',
+            dest='detach',
+            action='store_true',
+            default=False,
+            help='detach the partitions, they are renamed to <partition>_detached'),
+        make_option(
+            '--months',
+            dest='months',
+            type=str,
+            default=None,
+            help='range of months (YYYY-MM:YYYY-MM) for which the audit partitions are created'),
+        make_option(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            default=10000,
+            help='width of the id ranges moved by one statement'),
+    )
+
+    def handle(self, *args, **options):
+        if not is_partitioning_supported():
+            print(' -- partitioning is not supported by the database, nothing to do')
+            return
+        if options['attach'] and options['detach']:
+            raise CommandError('Options --attach and --detach can not be combined.')
+        if not options['attach'] and not options['detach']:
+            with closing(connection.cursor()) as cursor:
+                for parent, partition, rows in list_partitions(cursor):
+                    print(' -- partition', partition, 'of', parent, 'with approximately', rows, 'rows')
+            return
+        try:
+            if options['info'] is None:
+                info = EnvironmentInfo.objects.get(status=EnvironmentInfo.STATUS_ACTIVE)
+            else:
+                info = EnvironmentInfo.objects.get(id=options['info'])
+        except EnvironmentInfo.DoesNotExist:
+            raise CommandError('There is no such environment info.')
+        timer('partition_environment')
+        if options['attach']:
+            attach_partitions(info.id, months=self.parse_months(options['months']), chunk_size=options['chunk_size'])
+            print(' -- partitions of environment info', info.id, 'attached in', timer('partition_environment'), 'seconds')
+        else:
+            detach_partitions(info.id)
+            print(' -- partitions of environment info', info.id, 'detached in', timer('partition_environment'), 'seconds')
+
+    def parse_months(self, months):
+        if months is None:
+            return None
+        try:
+            first, last = [date(int(m[:4]), int(m[5:7]), 1) for m in months.split(':')]
+        except ValueError:
+            raise CommandError('The range of months has to be in format YYYY-MM:YYYY-MM.')
+        result = []
+        month = first
+        while month <= last:
+            result.append(month)
+            month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+        return result
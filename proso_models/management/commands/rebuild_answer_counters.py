@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from proso.util import timer
+from proso_models.models import AnswerCounter, ConfusionPair, RollingSuccess, rebuild_answer_counters
+
+
+class Command(BaseCommand):
+
+    help = 'Recompute the materialized answer counters, confusion pairs and rolling success of users from the answers.'
+
+    def handle(self, *args, **options):
+        timer('rebuild_answer_counters')
+        with transaction.atomic():
+            rebuild_answer_counters()
+        print(
+            ' -- number of counters:', AnswerCounter.objects.count(),
+            ', number of confusion pairs:', ConfusionPair.objects.count(),
+            ', number of rolling successes:', RollingSuccess.objects.count(),
+            ', time:', timer('rebuild_answer_counters'), 'seconds')
@@ -1,15 +1,45 @@
 from django.core.management.base import BaseCommand, CommandError
 from contextlib import closing
-from django.db import connection
+from django.db import connection, connections
 from optparse import make_option
 from proso_common.models import Config
-from proso_models.models import EnvironmentInfo, ENVIRONMENT_INFO_CACHE_KEY
-from proso.django.config import instantiate_from_config, set_default_config_name, get_config
+from proso_models.models import EnvironmentInfo, Variable, ENVIRONMENT_INFO_CACHE_KEY
+from proso_models.partitions import attach_partitions, drop_partition, info_partition, is_partitioning_enabled
+from proso.models.sharded_replay import compare_with_sequential, replay_sharded
+from proso.django.config import instantiate_from_config, instantiate_from_json, set_default_config_name, get_config
 from django.db import transaction
 from proso.util import timer
-from proso_models.models import get_predictive_model
 from clint.textui import progress
 from django.core.cache import cache
+from datetime import datetime, timedelta
+from time import sleep
+import bisect
+import proso.models.parameter_search as parameter_search
+import json
+import multiprocessing
+import shutil
+import signal
+
+
+GC_TABLES = ['proso_models_variable', 'proso_models_audit']
+
+# the larger gaps in identifiers of answers are not caused by concurrent
+# transactions (e.g., the sequence was moved), they are not tracked
+MAX_TRACKED_GAP = 1000
+
+ANSWER_COLUMNS = '''
+    id,
+    user_id,
+    item_id,
+    item_asked_id,
+    item_answered_id,
+    time,
+    response_time,
+    guess
+'''
+
+# batch of answers shared by the worker processes
+_worker_batch = None
 
 
 class Command(BaseCommand):
@@ -23,13 +53,27 @@ class Command(BaseCommand):
         make_option(
             '--config-name',
             dest='config_name',
+            action='append',
             type=str,
-            default='default'),
+            default=None,
+            help='name of the config, can be repeated to recompute more environments during one scan of answers'),
+        make_option(
+            '--processes',
+            dest='processes',
+            type=int,
+            default=1,
+            help='number of processes replaying the answers when recomputing more configs'),
         make_option(
             '--batch-size',
             dest='batch_size',
             type=int,
             default=100000),
+        make_option(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            default=10000,
+            help='number of answers fetched from the server-side cursor at once'),
         make_option(
             '--cancel',
             dest='cancel',
@@ -40,37 +84,176 @@ class Command(BaseCommand):
             dest='garbage_collector',
             action='store_true',
             default=False),
+        make_option(
+            '--gc-chunk-size',
+            dest='gc_chunk_size',
+            type=int,
+            default=10000,
+            help='width of the id ranges deleted by one statement during garbage collection'),
+        make_option(
+            '--gc-rows-per-second',
+            dest='gc_rows_per_second',
+            type=int,
+            default=None,
+            help='maximal number of rows deleted per second during garbage collection, unlimited by default'),
+        make_option(
+            '--dry-run',
+            dest='dry_run',
+            action='store_true',
+            default=False,
+            help='only report the number of rows which would be deleted by garbage collection'),
         make_option(
             '--finish',
             dest='finish',
             action='store_true',
             default=False),
+        make_option(
+            '--state',
+            dest='state',
+            type=str,
+            default=None,
+            help='directory to keep the state of the environment between batches, '
+                 'the variables are then saved to the database only each --flush-interval batches and when finishing'),
+        make_option(
+            '--flush-interval',
+            dest='flush_interval',
+            type=int,
+            default=10,
+            help='number of batches between saving the variables to the database when using --state'),
+        make_option(
+            '--shards',
+            dest='shards',
+            type=int,
+            default=1,
+            help='number of processes replaying the answers sharded by users, '
+                 'available only for the first batch of the environment'),
+        make_option(
+            '--epoch-size',
+            dest='epoch_size',
+            type=int,
+            default=10000,
+            help='number of answers between synchronizations of the shared variables of the shards, '
+                 'the audit of the shared variables contains one record per epoch'),
+        make_option(
+            '--verify-shards',
+            dest='verify_shards',
+            action='store_true',
+            default=False,
+            help='replay the answers also sequentially and print the difference of the predictions'),
+        make_option(
+            '--follow',
+            dest='follow',
+            action='store_true',
+            default=False,
+            help='keep the environment in the memory and continuously process new answers, '
+                 'together with --finish the environment is activated as soon as all answers are processed'),
+        make_option(
+            '--interval',
+            dest='interval',
+            type=int,
+            default=5,
+            help='number of seconds to wait for new answers in --follow mode'),
+        make_option(
+            '--checkpoint-interval',
+            dest='checkpoint_interval',
+            type=int,
+            default=60,
+            help='number of seconds between checkpoints in --follow mode'),
+        make_option(
+            '--gap-timeout',
+            dest='gap_timeout',
+            type=int,
+            default=300,
+            help='number of seconds for which the skipped identifiers of answers are re-scanned in --follow mode, '
+                 'the answers committed later than the following ones are replayed when they appear'),
     )
 
     def handle(self, *args, **options):
+        config_names = options['config_name']
+        if config_names is None:
+            config_names = ['default']
+        elif not isinstance(config_names, list):
+            config_names = [config_names]
+        options['config_name'] = config_names[0]
+        if options['shards'] > 1 and (len(config_names) > 1 or options['follow'] or options['state'] is not None):
+            raise CommandError('Option --shards can not be combined with more configs, --follow or --state.')
         if options['cancel']:
-            self.handle_cancel(options)
+            for config_name in config_names:
+                self.handle_cancel(dict(options, config_name=config_name))
         elif options['garbage_collector']:
             self.handle_gc(options)
+        elif len(config_names) > 1:
+            self.handle_recompute_more_configs(config_names, options)
+        elif options['follow']:
+            self.handle_follow(options)
         else:
             self.handle_recompute(options)
 
     def handle_gc(self, options):
+        """
+        Deletes the variables and the audit of disabled environment infos in
+        bounded id ranges, each range is committed on its own, so the
+        collection can be interrupted and run again later. The environment
+        info itself is deleted only after all its rows are gone. Partitions
+        dedicated to the environment info are dropped at once (see
+        proso_models.partitions).
+        """
         timer('recompute_gc')
         print(' -- collecting garbage')
-        to_gc = [str(x.id) for x in EnvironmentInfo.objects.filter(status=EnvironmentInfo.STATUS_DISABLED).all()]
+        to_gc = list(EnvironmentInfo.objects.filter(status=EnvironmentInfo.STATUS_DISABLED).order_by('id').values_list('id', flat=True))
         if not to_gc:
             print(' -- no environment info to collect')
             return
-        to_gc_str = ','.join(to_gc)
+        if options['dry_run']:
+            with closing(connection.cursor()) as cursor:
+                for info_id in to_gc:
+                    counts = []
+                    for table_name in GC_TABLES:
+                        partition = info_partition(cursor, table_name, info_id)
+                        if partition is not None:
+                            print(' -- partition', partition, 'would be dropped')
+                        cursor.execute('SELECT COUNT(*) FROM {} WHERE info_id = %s'.format(table_name), [info_id])
+                        counts.append(cursor.fetchone()[0])
+                    print(' -- environment info', info_id, 'has', counts[0], 'variables and', counts[1], 'audit records')
+            return
+        deleted = dict((table_name, 0) for table_name in GC_TABLES)
+        infos = 0
+        for info_id in to_gc:
+            for table_name in GC_TABLES:
+                deleted[table_name] += self.gc_table(table_name, info_id, options['gc_chunk_size'], options['gc_rows_per_second'])
+            # the remaining related objects (if any) are deleted by the ORM cascade
+            infos += EnvironmentInfo.objects.filter(id=info_id).delete()[1].get(EnvironmentInfo._meta.label, 0)
+            print(' -- environment info', info_id, 'collected')
+        print(' -- collecting garbage, time:', timer('recompute_gc'), 'seconds, deleted', deleted['proso_models_variable'], 'variables,', deleted['proso_models_audit'], 'audit records,', infos, 'environment info records')
+
+    def gc_table(self, table_name, info_id, chunk_size, rows_per_second=None):
+        """
+        Deletes the rows of the given environment info from the table.
+
+        Returns:
+            int: number of deleted rows, dropped partitions are not counted
+        """
         with closing(connection.cursor()) as cursor:
-            cursor.execute('DELETE FROM proso_models_variable WHERE info_id IN (%s)' % to_gc_str)
-            variables = cursor.rowcount
-            cursor.execute('DELETE FROM proso_models_audit WHERE info_id IN (%s)' % to_gc_str)
-            audits = cursor.rowcount
-            cursor.execute('DELETE FROM proso_models_environmentinfo WHERE id IN (%s)' % to_gc_str)
-            infos = cursor.rowcount
-        print(' -- collecting garbage, time:', timer('recompute_gc'), 'seconds, deleted', variables, 'variables,', audits, 'audit records,', infos, 'environment info records')
+            partition = drop_partition(cursor, table_name, info_id)
+            if partition is not None:
+                print(' -- partition', partition, 'dropped')
+            cursor.execute('SELECT MIN(id), MAX(id) FROM {} WHERE info_id = %s'.format(table_name), [info_id])
+            min_id, max_id = cursor.fetchone()
+        if min_id is None:
+            return 0
+        deleted = 0
+        started = datetime.now()
+        for lower in range(min_id, max_id + 1, chunk_size):
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(
+                    'DELETE FROM {} WHERE info_id = %s AND id >= %s AND id < %s'.format(table_name),
+                    [info_id, lower, lower + chunk_size])
+                deleted += cursor.rowcount
+            if rows_per_second:
+                ahead = float(deleted) / rows_per_second - (datetime.now() - started).total_seconds()
+                if ahead > 0:
+                    sleep(ahead)
+        return deleted
 
     def handle_cancel(self, options):
         info = self.load_environment_info(False, options['config_name'])
@@ -81,87 +264,352 @@ class Command(BaseCommand):
     def handle_recompute(self, options):
         timer('recompute_all')
         info = self.load_environment_info(options['initial'], options['config_name'])
+        environment = None
+        if options['shards'] > 1:
+            # the shards are forked outside of the transaction, because the
+            # connection is closed before
+            if options['finish']:
+                self.check_finish(info, options)
+            environment = self.recompute_sharded(info, options)
         if options['finish']:
             with transaction.atomic():
-                to_process = self.number_of_answers_to_process(info)
-                if self.number_of_answers_to_process(info) >= options['batch_size']:
-                    raise CommandError("There is more then allowed number of answers (%s) to process." % to_process)
-                self.recompute(info, options)
+                self.recompute(info, options, environment)
         else:
-            self.recompute(info, options)
+            self.recompute(info, options, environment)
         print(' -- total time:', timer('recompute_all'), 'seconds')
 
-    def recompute(self, info, options):
+    def recompute(self, info, options, environment=None):
+        """
+        Replays the answers which have not been processed yet and flushes
+        the environment, the given environment has the answers already
+        replayed (see :py:meth:`recompute_sharded`).
+        """
+        if options['state'] is not None:
+            self.recompute_with_state(info, options)
+            return
+        if options['finish']:
+            self.check_finish(info, options)
+        if environment is None:
+            print(' -- preparing phase')
+            timer('recompute_prepare')
+            environment = self.load_environment(info)
+            answers, users, items = self.load_answers(info, options['batch_size'], options['chunk_size'])
+            environment.prefetch(users, items)
+            predictive_model = _predictive_model(info)
+            print(' -- preparing phase, time:', timer('recompute_prepare'), 'seconds')
+            timer('recompute_model')
+            print(' -- model phase')
+            self.replay(environment, predictive_model, progress.bar(answers, every=max(1, len(answers) / 100), expected_size=len(answers)))
+            self.update_progress(info, answers)
+            print(' -- model phase, time:', timer('recompute_model'), 'seconds')
+        timer('recompute_flush')
+        print(' -- flushing phase')
+        environment.flush(clean=options['finish'])
+        print(' -- flushing phase, time:', timer('recompute_flush'), 'seconds, total number of answers:', info.load_progress)
+        if options['finish']:
+            self.activate(info)
+        info.save()
+
+    def recompute_sharded(self, info, options):
+        if info.last_answer_id != 0:
+            raise CommandError('The sharded replay can start only from an empty environment, use --batch-size covering all answers.')
         print(' -- preparing phase')
         timer('recompute_prepare')
         environment = self.load_environment(info)
-        users, items = self.load_user_and_item_ids(info, options['batch_size'])
-        environment.prefetch(users, items)
-        predictive_model = get_predictive_model()
+        rows = self.load_answers(info, options['batch_size'], options['chunk_size'])[0]
+        answers = parameter_search.answers_from_rows(rows)
+        initial_values = list(Variable.objects.filter(permanent=True).values_list(
+            'key', 'user_id', 'item_primary_id', 'item_secondary_id', 'permanent', 'updated', 'answer_id', 'value'))
+        predictive_model = _predictive_model(info)
+        print(' -- preparing phase, time:', timer('recompute_prepare'), 'seconds')
+        timer('recompute_model')
+        print(' -- model phase,', options['shards'], 'shards')
+        # the forked shards must not share the connection of this process
+        connections.close_all()
+        predictions = replay_sharded(
+            answers, predictive_model, shards=options['shards'], epoch_size=options['epoch_size'],
+            initial_values=initial_values, environment=environment)
+        self.update_progress(info, rows)
+        print(' -- model phase, time:', timer('recompute_model'), 'seconds')
+        if options['verify_shards']:
+            timer('recompute_verify')
+            comparison = compare_with_sequential(answers, predictions, predictive_model)
+            print(' -- verification, time:', timer('recompute_verify'), 'seconds, difference from the sequential replay:', ', '.join(
+                '{}: {:.5f}'.format(name, value) for name, value in sorted(comparison.items())))
+        return environment
+
+    def recompute_with_state(self, info, options):
+        print(' -- preparing phase')
+        timer('recompute_prepare')
+        environment = self.load_environment(info)
+        meta = environment.state_meta(options['state'])
+        # the state is valid only if there was no flush since it was saved
+        if meta is not None and meta['info'] == info.id and meta['flushed_answer_id'] == info.last_answer_id:
+            environment.load_state(options['state'])
+            info.last_answer_id = meta['last_answer_id']
+            info.load_progress = meta['load_progress']
+            batches = meta['batches']
+        else:
+            if meta is not None:
+                print(' -- ignoring outdated state')
+            environment.start_checkpoints(options['state'])
+            batches = 0
+        if options['finish']:
+            self.check_finish(info, options)
+        flushed_answer_id = info.last_answer_id
+        answers = self.load_answers(info, options['batch_size'], options['chunk_size'])[0]
+        predictive_model = _predictive_model(info)
         print(' -- preparing phase, time:', timer('recompute_prepare'), 'seconds')
         timer('recompute_model')
         print(' -- model phase')
-        with closing(connection.cursor()) as cursor:
-            cursor.execute(
-                '''
-                SELECT
-                    id,
-                    user_id,
-                    item_id,
-                    item_asked_id,
-                    item_answered_id,
-                    time,
-                    response_time,
-                    guess
-                FROM proso_models_answer
-                ORDER BY id
-                OFFSET %s LIMIT %s
-                ''', [info.load_progress, options['batch_size']])
-            progress_bar = progress.bar(cursor, every=max(1, cursor.rowcount / 100), expected_size=cursor.rowcount)
-            info.load_progress += cursor.rowcount
-            for (answer_id, user, item, asked, answered, time, response_time, guess) in progress_bar:
-                predictive_model.predict_and_update(
-                    environment,
-                    user,
-                    item,
-                    asked == answered,
-                    time,
-                    item_answered=answered,
-                    item_asked=asked,
-                    guess=guess,
-                    answer_id=answer_id)
-                environment.process_answer(user, item, asked, answered, time, answer_id, response_time, guess)
+        self.replay(environment, predictive_model, progress.bar(answers, every=max(1, len(answers) / 100), expected_size=len(answers)))
+        self.update_progress(info, answers)
+        batches += 1
         print(' -- model phase, time:', timer('recompute_model'), 'seconds')
-        timer('recompute_flush')
-        print(' -- flushing phase')
-        environment.flush(clean=options['finish'])
-        print(' -- flushing phase, time:', timer('recompute_flush'), 'seconds, total number of answers:', info.load_progress)
+        if options['finish'] or batches >= options['flush_interval']:
+            timer('recompute_flush')
+            print(' -- flushing phase')
+            with transaction.atomic():
+                environment.checkpoint(clean=options['finish'])
+                if options['finish']:
+                    self.activate(info)
+                info.save()
+            flushed_answer_id = info.last_answer_id
+            batches = 0
+            print(' -- flushing phase, time:', timer('recompute_flush'), 'seconds, total number of answers:', info.load_progress)
         if options['finish']:
-            timer('recompute_finish')
-            print(' -- finishing phase')
-            try:
-                previous_info = EnvironmentInfo.objects.get(status=EnvironmentInfo.STATUS_ACTIVE)
-                previous_info.status = EnvironmentInfo.STATUS_DISABLED
-                previous_info.save()
-                cache.delete(ENVIRONMENT_INFO_CACHE_KEY)
-            except EnvironmentInfo.DoesNotExist:
-                pass
-            info.status = EnvironmentInfo.STATUS_ACTIVE
-            print(' -- finishing phase, time:', timer('recompute_finish'), 'seconds')
+            shutil.rmtree(options['state'])
+            return
+        timer('recompute_state')
+        environment.save_state(
+            options['state'],
+            last_answer_id=info.last_answer_id,
+            load_progress=info.load_progress,
+            flushed_answer_id=flushed_answer_id,
+            batches=batches)
+        print(' -- saving state, time:', timer('recompute_state'), 'seconds')
+
+    def handle_recompute_more_configs(self, config_names, options):
+        if options['finish'] or options['follow'] or options['state'] is not None:
+            raise CommandError('Options --finish, --follow and --state can be used only with one config.')
+        timer('recompute_all')
+        infos = [self.load_environment_info(options['initial'], config_name) for config_name in config_names]
+        timer('recompute_read')
+        print(' -- reading phase')
+        # the environments can be recomputed to different answers
+        batch = self.load_answers(
+            None, options['batch_size'], options['chunk_size'],
+            last_answer_id=min([info.last_answer_id for info in infos]))
+        print(' -- reading phase, time:', timer('recompute_read'), 'seconds, number of answers:', len(batch[0]))
+        tasks = [(config_name, info.id) for config_name, info in zip(config_names, infos)]
+        if options['processes'] <= 1:
+            _init_worker(batch)
+            results = [_recompute_config_task(task) for task in tasks]
+        else:
+            # the workers have to open their own connections
+            connections.close_all()
+            with multiprocessing.Pool(min(options['processes'], len(tasks)), initializer=_init_worker, initargs=(batch,)) as pool:
+                results = pool.map(_recompute_config_task, tasks, chunksize=1)
+        for config_name, processed, load_progress, seconds in results:
+            print(' -- config', config_name, 'time:', seconds, 'seconds, processed answers:', processed, 'total number of answers:', load_progress)
+        print(' -- total time:', timer('recompute_all'), 'seconds')
+
+    def recompute_config(self, config_name, info_id, answers, users, items):
+        """
+        Replays the answers which have not been processed yet into the
+        environment of the given config and flushes it.
+
+        Returns:
+            int: number of processed answers
+        """
+        set_default_config_name(config_name)
+        info = EnvironmentInfo.objects.select_related('config').get(id=info_id)
+        answers = answers[bisect.bisect_right([a[0] for a in answers], info.last_answer_id):]
+        environment = self.load_environment(info)
+        environment.prefetch(users, items)
+        predictive_model = _predictive_model(info)
+        self.replay(environment, predictive_model, answers)
+        self.update_progress(info, answers)
+        environment.flush(clean=False)
         info.save()
+        return len(answers), info.load_progress
+
+    def check_finish(self, info, options):
+        to_process = self.number_of_answers_to_process(info, limit=options['batch_size'])
+        if to_process >= options['batch_size']:
+            raise CommandError("There is more then allowed number of answers (%s) to process." % to_process)
+
+    def handle_follow(self, options):
+        timer('recompute_all')
+        info = self.load_environment_info(options['initial'], options['config_name'])
+        print(' -- preparing phase')
+        timer('recompute_prepare')
+        environment = self.load_environment(info)
+        environment.start_checkpoints()
+        predictive_model = _predictive_model(info)
+        print(' -- preparing phase, time:', timer('recompute_prepare'), 'seconds')
+        stopped = []
+
+        def stop(signum, frame):
+            print(' -- stopping after the current batch')
+            stopped.append(signum)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        last_checkpoint = datetime.now()
+        # the identifiers skipped by the processed batches (answer id -> the
+        # time it was skipped), the transactions do not have to commit in
+        # order of the identifiers
+        gaps = self.load_gaps(info)
+        while True:
+            answers = self.follow_answers(info, gaps, options)
+            self.replay(environment, predictive_model, answers)
+            caught_up = len(answers) < options['batch_size']
+            if options['finish'] and caught_up:
+                # only the answers saved during the last batch are missing
+                with transaction.atomic():
+                    answers = self.follow_answers(info, gaps, options)
+                    self.replay(environment, predictive_model, answers)
+                    self.checkpoint(environment, info, clean=True, gaps=gaps)
+                    self.activate(info)
+                    info.save()
+                break
+            if stopped or datetime.now() - last_checkpoint >= timedelta(seconds=options['checkpoint_interval']):
+                self.checkpoint(environment, info, gaps=gaps)
+                last_checkpoint = datetime.now()
+            if stopped:
+                break
+            if caught_up:
+                sleep(options['interval'])
+        print(' -- total time:', timer('recompute_all'), 'seconds')
+
+    def follow_answers(self, info, gaps, options):
+        """
+        Reads the answers which appeared in the tracked gaps since the last
+        call (they are replayed before the new batch) and the batch of new
+        answers, the progress of the environment info is updated.
+
+        Returns:
+            list: answers to replay
+        """
+        late = self.load_late_answers(gaps, options['gap_timeout'])
+        answers = self.load_answers(info, options['batch_size'], options['chunk_size'])[0]
+        self.track_gaps(gaps, info.last_answer_id, answers)
+        info.load_progress += len(late)
+        self.update_progress(info, answers)
+        return late + answers
+
+    def load_gaps(self, info, now=None):
+        """
+        Reads the gaps saved by the last checkpoint of the given environment
+        info, they are tracked again from the given time (now by default).
+
+        Returns:
+            dict: answer id -> the time it is tracked since
+        """
+        if now is None:
+            now = datetime.now()
+        return {answer_id: now for answer_id in json.loads(info.tracked_gaps)}
+
+    def track_gaps(self, gaps, last_answer_id, answers, now=None):
+        """
+        Remembers the identifiers skipped by the given batch of answers
+        following the given answer id.
+        """
+        if now is None:
+            now = datetime.now()
+        previous = last_answer_id
+        for answer in answers:
+            if answer[0] - previous - 1 <= MAX_TRACKED_GAP:
+                for missing in range(previous + 1, answer[0]):
+                    gaps.setdefault(missing, now)
+            previous = answer[0]
+
+    def load_late_answers(self, gaps, gap_timeout):
+        """
+        Reads the answers which appeared in the tracked gaps, the found ones
+        and the ones tracked longer than the given number of seconds (e.g.,
+        rolled back) are not tracked anymore.
+
+        Returns:
+            list: answers ordered by id
+        """
+        if not gaps:
+            return []
+        answers = []
+        missing = sorted(gaps)
+        with closing(connection.cursor()) as cursor:
+            for i in range(0, len(missing), 1000):
+                chunk = missing[i:i + 1000]
+                cursor.execute(
+                    'SELECT ' + ANSWER_COLUMNS + ' FROM proso_models_answer WHERE id IN (' + ','.join(['%s' for a in chunk]) + ') ORDER BY id',
+                    chunk)
+                answers.extend(cursor.fetchall())
+        for answer in answers:
+            del gaps[answer[0]]
+        expired = datetime.now() - timedelta(seconds=gap_timeout)
+        for answer_id, skipped in list(gaps.items()):
+            if skipped < expired:
+                del gaps[answer_id]
+        return answers
+
+    def replay(self, environment, predictive_model, answers):
+        for (answer_id, user, item, asked, answered, time, response_time, guess) in answers:
+            predictive_model.predict_and_update(
+                environment,
+                user,
+                item,
+                asked == answered,
+                time,
+                item_answered=answered,
+                item_asked=asked,
+                guess=guess,
+                answer_id=answer_id)
+            environment.process_answer(user, item, asked, answered, time, answer_id, response_time, guess)
+
+    def update_progress(self, info, answers):
+        if answers:
+            info.load_progress += len(answers)
+            info.last_answer_id = answers[-1][0]
+
+    def checkpoint(self, environment, info, clean=False, gaps=None):
+        timer('recompute_checkpoint')
+        if gaps is not None:
+            # saved together with the progress, so the answers which are
+            # still missing are re-scanned after the restart
+            info.tracked_gaps = json.dumps(sorted(gaps))
+        with transaction.atomic():
+            environment.checkpoint(clean=clean)
+            info.save()
+        print(' -- checkpoint, time:', timer('recompute_checkpoint'), 'seconds, total number of answers:', info.load_progress)
+
+    def activate(self, info):
+        timer('recompute_finish')
+        print(' -- finishing phase')
+        try:
+            previous_info = EnvironmentInfo.objects.get(status=EnvironmentInfo.STATUS_ACTIVE)
+            previous_info.status = EnvironmentInfo.STATUS_DISABLED
+            previous_info.save()
+            cache.delete(ENVIRONMENT_INFO_CACHE_KEY)
+        except EnvironmentInfo.DoesNotExist:
+            pass
+        info.status = EnvironmentInfo.STATUS_ACTIVE
+        print(' -- finishing phase, time:', timer('recompute_finish'), 'seconds')
 
     def load_environment_info(self, initial, config_name):
         set_default_config_name(config_name)
         config = Config.objects.from_content(get_config('proso_models', 'predictive_model', default={}))
         if initial:
-            if EnvironmentInfo.objects.filter(status=EnvironmentInfo.STATUS_LOADING).count() > 0:
+            if EnvironmentInfo.objects.filter(config=config, status=EnvironmentInfo.STATUS_LOADING).count() > 0:
                 raise CommandError("There is already one currently loading environment.")
             last_revisions = EnvironmentInfo.objects.filter(config=config).order_by('-revision')[:1]
             if last_revisions:
                 new_revision = last_revisions[0].id + 1
             else:
                 new_revision = 0
-            return EnvironmentInfo.objects.create(config=config, revision=new_revision)
+            info = EnvironmentInfo.objects.create(config=config, revision=new_revision)
+            if is_partitioning_enabled():
+                attach_partitions(info.id)
+            return info
         else:
             return EnvironmentInfo.objects.get(config=config, status=EnvironmentInfo.STATUS_LOADING)
 
@@ -171,35 +619,75 @@ class Command(BaseCommand):
             default_class='proso_models.environment.InMemoryDatabaseFlushEnvironment',
             pass_parameters=[info])
 
-    def load_user_and_item_ids(self, info, batch_size):
-        with closing(connection.cursor()) as cursor:
-            cursor.execute(
-                '''
-                SELECT
-                    user_id,
-                    item_id,
-                    item_asked_id,
-                    item_answered_id
-                FROM proso_models_answer
-                ORDER BY id
-                OFFSET %s LIMIT %s
-                ''', [info.load_progress, batch_size])
-            unzipped = list(zip(*cursor.fetchall()))
-            if len(unzipped) == 0:
-                return [], []
-            else:
-                return list(set(unzipped[0])), [x for x in list(set(unzipped[1]) | set(unzipped[2]) | set(unzipped[3])) if x is not None]
+    def load_answers(self, info, batch_size, chunk_size, last_answer_id=None):
+        """
+        Reads the batch of answers following the last processed one (or the
+        given one) in a single pass (keyset pagination, so the cost of the
+        batch does not depend on the number of already processed answers).
 
-    def number_of_answers_to_process(self, info):
+        Returns:
+            tuple: (list of answers, list of users, list of items)
+        """
+        answers = []
+        users = set()
+        items = set()
+        with transaction.atomic():
+            with closing(self._answers_cursor(chunk_size)) as cursor:
+                cursor.execute(
+                    'SELECT ' + ANSWER_COLUMNS + '''
+                    FROM proso_models_answer
+                    WHERE id > %s
+                    ORDER BY id
+                    LIMIT %s
+                    ''', [info.last_answer_id if last_answer_id is None else last_answer_id, batch_size])
+                while True:
+                    chunk = cursor.fetchmany(chunk_size)
+                    if not chunk:
+                        break
+                    for answer in chunk:
+                        users.add(answer[1])
+                        items.update(answer[2:5])
+                    answers.extend(chunk)
+        items.discard(None)
+        return answers, list(users), list(items)
+
+    def number_of_answers_to_process(self, info, limit=None):
         with closing(connection.cursor()) as cursor:
             cursor.execute(
                 '''
-                SELECT COUNT(id)
-                FROM proso_models_answer
-                OFFSET %s
-                ''', [info.load_progress])
-            fetched = cursor.fetchone()
-            if fetched is None:
-                return 0
-            else:
-                return fetched[0]
+                SELECT COUNT(*)
+                FROM (
+                    SELECT id
+                    FROM proso_models_answer
+                    WHERE id > %s
+                    ORDER BY id
+                    ''' + ('' if limit is None else 'LIMIT %d' % int(limit)) + '''
+                ) AS to_process
+                ''', [info.last_answer_id])
+            return cursor.fetchone()[0]
+
+    def _answers_cursor(self, chunk_size):
+        if connection.vendor != 'postgresql':
+            return connection.cursor()
+        # server-side cursor, the rows are transferred in chunks
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(name='recompute_model_answers')
+        cursor.itersize = chunk_size
+        return cursor
+
+
+def _predictive_model(info):
+    # the model of the recomputed environment, not the active one
+    return instantiate_from_json(json.loads(info.config.content))
+
+
+def _init_worker(batch):
+    global _worker_batch
+    _worker_batch = batch
+
+
+def _recompute_config_task(task):
+    config_name, info_id = task
+    timer('recompute_config')
+    processed, load_progress = Command().recompute_config(config_name, info_id, *_worker_batch)
+    return config_name, processed, load_progress, timer('recompute_config')
@@ -0,0 +1,143 @@
+from contextlib import closing
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from proso.django.config import get_config
+from proso.util import timer
+import csv
+import datetime
+import json
+import proso.models.parameter_search as parameter_search
+
+
+class Command(BaseCommand):
+
+    help = '''
+    Search for the parameters of the predictive model. The answers are loaded
+    once (from the database or from the CSV file created by 'table2csv'
+    command) and replayed for each configuration in a pool of processes.
+
+    Examples:
+        --grid '{"time_shift": [40, 80, 120], "pfae_good": [1.0, 3.4]}'
+        --random 100 --ranges '{"elo_alpha": [0.1, 1.0], "pfae_bad": [0.1, 1.0]}'
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--csv',
+            dest='csv',
+            type=str,
+            default=None,
+            help='CSV file with answers (proso_models_answer table), the database is used by default'),
+        make_option(
+            '--limit',
+            dest='limit',
+            type=int,
+            default=None,
+            help='maximal number of answers'),
+        make_option(
+            '--model',
+            dest='model',
+            type=str,
+            default=None,
+            help='class of the predictive model, the configured one is used by default'),
+        make_option(
+            '--grid',
+            dest='grid',
+            type=str,
+            default=None,
+            help='JSON: parameter name -> list of values'),
+        make_option(
+            '--random',
+            dest='random',
+            type=int,
+            default=None,
+            help='number of configurations randomly sampled from --ranges'),
+        make_option(
+            '--ranges',
+            dest='ranges',
+            type=str,
+            default=None,
+            help='JSON: parameter name -> [min, max]'),
+        make_option(
+            '--seed',
+            dest='seed',
+            type=int,
+            default=None),
+        make_option(
+            '--processes',
+            dest='processes',
+            type=int,
+            default=None,
+            help='number of processes, number of CPUs by default'),
+        make_option(
+            '--output',
+            dest='output',
+            type=str,
+            default=None,
+            help='CSV file to store the results'),
+    )
+
+    def handle(self, *args, **options):
+        if options['grid'] is not None:
+            configs = parameter_search.grid(json.loads(options['grid']))
+        elif options['random'] is not None and options['ranges'] is not None:
+            configs = parameter_search.random_sample(json.loads(options['ranges']), options['random'], seed=options['seed'])
+        else:
+            raise CommandError('Either --grid or --random with --ranges has to be specified.')
+        model_config = get_config('proso_models', 'predictive_model', default={})
+        model_class = options['model'] if options['model'] else model_config.get(
+            'class', 'proso.models.prediction.PriorCurrentPredictiveModel')
+        base_parameters = model_config.get('parameters', {}) if model_class == model_config.get('class') else {}
+        timer('search_model_parameters_load')
+        if options['csv'] is not None:
+            answers = parameter_search.answers_from_csv(options['csv'], limit=options['limit'])
+        else:
+            answers = self.load_answers(options['limit'])
+        print(' -- loading phase, time:', timer('search_model_parameters_load'), 'seconds, number of answers:', len(answers))
+        timer('search_model_parameters_search')
+        results = parameter_search.search(
+            answers, model_class, configs, base_parameters=base_parameters, processes=options['processes'])
+        print(' -- searching phase, time:', timer('search_model_parameters_search'), 'seconds, number of configurations:', len(configs))
+        results.sort(key=lambda result: result['rmse'])
+        names = sorted(configs[0].keys())
+        print('\t'.join(['rmse', 'log_loss', 'auc'] + names))
+        for result in results:
+            print('\t'.join(
+                ['{:.5f}'.format(result[metric]) for metric in ['rmse', 'log_loss', 'auc']] +
+                [str(result['parameters'][name]) for name in names]
+            ))
+        if options['output'] is not None:
+            with open(options['output'], 'w') as output:
+                writer = csv.writer(output)
+                writer.writerow(['rmse', 'log_loss', 'auc'] + names)
+                for result in results:
+                    writer.writerow(
+                        [result[metric] for metric in ['rmse', 'log_loss', 'auc']] +
+                        [result['parameters'][name] for name in names])
+
+    def load_answers(self, limit):
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT
+                    id,
+                    user_id,
+                    item_id,
+                    item_asked_id,
+                    item_answered_id,
+                    time,
+                    response_time,
+                    guess
+                FROM proso_models_answer
+                ORDER BY id
+                ''' + ('' if limit is None else 'LIMIT %s' % int(limit)))
+            return parameter_search.answers_from_rows(
+                (a_id, u, i, asked, answered, self._ensure_is_datetime(t), r_t, guess)
+                for (a_id, u, i, asked, answered, t, r_t, guess) in cursor
+            )
+
+    def _ensure_is_datetime(self, value):
+        if isinstance(value, str):
+            return datetime.datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+        return value
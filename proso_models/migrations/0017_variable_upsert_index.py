@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proso_models', '0016_answer_type'),
+    ]
+
+    operations = [
+        # remove duplicates created by the race condition in DatabaseEnvironment.write
+        migrations.RunSQL(
+            '''
+            DELETE FROM proso_models_variable WHERE id NOT IN (
+                SELECT MAX(id) FROM proso_models_variable
+                GROUP BY key, info_id, user_id, item_primary_id, item_secondary_id
+            )
+            ''',
+            migrations.RunSQL.noop
+        ),
+        # unique index usable by 'INSERT ... ON CONFLICT', the unique_together
+        # constraint does not take NULL values into account
+        migrations.RunSQL(
+            '''
+            CREATE UNIQUE INDEX proso_models_variable_upsert ON proso_models_variable (
+                key,
+                (COALESCE(info_id, -1)),
+                (COALESCE(user_id, -1)),
+                (COALESCE(item_primary_id, -1)),
+                (COALESCE(item_secondary_id, -1))
+            )
+            ''',
+            'DROP INDEX proso_models_variable_upsert'
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from proso_models.models import REBUILD_ANSWER_COUNTERS_USER_SQL, REBUILD_ANSWER_COUNTERS_ITEM_SQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('proso_models', '0017_variable_upsert_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnswerCounter',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('number_of_answers', models.IntegerField(default=0)),
+                ('number_of_correct_answers', models.IntegerField(default=0)),
+                ('number_of_first_answers', models.IntegerField(default=0)),
+                ('last_answer_time', models.DateTimeField(default=None, blank=True, null=True)),
+                ('item', models.ForeignKey(to='proso_models.Item')),
+                ('user', models.ForeignKey(default=None, blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='answercounter',
+            unique_together=set([('user', 'item')]),
+        ),
+        # unique index usable by 'INSERT ... ON CONFLICT', the unique_together
+        # constraint does not take NULL values into account
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX proso_models_answercounter_upsert ON proso_models_answercounter ((COALESCE(user_id, -1)), item_id)',
+            'DROP INDEX proso_models_answercounter_upsert'
+        ),
+        # the counters of the existing answers, the environment reads them
+        # instead of the answers
+        migrations.RunSQL(REBUILD_ANSWER_COUNTERS_USER_SQL, migrations.RunSQL.noop),
+        migrations.RunSQL(REBUILD_ANSWER_COUNTERS_ITEM_SQL, migrations.RunSQL.noop),
+    ]
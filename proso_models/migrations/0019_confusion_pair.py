@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from proso_models.models import REBUILD_CONFUSION_PAIRS_USER_SQL, REBUILD_CONFUSION_PAIRS_GLOBAL_SQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('proso_models', '0018_answer_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConfusionPair',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('value', models.IntegerField(default=0)),
+                ('item_primary', models.ForeignKey(related_name='item_primary_confusion_pairs', to='proso_models.Item')),
+                ('item_secondary', models.ForeignKey(related_name='item_secondary_confusion_pairs', to='proso_models.Item')),
+                ('user', models.ForeignKey(default=None, blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='confusionpair',
+            unique_together=set([('item_primary', 'item_secondary', 'user')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='confusionpair',
+            index_together=set([('item_secondary', 'item_primary')]),
+        ),
+        # unique index usable by 'INSERT ... ON CONFLICT', the unique_together
+        # constraint does not take NULL values into account
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX proso_models_confusionpair_upsert ON proso_models_confusionpair (item_primary_id, item_secondary_id, (COALESCE(user_id, -1)))',
+            'DROP INDEX proso_models_confusionpair_upsert'
+        ),
+        # the confusion pairs of the existing answers
+        migrations.RunSQL(REBUILD_CONFUSION_PAIRS_USER_SQL, migrations.RunSQL.noop),
+        migrations.RunSQL(REBUILD_CONFUSION_PAIRS_GLOBAL_SQL, migrations.RunSQL.noop),
+    ]
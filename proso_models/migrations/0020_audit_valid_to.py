@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# the validity intervals of the existing audit records are closed by
+# 'close_audit_intervals' command (per environment info)
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proso_models', '0019_confusion_pair'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audit',
+            name='valid_to',
+            field=models.DateTimeField(default=None, blank=True, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='audit',
+            index_together=set([('info', 'key'), ('info', 'key', 'user'), ('info', 'key', 'user', 'item_primary'), ('info', 'key', 'user', 'item_primary', 'item_secondary'), ('info', 'key', 'item_primary'), ('key', 'user', 'item_primary', 'item_secondary', 'valid_to')]),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from proso_models.models import REBUILD_ROLLING_SUCCESS_CONTEXT_SQL, REBUILD_ROLLING_SUCCESS_GLOBAL_SQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('proso_models', '0020_audit_valid_to'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollingSuccess',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('bits', models.BigIntegerField(default=0)),
+                ('size', models.IntegerField(default=0)),
+                ('context', models.ForeignKey(default=None, blank=True, to='proso_models.PracticeContext', null=True)),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='rollingsuccess',
+            unique_together=set([('user', 'context')]),
+        ),
+        # unique index usable by 'INSERT ... ON CONFLICT', the unique_together
+        # constraint does not take NULL values into account
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX proso_models_rollingsuccess_upsert ON proso_models_rollingsuccess (user_id, (COALESCE(context_id, -1)))',
+            'DROP INDEX proso_models_rollingsuccess_upsert'
+        ),
+        # the rolling success of the existing answers
+        migrations.RunSQL(REBUILD_ROLLING_SUCCESS_CONTEXT_SQL, migrations.RunSQL.noop),
+        migrations.RunSQL(REBUILD_ROLLING_SUCCESS_GLOBAL_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proso_models', '0021_rolling_success'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environmentinfo',
+            name='last_answer_id',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunSQL(
+            '''
+            UPDATE proso_models_environmentinfo
+            SET last_answer_id = t.id
+            FROM (
+                SELECT
+                    id,
+                    ROW_NUMBER() OVER (ORDER BY id) AS position
+                FROM proso_models_answer
+            ) AS t
+            WHERE proso_models_environmentinfo.load_progress > 0 AND t.position = proso_models_environmentinfo.load_progress
+            ''',
+            migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# functions used by the triggers of the optional partitioning (see
+# proso_models.partitions), the triggers are created when the first
+# partition is attached
+ROUTE_PARTITION = '''
+CREATE OR REPLACE FUNCTION proso_models_route_partition() RETURNS trigger AS $$
+DECLARE
+    partition text;
+BEGIN
+    IF TG_ARGV[0] = 'info' THEN
+        IF NEW.info_id IS NULL THEN
+            RETURN NEW;
+        END IF;
+        partition := TG_TABLE_NAME || '_info_' || NEW.info_id;
+    ELSE
+        partition := TG_TABLE_NAME || '_' || to_char(NEW.time, 'YYYYMM');
+    END IF;
+    IF to_regclass(partition) IS NULL THEN
+        RETURN NEW;
+    END IF;
+    EXECUTE format('INSERT INTO %I SELECT ($1).*', partition) USING NEW;
+    -- the row is written only once, to the partition
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+'''
+
+
+def create_functions(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(ROUTE_PARTITION)
+
+
+def drop_functions(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP FUNCTION IF EXISTS proso_models_route_partition() CASCADE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proso_models', '0022_environment_info_last_answer'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_functions, drop_functions),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proso_models', '0023_partitioning'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environmentinfo',
+            name='tracked_gaps',
+            field=models.TextField(default='[]'),
+        ),
+    ]
@@ -1,20 +1,22 @@
 from collections import defaultdict
-from contextlib import closing
+from contextlib import closing, contextmanager
 from datetime import datetime, timedelta
 from django.contrib.auth.models import User
-from django.core.cache import cache
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from django.db import connection
 from django.db import models
 from django.db import transaction
 from django.db.models import Count, F
 from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
-from proso.django.cache import get_request_cache, is_cache_prepared, get_from_request_permenent_cache, set_to_request_permanent_cache
+from proso.django.cache import get_request_cache, is_cache_prepared, get_from_request_permenent_cache, set_to_request_permanent_cache, has_request_permanent_cache
 from functools import reduce
 from proso.django.config import instantiate_from_config, instantiate_from_json, get_global_config, get_config
 from proso.django.models import ModelDiffMixin
 from proso.django.request import load_query_json
-from proso.django.util import disable_for_loaddata, cache_pure
+from proso.django.util import disable_for_loaddata, cache_pure, is_on_postgresql
 from proso.func import fixed_point
 from proso.list import flatten
 from proso.metric import binomial_confidence_mean, confidence_value_to_json
@@ -22,6 +24,7 @@ from proso.models.item_selection import TestWrapperItemSelection
 from proso_common.models import Config
 from proso_common.models import IntegrityCheck
 from proso_user.models import Session
+from threading import currentThread
 import django.apps
 import hashlib
 import importlib
@@ -29,13 +32,21 @@ import json
 import logging
 import proso.list
 import re
+import uuid
+import weakref
 
 
 ENVIRONMENT_INFO_CACHE_EXPIRATION = 30 * 60
 ENVIRONMENT_INFO_CACHE_KEY = 'proso_models_env_info'
 ITEM_SELECTOR_CACHE_KEY = 'proso_models_item_selector'
+ITEM_RELATION_VERSION_CACHE_KEY = 'proso_models_item_relation_version'
 LOGGER = logging.getLogger('django.request')
 
+_deferred_answers = {}
+# thread -> weak reference to the callback bumping the item relation version
+# after the commit, the callback is released once the transaction ends
+_uncommitted_item_relations = {}
+
 
 ################################################################################
 # getters
@@ -69,6 +80,101 @@ def get_environment():
     )
 
 
+def get_batch_environment():
+    return instantiate_from_config(
+        'proso_models', 'batch_environment',
+        default_class='proso_models.environment.BatchDatabaseEnvironment',
+        pass_parameters=[get_active_environment_info()['id']]
+    )
+
+
+def get_item_relation_version():
+    """
+    Returns the version of the item relations. The version changes whenever
+    the 'parent' or 'child' variables (created from item relations) change, so
+    it can be used to invalidate structures compiled from the item hierarchy.
+    If there is no cache shared by all the processes (see
+    'proso_models.item_relation_version.cache' config), the version is valid
+    only within the current request, outside of requests it is None (nothing
+    should be cached).
+    """
+    shared = _item_relation_version_cache()
+    if shared is None:
+        return _request_item_relation_version()
+    version = shared.get(ITEM_RELATION_VERSION_CACHE_KEY)
+    if version is None:
+        shared.add(ITEM_RELATION_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+        version = shared.get(ITEM_RELATION_VERSION_CACHE_KEY)
+    return version
+
+
+def bump_item_relation_version():
+    shared = _item_relation_version_cache()
+    thread = currentThread()
+
+    def _bump():
+        if has_request_permanent_cache():
+            set_to_request_permanent_cache(ITEM_RELATION_VERSION_CACHE_KEY, None)
+        if shared is not None:
+            shared.set(ITEM_RELATION_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+
+    def _bump_after_commit():
+        _uncommitted_item_relations.pop(thread, None)
+        _bump()
+
+    _bump()
+    # the structures could be compiled from the uncommitted data in the meantime
+    if connection.in_atomic_block:
+        _uncommitted_item_relations[thread] = weakref.ref(_bump_after_commit)
+    transaction.on_commit(_bump_after_commit)
+
+
+def has_uncommitted_item_relations():
+    """
+    Returns True if the item relations have been changed in the current
+    transaction, i.e., the structures compiled from them in this thread should
+    not be shared with others.
+    """
+    callback = _uncommitted_item_relations.get(currentThread())
+    if callback is None:
+        return False
+    if not connection.in_atomic_block or callback() is None:
+        # the transaction (or the savepoint) has been rolled back and the
+        # callback registered by transaction.on_commit has been discarded
+        _uncommitted_item_relations.pop(currentThread(), None)
+        return False
+    return True
+
+
+def is_item_relation_version_shared():
+    """
+    Returns True if the version of the item relations is shared by all the
+    processes, otherwise it is valid only within the current request (see
+    :py:func:`get_item_relation_version`).
+    """
+    return _item_relation_version_cache() is not None
+
+
+def _request_item_relation_version():
+    if not has_request_permanent_cache():
+        return None
+    version = get_from_request_permenent_cache(ITEM_RELATION_VERSION_CACHE_KEY)
+    if version is None:
+        version = 'request_{}'.format(uuid.uuid4().hex)
+        set_to_request_permanent_cache(ITEM_RELATION_VERSION_CACHE_KEY, version)
+    return version
+
+
+def _item_relation_version_cache():
+    alias = get_config('proso_models', 'item_relation_version.cache', default='default')
+    shared = caches[alias]
+    if isinstance(shared, (DummyCache, LocMemCache)):
+        # the version kept only in the memory of this process is not bumped
+        # by the others
+        return None
+    return shared
+
+
 def get_predictive_model():
     # predictive model is configured by active environment info
     return instantiate_from_json(get_active_environment_info()['config'])
@@ -290,6 +396,10 @@ class EnvironmentInfo(models.Model):
     revision = models.IntegerField()
     config = models.ForeignKey(Config)
     load_progress = models.IntegerField(default=0)
+    last_answer_id = models.IntegerField(default=0)
+    # JSON list of the identifiers of answers skipped by the follow mode of
+    # 'recompute_model' and not replayed yet, saved with its checkpoints
+    tracked_gaps = models.TextField(default='[]')
     updated = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
 
@@ -1036,6 +1146,9 @@ class Audit(models.Model):
     key = models.CharField(max_length=50)
     value = models.FloatField()
     time = models.DateTimeField(default=datetime.now)
+    # time of the following record of the same variable, the record is valid
+    # in the interval [time, valid_to), None if it is the current value
+    valid_to = models.DateTimeField(null=True, blank=True, default=None)
     info = models.ForeignKey(EnvironmentInfo, null=True, blank=True, default=None)
     answer = models.ForeignKey(Answer, null=True, blank=True, default=None)
 
@@ -1046,10 +1159,380 @@ class Audit(models.Model):
             ['info', 'key', 'user'],
             ['info', 'key', 'item_primary'],
             ['info', 'key', 'user', 'item_primary'],
-            ['info', 'key', 'user', 'item_primary', 'item_secondary']
+            ['info', 'key', 'user', 'item_primary', 'item_secondary'],
+            ['key', 'user', 'item_primary', 'item_secondary', 'valid_to'],
+        ]
+
+
+def save_audits(audits, stored_variables=None):
+    """
+    Saves the given new audit records and closes the validity intervals of
+    the records they follow (see Audit.valid_to). The intervals of all the
+    variables are closed by one statement (per 80 variables).
+
+    Args:
+        audits (list): list of unsaved proso_models.models.Audit
+        stored_variables (set): (key, user, item primary, item secondary,
+            info) of the variables which may already have audit records,
+            the records of other variables are not looked up; None means
+            all the variables
+    """
+    if len(audits) == 0:
+        return
+    # (key, user, item primary, item secondary, info) -> audit records
+    variables = defaultdict(list)
+    for audit in audits:
+        variables[audit.key, audit.user_id, audit.item_primary_id, audit.item_secondary_id, audit.info_id].append(audit)
+    closing_times = []
+    for variable, variable_audits in variables.items():
+        variable_audits.sort(key=lambda audit: audit.time)
+        for audit, following in zip(variable_audits, variable_audits[1:]):
+            audit.valid_to = following.time
+        if stored_variables is None or variable in stored_variables:
+            closing_times.append((variable, variable_audits[0].time))
+    with closing(connection.cursor()) as cursor:
+        for start in range(0, len(closing_times), 80):
+            cases, case_params, conds, conds_params = [], [], [], []
+            for variable, time in closing_times[start:start + 80]:
+                cond, cond_params = _audit_variable_condition(*variable)
+                cases.append('WHEN ' + cond + ' THEN %s')
+                case_params += cond_params + [time]
+                conds.append(cond)
+                conds_params += cond_params
+            cursor.execute(
+                'UPDATE proso_models_audit SET valid_to = CASE ' + ' '.join(cases) + ' END '
+                'WHERE valid_to IS NULL AND (' + ' OR '.join(conds) + ')',
+                case_params + conds_params)
+    Audit.objects.bulk_create(audits)
+
+
+def close_audit_intervals(info_id):
+    """
+    Closes the validity intervals of all the audit records belonging to the
+    given environment info which are followed by other records. This is
+    useful after the audit records are loaded in bulk.
+    """
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            '''
+            UPDATE proso_models_audit
+            SET valid_to = t.valid_to
+            FROM (
+                SELECT
+                    id,
+                    LEAD(time) OVER (
+                        PARTITION BY key, user_id, item_primary_id, item_secondary_id
+                        ORDER BY time, id
+                    ) AS valid_to
+                FROM proso_models_audit
+                WHERE valid_to IS NULL AND info_id = %s
+            ) AS t
+            WHERE proso_models_audit.id = t.id AND t.valid_to IS NOT NULL AND proso_models_audit.info_id = %s
+            ''', [info_id, info_id])
+
+
+def _audit_variable_condition(key, user, item_primary, item_secondary, info):
+    columns = [('key', key), ('user_id', user), ('item_primary_id', item_primary), ('item_secondary_id', item_secondary), ('info_id', info)]
+    return (
+        '(' + ' AND '.join([c + (' IS NULL' if v is None else ' = %s') for c, v in columns]) + ')',
+        [v for c, v in columns if v is not None]
+    )
+
+
+class AnswerCounter(models.Model):
+    """
+    Materialized statistics of answers for the pair (user, item), rows
+    without user contain the statistics of the item over all users. The
+    counters are updated after the predictive model, see
+    :py:func:`update_answer_counters`.
+    """
+
+    user = models.ForeignKey(User, null=True, blank=True, default=None)
+    item = models.ForeignKey(Item)
+    number_of_answers = models.IntegerField(default=0)
+    number_of_correct_answers = models.IntegerField(default=0)
+    number_of_first_answers = models.IntegerField(default=0)
+    last_answer_time = models.DateTimeField(null=True, blank=True, default=None)
+
+    class Meta:
+        app_label = 'proso_models'
+        unique_together = ('user', 'item')
+
+
+def update_answer_counters(answers):
+    """
+    Adds the given (already saved) answers to the answer counters and shifts
+    their correctness into the rolling success of their users (see
+    :py:class:`RollingSuccess`). On PostgreSQL, all the upserts are sent as
+    one statement.
+
+    Args:
+        answers (list): list of proso_models.models.Answer ordered by id
+    """
+    if len(answers) == 0:
+        return
+    existing = set(AnswerCounter.objects.filter(
+        user_id__in={a.user_id for a in answers},
+        item_id__in={a.item_id for a in answers}
+    ).values_list('user_id', 'item_id'))
+    # (user, item) -> [answers, correct answers, first answers, last time]
+    counters = {}
+    for answer in answers:
+        first = (answer.user_id, answer.item_id) not in existing
+        existing.add((answer.user_id, answer.item_id))
+        for user in [answer.user_id, None]:
+            counter = counters.setdefault((user, answer.item_id), [0, 0, 0, answer.time])
+            counter[0] += 1
+            counter[1] += 1 if answer.item_asked_id == answer.item_answered_id else 0
+            counter[2] += 1 if first else 0
+            counter[3] = max(counter[3], answer.time)
+    rows = [[u, i] + counter for (u, i), counter in sorted(counters.items(), key=lambda x: (x[0][0] is None, x[0]))]
+    statements = []
+    for start in range(0, len(rows), 150):
+        chunk = rows[start:start + 150]
+        statements.append((
+            '''
+            INSERT INTO proso_models_answercounter
+                (user_id, item_id, number_of_answers, number_of_correct_answers, number_of_first_answers, last_answer_time)
+            VALUES
+            ''' + ','.join(['(%s, %s, %s, %s, %s, %s)' for row in chunk]) +
+            '''
+            ON CONFLICT ((COALESCE(user_id, -1)), item_id)
+            DO UPDATE SET
+                number_of_answers = proso_models_answercounter.number_of_answers + EXCLUDED.number_of_answers,
+                number_of_correct_answers = proso_models_answercounter.number_of_correct_answers + EXCLUDED.number_of_correct_answers,
+                number_of_first_answers = proso_models_answercounter.number_of_first_answers + EXCLUDED.number_of_first_answers,
+                last_answer_time = CASE
+                    WHEN proso_models_answercounter.last_answer_time > EXCLUDED.last_answer_time
+                    THEN proso_models_answercounter.last_answer_time
+                    ELSE EXCLUDED.last_answer_time
+                END
+            ''', [x for row in chunk for x in row]))
+    _execute_upserts(statements + _rolling_success_upserts(answers))
+
+
+def _execute_upserts(statements):
+    """
+    Executes the given upserts (sql, params) touching disjoint rows, on
+    PostgreSQL they are joined into one statement by data-modifying WITH
+    clauses.
+    """
+    if len(statements) == 0:
+        return
+    with closing(connection.cursor()) as cursor:
+        if is_on_postgresql():
+            cursor.execute(
+                ('WITH ' + ', '.join(['upsert_{} AS ({})'.format(i, sql) for i, (sql, params) in enumerate(statements[:-1])]) + ' '
+                 if len(statements) > 1 else '') + statements[-1][0],
+                [p for sql, params in statements for p in params])
+        else:
+            for sql, params in statements:
+                cursor.execute(sql, params)
+
+
+class ConfusionPair(models.Model):
+    """
+    Number of wrong answers (not guessed) for which the given pair of items
+    was confused (one of them was asked, the other was answered) by the
+    given user, rows without user contain the numbers over all users. The
+    pair is unordered, the item with the lower identifier is the primary one.
+    """
+
+    user = models.ForeignKey(User, null=True, blank=True, default=None)
+    item_primary = models.ForeignKey(Item, related_name='item_primary_confusion_pairs')
+    item_secondary = models.ForeignKey(Item, related_name='item_secondary_confusion_pairs')
+    value = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = 'proso_models'
+        unique_together = ('item_primary', 'item_secondary', 'user')
+        index_together = [
+            ['item_secondary', 'item_primary'],
         ]
 
 
+def update_confusion_pairs(answers):
+    """
+    Adds the given (already saved) wrong answers to the confusion pairs.
+
+    Args:
+        answers (list): list of proso_models.models.Answer
+    """
+    # (user, item primary, item secondary) -> number of answers
+    pairs = defaultdict(int)
+    for answer in answers:
+        if answer.guess != 0 or answer.item_answered_id is None or answer.item_asked_id == answer.item_answered_id:
+            continue
+        items = sorted([answer.item_asked_id, answer.item_answered_id])
+        pairs[answer.user_id, items[0], items[1]] += 1
+        pairs[None, items[0], items[1]] += 1
+    if len(pairs) == 0:
+        return
+    rows = [list(key) + [count] for key, count in sorted(pairs.items(), key=lambda x: (x[0][0] is None, x[0]))]
+    with closing(connection.cursor()) as cursor:
+        for start in range(0, len(rows), 200):
+            chunk = rows[start:start + 200]
+            cursor.execute(
+                '''
+                INSERT INTO proso_models_confusionpair (user_id, item_primary_id, item_secondary_id, value)
+                VALUES
+                ''' + ','.join(['(%s, %s, %s, %s)' for row in chunk]) +
+                '''
+                ON CONFLICT (item_primary_id, item_secondary_id, (COALESCE(user_id, -1)))
+                DO UPDATE SET value = proso_models_confusionpair.value + EXCLUDED.value
+                ''', [x for row in chunk for x in row])
+
+
+# number of the most recent answers kept in proso_models.models.RollingSuccess
+ROLLING_SUCCESS_SIZE = 63
+ROLLING_SUCCESS_MASK = (1 << ROLLING_SUCCESS_SIZE) - 1
+
+
+class RollingSuccess(models.Model):
+    """
+    Correctness of the most recent answers of the given user in the given
+    context packed into one integer, rows without context contain the
+    answers from all contexts. The lowest bit belongs to the last answer,
+    at most ROLLING_SUCCESS_SIZE answers are kept, see
+    :py:func:`update_answer_counters`.
+    """
+
+    user = models.ForeignKey(User)
+    context = models.ForeignKey(PracticeContext, null=True, blank=True, default=None)
+    bits = models.BigIntegerField(default=0)
+    size = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = 'proso_models'
+        unique_together = ('user', 'context')
+
+
+def _rolling_success_upserts(answers):
+    # (user, context) -> [bits, number of answers]
+    buffers = {}
+    for answer in answers:
+        correct = 1 if answer.item_asked_id == answer.item_answered_id else 0
+        for context in [answer.context_id, None] if answer.context_id is not None else [None]:
+            buffer = buffers.setdefault((answer.user_id, context), [0, 0])
+            buffer[0] = ((buffer[0] << 1) | correct) & ROLLING_SUCCESS_MASK
+            buffer[1] = min(buffer[1] + 1, ROLLING_SUCCESS_SIZE)
+    rows = [list(key) + buffer for key, buffer in buffers.items()]
+    statements = []
+    for start in range(0, len(rows), 200):
+        chunk = rows[start:start + 200]
+        statements.append((
+            '''
+            INSERT INTO proso_models_rollingsuccess (user_id, context_id, bits, size)
+            VALUES
+            ''' + ','.join(['(%s, %s, %s, %s)' for row in chunk]) +
+            '''
+            ON CONFLICT (user_id, (COALESCE(context_id, -1)))
+            DO UPDATE SET
+                bits = ((proso_models_rollingsuccess.bits << EXCLUDED.size) | EXCLUDED.bits) & {mask},
+                size = CASE
+                    WHEN proso_models_rollingsuccess.size + EXCLUDED.size > {size}
+                    THEN {size}
+                    ELSE proso_models_rollingsuccess.size + EXCLUDED.size
+                END
+            '''.format(mask=ROLLING_SUCCESS_MASK, size=ROLLING_SUCCESS_SIZE), [x for row in chunk for x in row]))
+    return statements
+
+
+REBUILD_ANSWER_COUNTERS_USER_SQL = '''
+    INSERT INTO proso_models_answercounter
+        (user_id, item_id, number_of_answers, number_of_correct_answers, number_of_first_answers, last_answer_time)
+    SELECT
+        user_id,
+        item_id,
+        COUNT(id),
+        SUM(CASE WHEN item_asked_id = item_answered_id THEN 1 ELSE 0 END),
+        1,
+        MAX(time)
+    FROM proso_models_answer
+    GROUP BY user_id, item_id
+'''
+
+REBUILD_ANSWER_COUNTERS_ITEM_SQL = '''
+    INSERT INTO proso_models_answercounter
+        (user_id, item_id, number_of_answers, number_of_correct_answers, number_of_first_answers, last_answer_time)
+    SELECT
+        NULL,
+        item_id,
+        SUM(number_of_answers),
+        SUM(number_of_correct_answers),
+        COUNT(1),
+        MAX(last_answer_time)
+    FROM proso_models_answercounter
+    WHERE user_id IS NOT NULL
+    GROUP BY item_id
+'''
+
+
+REBUILD_CONFUSION_PAIRS_USER_SQL = '''
+    INSERT INTO proso_models_confusionpair (user_id, item_primary_id, item_secondary_id, value)
+    SELECT
+        user_id,
+        CASE WHEN item_asked_id < item_answered_id THEN item_asked_id ELSE item_answered_id END AS item_primary,
+        CASE WHEN item_asked_id < item_answered_id THEN item_answered_id ELSE item_asked_id END AS item_secondary,
+        COUNT(id)
+    FROM proso_models_answer
+    WHERE guess = 0 AND item_answered_id IS NOT NULL AND item_asked_id != item_answered_id
+    GROUP BY user_id, item_primary, item_secondary
+'''
+
+REBUILD_CONFUSION_PAIRS_GLOBAL_SQL = '''
+    INSERT INTO proso_models_confusionpair (user_id, item_primary_id, item_secondary_id, value)
+    SELECT NULL, item_primary_id, item_secondary_id, SUM(value)
+    FROM proso_models_confusionpair
+    WHERE user_id IS NOT NULL
+    GROUP BY item_primary_id, item_secondary_id
+'''
+
+REBUILD_ROLLING_SUCCESS_SQL = '''
+    INSERT INTO proso_models_rollingsuccess (user_id, context_id, bits, size)
+    SELECT
+        user_id,
+        {context},
+        SUM(CASE WHEN item_asked_id = item_answered_id THEN CAST(1 AS BIGINT) << (answer_order - 1) ELSE 0 END),
+        COUNT(1)
+    FROM (
+        SELECT
+            user_id,
+            context_id,
+            item_asked_id,
+            item_answered_id,
+            ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY id DESC) AS answer_order
+        FROM proso_models_answer
+        {where}
+    ) AS ordered_answers
+    WHERE answer_order <= {size}
+    GROUP BY {partition}
+'''
+
+REBUILD_ROLLING_SUCCESS_CONTEXT_SQL = REBUILD_ROLLING_SUCCESS_SQL.format(
+    context='context_id', partition='user_id, context_id', where='WHERE context_id IS NOT NULL', size=ROLLING_SUCCESS_SIZE)
+
+REBUILD_ROLLING_SUCCESS_GLOBAL_SQL = REBUILD_ROLLING_SUCCESS_SQL.format(
+    context='NULL', partition='user_id', where='', size=ROLLING_SUCCESS_SIZE)
+
+
+def rebuild_answer_counters():
+    """
+    Recomputes all the answer counters, the confusion pairs and the rolling
+    success of users from the answers.
+    """
+    with closing(connection.cursor()) as cursor:
+        cursor.execute('DELETE FROM proso_models_answercounter')
+        cursor.execute(REBUILD_ANSWER_COUNTERS_USER_SQL)
+        cursor.execute(REBUILD_ANSWER_COUNTERS_ITEM_SQL)
+        cursor.execute('DELETE FROM proso_models_confusionpair')
+        cursor.execute(REBUILD_CONFUSION_PAIRS_USER_SQL)
+        cursor.execute(REBUILD_CONFUSION_PAIRS_GLOBAL_SQL)
+        cursor.execute('DELETE FROM proso_models_rollingsuccess')
+        cursor.execute(REBUILD_ROLLING_SUCCESS_CONTEXT_SQL)
+        cursor.execute(REBUILD_ROLLING_SUCCESS_GLOBAL_SQL)
+
+
 def get_content_hash(content):
     return hashlib.sha1(content.encode()).hexdigest()
 
@@ -1115,21 +1598,86 @@ def init_config(sender, instance, **kwargs):
 def update_predictive_model(sender, instance, **kwargs):
     if not issubclass(sender, Answer) or not kwargs['created']:
         return
+    deferred = _deferred_answers.get(currentThread())
+    if deferred is not None:
+        deferred.append(instance)
+        return
     environment = get_environment()
     # We want to make the prediction before the answer is saved,
     # but we need answer id to track it.
     environment.shift_answers(instance.pk)
     environment.avoid_audit(True)
     predictive_model = get_predictive_model()
-    predictive_model.predict_and_update(
-        environment,
-        instance.user_id,
-        instance.item_id,
-        instance.item_asked_id == instance.item_answered_id,
-        instance.time,
-        instance.pk,
-        item_answered=instance.item_answered_id,
-        item_asked=instance.item_asked_id)
+    with transaction.atomic():
+        predictive_model.predict_and_update(
+            environment,
+            instance.user_id,
+            instance.item_id,
+            instance.item_asked_id == instance.item_answered_id,
+            instance.time,
+            instance.pk,
+            item_answered=instance.item_answered_id,
+            item_asked=instance.item_asked_id)
+        # buffering environments write the values here
+        environment.flush()
+        # the counters are updated after the model, because the model expects
+        # them to contain only the previous answers
+        update_answer_counters([instance])
+        update_confusion_pairs([instance])
+
+
+def update_predictive_model_many(answers):
+    """
+    Updates the predictive model after the given (already saved) answers at
+    once. The data for all the users and items are prefetched by a few
+    queries, the answers are processed in memory and the changes are written
+    by one batch at the end.
+
+    Args:
+        answers (list): list of proso_models.models.Answer
+    """
+    if len(answers) == 0:
+        return
+    answers = sorted(answers, key=lambda answer: answer.pk)
+    environment = get_batch_environment()
+    environment.prefetch(
+        list({answer.user_id for answer in answers}),
+        list({answer.item_id for answer in answers}),
+        answers[0].pk)
+    get_predictive_model().predict_and_update_many(environment, [{
+        'user': answer.user_id,
+        'item': answer.item_id,
+        'item_asked': answer.item_asked_id,
+        'item_answered': answer.item_answered_id,
+        'time': answer.time,
+        'answer_id': answer.pk,
+        'response_time': answer.response_time,
+    } for answer in answers])
+    environment.flush()
+    update_answer_counters(answers)
+    update_confusion_pairs(answers)
+
+
+@contextmanager
+def defer_predictive_model_update():
+    """
+    Within this context, the predictive model is not updated after each saved
+    answer. The answers saved in the current thread are collected and the
+    model is updated after all of them at once (see
+    :py:func:`update_predictive_model_many`) when the context is left without
+    an exception.
+    """
+    thread = currentThread()
+    if thread in _deferred_answers:
+        yield
+        return
+    _deferred_answers[thread] = []
+    try:
+        yield
+        answers = _deferred_answers[thread]
+    finally:
+        del _deferred_answers[thread]
+    update_predictive_model_many(answers)
 
 
 @receiver(post_save, sender=Variable)
@@ -1145,7 +1693,8 @@ def log_audit(sender, instance, **kwargs):
             time=instance.updated,
             info_id=instance.info_id,
             answer=instance.answer)
-        audit.save()
+        # the newly created variable has no audit record to be closed
+        save_audits([audit], stored_variables=set() if kwargs.get('created') else None)
 
 
 @receiver(pre_save, sender=ItemRelation)
@@ -1,5 +1,10 @@
-from .models import Item, ItemRelation, get_environment
+from .management.commands.recompute_model import Command as RecomputeModelCommand, _predictive_model
+from .models import Answer, AnswerCounter, Audit, ConfusionPair, EnvironmentInfo, Item, ItemRelation, PracticeContext, RollingSuccess, Variable, defer_predictive_model_update, get_environment
+from datetime import datetime, timedelta
+from django.contrib.auth.models import User
 from django.core.management import call_command
+from proso.models.prediction import AlwaysLearningPredictiveModel
+from proso_common.models import Config
 from proso_flashcards.models import Flashcard, Category
 from testproject.testapp.models import ExtendedContext, ExtendedTerm
 import django.test as test
@@ -235,3 +240,202 @@ class TestItemManager(test.TestCase):
             Item.objects.translate_identifiers(['flashcard/africa-bw', 'category/world'], 'cs'),
             {'category/world': 2, 'flashcard/africa-bw': 188}
         )
+
+
+class AnswerCounterTest(test.TestCase):
+
+    def test_rebuild(self):
+        users = [User.objects.create(username=str(i)) for i in range(3)]
+        items = [Item.objects.create() for i in range(4)]
+        time = datetime(2016, 1, 1, 12)
+        for i in range(20):
+            user, item = users[i % 3], items[i % 4]
+            Answer.objects.create(
+                user=user, item=item, item_asked=item, item_answered=item if i % 5 else None,
+                response_time=1000, time=time + timedelta(minutes=i))
+        with defer_predictive_model_update():
+            for i in range(10):
+                user, item = users[i % 2], items[i % 3]
+                Answer.objects.create(
+                    user=user, item=item, item_asked=item, item_answered=item,
+                    response_time=1000, time=time + timedelta(minutes=30 + i))
+        updated = self._load_counters()
+        self.assertEqual(30, sum([n for (u, i), (n, c, f, t) in updated.items() if u is None]))
+        # each of the 12 pairs (user, item) is answered by the first 12 answers
+        self.assertEqual(12, sum([f for (u, i), (n, c, f, t) in updated.items() if u is None]))
+        call_command('rebuild_answer_counters')
+        self.assertEqual(self._load_counters(), updated)
+
+    def test_environment(self):
+        user = User.objects.create(username='user')
+        items = [Item.objects.create() for i in range(3)]
+        for i in range(5):
+            Answer.objects.create(
+                user=user, item=items[0], item_asked=items[0], item_answered=items[1] if i % 2 else items[0],
+                response_time=1000, time=datetime(2016, 1, 1, 12, i))
+        environment = get_environment()
+        item_ids = [item.id for item in items]
+        with self.assertNumQueries(1):
+            self.assertEqual([5, 0, 0], environment.number_of_answers_more_items(item_ids, user=user.id))
+        self.assertEqual([3, 0, 0], environment.number_of_correct_answers_more_items(item_ids, user=user.id))
+        self.assertEqual(1, environment.number_of_first_answers(user=user.id))
+        self.assertEqual(datetime(2016, 1, 1, 12, 4), environment.last_answer_time(item=item_ids[0]))
+
+    def test_confusion_pairs(self):
+        users = [User.objects.create(username=str(i)) for i in range(2)]
+        items = [Item.objects.create() for i in range(4)]
+        for i, (user, asked, answered, guess) in enumerate([
+                (0, 0, 1, 0), (0, 1, 0, 0), (1, 0, 1, 0), (1, 0, 2, 0.5), (1, 2, 3, 0), (1, 2, None, 0), (0, 3, 3, 0)]):
+            Answer.objects.create(
+                user=users[user], item=items[asked], item_asked=items[asked],
+                item_answered=None if answered is None else items[answered], guess=guess,
+                response_time=1000, time=datetime(2016, 1, 1, 12, i))
+        environment = get_environment()
+        item_ids = [item.id for item in items]
+        with self.assertNumQueries(1):
+            self.assertEqual([3, 0, 0], environment.confusing_factor_more_items(item_ids[0], item_ids[1:]))
+        self.assertEqual([2, 0, 0], environment.confusing_factor_more_items(item_ids[0], item_ids[1:], user=users[0].id))
+        self.assertEqual([0, 1], environment.confusing_factor_more_items(item_ids[3], item_ids[1:3], user=users[1].id))
+        pairs = self._load_confusion_pairs()
+        call_command('rebuild_answer_counters')
+        self.assertEqual(self._load_confusion_pairs(), pairs)
+
+    def test_rolling_success(self):
+        user = User.objects.create(username='user')
+        item = Item.objects.create()
+        context = PracticeContext.objects.from_content({'name': 'context'})
+        with defer_predictive_model_update():
+            for i in range(70):
+                Answer.objects.create(
+                    user=user, item=item, item_asked=item, item_answered=item if i % 3 else None,
+                    context=context if i % 2 else None, response_time=1000, time=datetime(2016, 1, 1, 12, i % 60))
+        environment = get_environment()
+        with self.assertNumQueries(1):
+            self.assertAlmostEqual(0.6, environment.rolling_success(user.id))
+        self.assertAlmostEqual(0.5, environment.rolling_success(user.id, window_size=4, context=context.id))
+        self.assertIsNone(environment.rolling_success(user.id, window_size=40, context=context.id))
+        environment.use_answer_counters(False)
+        self.assertAlmostEqual(0.6, environment.rolling_success(user.id))
+        self.assertAlmostEqual(0.5, environment.rolling_success(user.id, window_size=4, context=context.id))
+        rolling_success = self._load_rolling_success()
+        call_command('rebuild_answer_counters')
+        self.assertEqual(self._load_rolling_success(), rolling_success)
+
+    def _load_rolling_success(self):
+        return {(r.user_id, r.context_id): (r.bits, r.size) for r in RollingSuccess.objects.all()}
+
+    def _load_confusion_pairs(self):
+        return {(p.user_id, p.item_primary_id, p.item_secondary_id): p.value for p in ConfusionPair.objects.all()}
+
+    def _load_counters(self):
+        return {
+            (c.user_id, c.item_id): (c.number_of_answers, c.number_of_correct_answers, c.number_of_first_answers, c.last_answer_time)
+            for c in AnswerCounter.objects.all()
+        }
+
+
+class RecomputeModelTest(test.TestCase):
+
+    def test_load_answers(self):
+        users = [User.objects.create(username=str(i)) for i in range(2)]
+        items = [Item.objects.create() for i in range(4)]
+        answers = [
+            Answer.objects.create(
+                user=users[i % 2], item=items[i % 3], item_asked=items[i % 3], item_answered=items[3] if i == 4 else None,
+                response_time=1000, time=datetime(2016, 1, 1, 12, i))
+            for i in range(5)
+        ]
+        info = EnvironmentInfo.objects.create(config=Config.objects.from_content({}), revision=0)
+        command = RecomputeModelCommand()
+        self.assertEqual(3, command.number_of_answers_to_process(info, limit=3))
+        loaded, loaded_users, loaded_items = command.load_answers(info, 3, 2)
+        self.assertEqual([a.id for a in answers[:3]], [a[0] for a in loaded])
+        self.assertEqual({u.id for u in users}, set(loaded_users))
+        self.assertEqual({i.id for i in items[:3]}, set(loaded_items))
+        info.last_answer_id = loaded[-1][0]
+        self.assertEqual(2, command.number_of_answers_to_process(info))
+        loaded, loaded_users, loaded_items = command.load_answers(info, 3, 2)
+        self.assertEqual([a.id for a in answers[3:]], [a[0] for a in loaded])
+        self.assertEqual({items[0].id, items[1].id, items[3].id}, set(loaded_items))
+
+    def test_late_answers(self):
+        user = User.objects.create(username='user')
+        item = Item.objects.create()
+        answers = [
+            Answer.objects.create(user=user, item=item, item_asked=item, item_answered=item, response_time=1000, time=datetime(2016, 1, 1, 12, i))
+            for i in range(4)
+        ]
+        command = RecomputeModelCommand()
+        gaps = {}
+        # the second answer is not committed yet when the batch is read
+        batch = [a for a in command.load_answers(None, 10, 10, last_answer_id=0)[0] if a[0] != answers[1].id]
+        command.track_gaps(gaps, answers[0].id - 1, batch, now=datetime.now() - timedelta(seconds=10))
+        self.assertEqual([answers[1].id], list(gaps.keys()))
+        self.assertEqual([answers[1].id], [a[0] for a in command.load_late_answers(gaps, 60)])
+        self.assertEqual({}, gaps)
+        command.track_gaps(gaps, answers[-1].id, [(answers[-1].id + 3,)], now=datetime.now() - timedelta(seconds=10))
+        self.assertEqual([], command.load_late_answers(gaps, 60))
+        self.assertEqual(2, len(gaps))
+        self.assertEqual([], command.load_late_answers(gaps, 5))
+        self.assertEqual({}, gaps)
+
+    def test_checkpoint_gaps(self):
+        config = Config.objects.from_content({})
+        info = EnvironmentInfo.objects.create(config=config, revision=1)
+        command = RecomputeModelCommand()
+        environment = command.load_environment(info)
+        environment.start_checkpoints()
+        gaps = {}
+        command.track_gaps(gaps, 10, [(11,), (14,)])
+        command.checkpoint(environment, info, gaps=gaps)
+        info.refresh_from_db()
+        # the restarted follow mode re-scans the gaps of the last checkpoint
+        now = datetime.now()
+        self.assertEqual({12: now, 13: now}, command.load_gaps(info, now=now))
+
+    def test_recompute_config(self):
+        user = User.objects.create(username='user')
+        items = [Item.objects.create() for i in range(2)]
+        answers = [
+            Answer.objects.create(
+                user=user, item=items[i % 2], item_asked=items[i % 2], item_answered=items[i % 2],
+                response_time=1000, time=datetime(2016, 1, 1, 12, i))
+            for i in range(4)
+        ]
+        config = Config.objects.from_content({'class': 'proso.models.prediction.PriorCurrentPredictiveModel'})
+        # the revision 0 is taken by the active environment info created by the answers
+        infos = [EnvironmentInfo.objects.create(config=config, revision=i + 1) for i in range(2)]
+        infos[1].last_answer_id = answers[1].id
+        infos[1].save()
+        command = RecomputeModelCommand()
+        batch = command.load_answers(None, 10, 10, last_answer_id=0)
+        self.assertEqual((4, 4), command.recompute_config('default', infos[0].id, *batch))
+        self.assertEqual((2, 2), command.recompute_config('default', infos[1].id, *batch))
+        for info in infos:
+            info.refresh_from_db()
+            self.assertEqual(answers[-1].id, info.last_answer_id)
+            self.assertTrue(Variable.objects.filter(info=info).exists())
+
+    def test_predictive_model(self):
+        config = Config.objects.from_content({'class': 'proso.models.prediction.AlwaysLearningPredictiveModel'})
+        info = EnvironmentInfo.objects.create(config=config, revision=1)
+        self.assertIsInstance(_predictive_model(info), AlwaysLearningPredictiveModel)
+
+    def test_gc(self):
+        users = [User.objects.create(username=str(i)) for i in range(5)]
+        config = Config.objects.from_content({})
+        infos = [
+            EnvironmentInfo.objects.create(config=config, revision=i, status=status)
+            for i, status in enumerate([EnvironmentInfo.STATUS_DISABLED, EnvironmentInfo.STATUS_ACTIVE])
+        ]
+        for info in infos:
+            for i, user in enumerate(users):
+                Variable.objects.create(info=info, key='key', user=user, value=i)
+                Audit.objects.create(info=info, key='key', user=user, value=i)
+        command = RecomputeModelCommand()
+        command.handle_gc({'dry_run': True, 'gc_chunk_size': 2, 'gc_rows_per_second': None})
+        self.assertEqual(10, Variable.objects.count())
+        command.handle_gc({'dry_run': False, 'gc_chunk_size': 2, 'gc_rows_per_second': 1000})
+        self.assertEqual({infos[1].id}, set(Variable.objects.values_list('info_id', flat=True)))
+        self.assertEqual({infos[1].id}, set(Audit.objects.values_list('info_id', flat=True)))
+        self.assertEqual([infos[1].id], [i.id for i in EnvironmentInfo.objects.all()])
@@ -0,0 +1,268 @@
+"""
+Optional partitioning of proso_models_variable and proso_models_audit by
+environment info (PostgreSQL only, table inheritance). Each partitioned
+environment info has its own child table '<table>_info_<id>' with the check
+constraint on info_id, the audit partition can be further divided into
+monthly child tables '<table>_info_<id>_<YYYYMM>' with the check constraint
+on time. The queries filtering by a constant info_id (and time) are pruned
+by the constraint exclusion, the partition of a disabled environment info is
+dropped at once (see 'recompute_model --garbage-collector').
+
+The rows inserted into the parent table are moved to the partitions by
+triggers (their functions are created by the migrations), the bulk loads
+write to :py:func:`partition_table` directly (enabled by
+'proso_models.partitioning.enabled' config). While the partition is
+attached, the parent table itself can not contain rows of its environment
+info (check constraint without inheritance), so the unique indexes of the
+partition hold for the parent and the partition together. The routed rows
+are not returned by 'INSERT ... RETURNING', so the new variables of the
+partitioned environment infos get their identifiers in advance (see
+:py:func:`next_variable_id`). On other databases all the functions do
+nothing.
+"""
+from contextlib import closing
+from datetime import date
+from django.db import connection
+from proso.django.config import get_config
+from proso.django.util import is_on_postgresql
+
+
+PARTITIONED_TABLES = ['proso_models_variable', 'proso_models_audit']
+TIME_PARTITIONED_TABLES = ['proso_models_audit']
+DETACHED_SUFFIX = '_detached'
+
+
+def is_partitioning_supported():
+    return is_on_postgresql()
+
+
+def is_partitioning_enabled():
+    return is_partitioning_supported() and get_config('proso_models', 'partitioning.enabled', default=False)
+
+
+def info_partition_name(table_name, info_id):
+    return '{}_info_{}'.format(table_name, info_id)
+
+
+def time_partition_name(table_name, info_id, month):
+    return '{}_{}'.format(info_partition_name(table_name, info_id), month.strftime('%Y%m'))
+
+
+def next_variable_id(info_id):
+    """
+    Returns:
+        int: identifier for the new variable of the given environment info
+        if it has to be assigned in advance (partitioning is enabled),
+        otherwise None
+    """
+    if info_id is None or not is_partitioning_enabled():
+        return None
+    with closing(connection.cursor()) as cursor:
+        cursor.execute("SELECT nextval(pg_get_serial_sequence('proso_models_variable', 'id'))")
+        return cursor.fetchone()[0]
+
+
+def info_partition(cursor, table_name, info_id):
+    """
+    Returns:
+        str: name of the attached partition of the given environment info,
+        None if there is no such partition
+    """
+    if not is_partitioning_supported() or info_id is None:
+        return None
+    partition = info_partition_name(table_name, info_id)
+    return partition if _exists(cursor, partition) else None
+
+
+def partition_table(table_name, info_id):
+    """
+    Returns the table where the rows of the given environment info should be
+    written, the partition if partitioning is enabled and the partition is
+    attached, otherwise the given table.
+    """
+    if info_id is None or not is_partitioning_enabled():
+        return table_name
+    with closing(connection.cursor()) as cursor:
+        partition = info_partition(cursor, table_name, info_id)
+    return table_name if partition is None else partition
+
+
+def list_partitions(cursor):
+    """
+    Returns:
+        list: (parent table, partition, estimated number of rows) for all
+        the partitions attached to the partitioned tables and their partitions
+    """
+    if not is_partitioning_supported():
+        return []
+    cursor.execute(
+        '''
+        WITH RECURSIVE partitions(parent, child) AS (
+            SELECT inhparent, inhrelid FROM pg_inherits WHERE inhparent::regclass::text IN %s
+            UNION ALL
+            SELECT pg_inherits.inhparent, pg_inherits.inhrelid
+            FROM pg_inherits INNER JOIN partitions ON pg_inherits.inhparent = partitions.child
+        )
+        SELECT parent::regclass::text, child::regclass::text, pg_class.reltuples::bigint
+        FROM partitions INNER JOIN pg_class ON pg_class.oid = partitions.child
+        ORDER BY 2
+        ''', [tuple(PARTITIONED_TABLES)])
+    return cursor.fetchall()
+
+
+def attach_partitions(info_id, months=None, chunk_size=10000):
+    """
+    Creates (or attaches the previously detached) partitions of the given
+    environment info and moves its rows there from the parent tables in
+    chunks of ids.
+
+    Args:
+        info_id (int): identifier of the environment info
+        months (list): first days of months (datetime.date) for which the
+            audit partitions should be created
+        chunk_size (int): width of the id ranges moved by one statement
+
+    Returns:
+        bool: False if partitioning is not supported by the database
+    """
+    if not is_partitioning_supported():
+        return False
+    with closing(connection.cursor()) as cursor:
+        for table_name in PARTITIONED_TABLES:
+            _ensure_trigger(cursor, table_name, 'info')
+            partition = info_partition_name(table_name, info_id)
+            if _exists(cursor, partition + DETACHED_SUFFIX):
+                cursor.execute('ALTER TABLE {} RENAME TO {}'.format(partition + DETACHED_SUFFIX, partition))
+            elif not _exists(cursor, partition):
+                _create_child(cursor, table_name, partition, 'info_id = {}'.format(int(info_id)), 'info_partition')
+            if not _inherits(cursor, partition, table_name):
+                cursor.execute('ALTER TABLE {} INHERIT {}'.format(partition, table_name))
+            if table_name in TIME_PARTITIONED_TABLES:
+                _ensure_trigger(cursor, partition, 'time')
+            _move_rows(cursor, table_name, partition, 'info_id = %s', [info_id], chunk_size)
+            if not _has_constraint(cursor, table_name, _excluded_constraint(info_id)):
+                cursor.execute('ALTER TABLE ONLY {} ADD CONSTRAINT {} CHECK (info_id IS DISTINCT FROM {}) NO INHERIT'.format(
+                    table_name, _excluded_constraint(info_id), int(info_id)))
+        for month in (months if months is not None else []):
+            add_time_partition(cursor, 'proso_models_audit', info_id, month, chunk_size=chunk_size)
+    return True
+
+
+def add_time_partition(cursor, table_name, info_id, month, chunk_size=10000):
+    """
+    Creates the partition of the given month within the (attached) partition
+    of the environment info and moves the rows of the month there.
+    """
+    parent = info_partition_name(table_name, info_id)
+    partition = time_partition_name(table_name, info_id, month)
+    if _exists(cursor, partition):
+        return
+    next_month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+    condition = 'time >= %s AND time < %s'
+    params = [month.strftime('%Y-%m-%d'), next_month.strftime('%Y-%m-%d')]
+    _create_child(cursor, table_name, partition, 'info_id = {}'.format(int(info_id)), 'info_partition')
+    cursor.execute('ALTER TABLE {} ADD CONSTRAINT time_partition CHECK ({})'.format(partition, condition), params)
+    cursor.execute('ALTER TABLE {} INHERIT {}'.format(partition, parent))
+    _move_rows(cursor, parent, partition, condition, params, chunk_size)
+
+
+def detach_partitions(info_id):
+    """
+    Detaches the partitions of the given environment info, their rows are
+    not visible through the parent tables anymore and the tables are renamed
+    to '<partition>_detached', so they can be archived or attached again.
+
+    Returns:
+        bool: False if partitioning is not supported by the database
+    """
+    if not is_partitioning_supported():
+        return False
+    with closing(connection.cursor()) as cursor:
+        for table_name in PARTITIONED_TABLES:
+            partition = info_partition(cursor, table_name, info_id)
+            if partition is None:
+                continue
+            cursor.execute('ALTER TABLE {} NO INHERIT {}'.format(partition, table_name))
+            cursor.execute('ALTER TABLE {} RENAME TO {}'.format(partition, partition + DETACHED_SUFFIX))
+            _drop_excluded_constraint(cursor, table_name, info_id)
+    return True
+
+
+def drop_partition(cursor, table_name, info_id):
+    """
+    Drops the partition (including its time partitions) of the given
+    environment info.
+
+    Returns:
+        str: name of the dropped partition, None if there is no partition
+    """
+    partition = info_partition(cursor, table_name, info_id)
+    if partition is None:
+        return None
+    cursor.execute('DROP TABLE {} CASCADE'.format(partition))
+    _drop_excluded_constraint(cursor, table_name, info_id)
+    return partition
+
+
+def _exists(cursor, table_name):
+    cursor.execute('SELECT to_regclass(%s)', [table_name])
+    return cursor.fetchone()[0] is not None
+
+
+def _inherits(cursor, child, parent):
+    cursor.execute(
+        'SELECT COUNT(*) FROM pg_inherits WHERE inhrelid = to_regclass(%s) AND inhparent = to_regclass(%s)',
+        [child, parent])
+    return cursor.fetchone()[0] > 0
+
+
+def _create_child(cursor, table_name, child, check, check_name):
+    # the child shares the sequence of ids with the parent (default values)
+    cursor.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING INDEXES)'.format(child, table_name))
+    cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} CHECK ({})'.format(child, check_name, check))
+
+
+def _has_constraint(cursor, table_name, constraint):
+    cursor.execute(
+        'SELECT COUNT(*) FROM pg_constraint WHERE conrelid = to_regclass(%s) AND conname = %s',
+        [table_name, constraint])
+    return cursor.fetchone()[0] > 0
+
+
+def _excluded_constraint(info_id):
+    # rows of the partitioned environment info are not allowed in the parent
+    return 'info_{}_excluded'.format(int(info_id))
+
+
+def _drop_excluded_constraint(cursor, table_name, info_id):
+    cursor.execute('ALTER TABLE ONLY {} DROP CONSTRAINT IF EXISTS {}'.format(table_name, _excluded_constraint(info_id)))
+
+
+def _ensure_trigger(cursor, table_name, mode):
+    cursor.execute(
+        'SELECT COUNT(*) FROM pg_trigger WHERE tgrelid = to_regclass(%s) AND tgname = %s',
+        [table_name, 'proso_models_route_partition'])
+    if cursor.fetchone()[0] > 0:
+        return
+    cursor.execute(
+        '''
+        CREATE TRIGGER proso_models_route_partition BEFORE INSERT ON {}
+        FOR EACH ROW EXECUTE PROCEDURE proso_models_route_partition('{}')
+        '''.format(table_name, mode))
+
+
+def _move_rows(cursor, source, target, condition, params, chunk_size):
+    # the rows written to the target while the rows were moved are newer
+    cursor.execute('SELECT MIN(id), MAX(id) FROM ONLY {} WHERE {}'.format(source, condition), params)
+    min_id, max_id = cursor.fetchone()
+    if min_id is None:
+        return
+    for lower in range(min_id, max_id + 1, chunk_size):
+        cursor.execute(
+            '''
+            WITH moved AS (
+                DELETE FROM ONLY {} WHERE {} AND id >= %s AND id < %s RETURNING *
+            )
+            INSERT INTO {} SELECT * FROM moved ON CONFLICT DO NOTHING
+            '''.format(source, condition, target),
+            params + [lower, lower + chunk_size])
@@ -0,0 +1,87 @@
+from .environment import DatabaseEnvironment, InMemoryDatabaseFlushEnvironment
+from .management.commands.recompute_model import Command as RecomputeModelCommand
+from .models import Audit, EnvironmentInfo, Variable
+from .partitions import attach_partitions, detach_partitions, info_partition, is_partitioning_supported, next_variable_id, partition_table
+from contextlib import closing
+from datetime import date, datetime
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection, transaction
+from proso.django.config import override, reset_overridden
+from proso_common.models import Config
+import django.test as test
+import shutil
+import tempfile
+import unittest
+
+
+class PartitionsTest(test.TestCase):
+
+    def setUp(self):
+        self._user = User.objects.create(username='user')
+        config = Config.objects.from_content({})
+        self._info = EnvironmentInfo.objects.create(config=config, revision=0, status=EnvironmentInfo.STATUS_DISABLED)
+        override('proso_models.partitioning.enabled', True)
+        self._data_dir = tempfile.mkdtemp()
+        self._settings = self.settings(DATA_DIR=self._data_dir)
+        self._settings.enable()
+
+    def tearDown(self):
+        reset_overridden()
+        self._settings.disable()
+        shutil.rmtree(self._data_dir)
+
+    @unittest.skipIf(is_partitioning_supported(), 'the database supports partitioning')
+    def test_noop(self):
+        self.assertFalse(attach_partitions(self._info.id))
+        self.assertFalse(detach_partitions(self._info.id))
+        self.assertEqual('proso_models_variable', partition_table('proso_models_variable', self._info.id))
+        with closing(connection.cursor()) as cursor:
+            self.assertIsNone(info_partition(cursor, 'proso_models_variable', self._info.id))
+
+    @unittest.skipUnless(is_partitioning_supported(), 'the database does not support partitioning')
+    def test_attach_and_detach(self):
+        Variable.objects.create(info=self._info, key='moved', user=self._user, value=1, audit=False)
+        self.assertTrue(attach_partitions(self._info.id, months=[date(2016, 1, 1)], chunk_size=1))
+        self.assertEqual('proso_models_variable_info_{}'.format(self._info.id), partition_table('proso_models_variable', self._info.id))
+        routed = Variable.objects.create(id=next_variable_id(self._info.id), info=self._info, key='routed', user=self._user, value=2, audit=False)
+        self.assertEqual(routed.id, Variable.objects.get(info=self._info, key='routed').id)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Variable.objects.create(id=next_variable_id(self._info.id), info=self._info, key='routed', user=self._user, value=3, audit=False)
+        Audit.objects.bulk_create([
+            Audit(info=self._info, key='routed', user=self._user, value=2, time=datetime(2016, 1, 15)),
+            Audit(info=self._info, key='routed', user=self._user, value=3, time=datetime(2016, 2, 15)),
+        ])
+        self.assertEqual({'moved': 1, 'routed': 2}, dict(Variable.objects.filter(info=self._info).values_list('key', 'value')))
+        self.assertEqual(0, self._count('ONLY proso_models_variable'))
+        self.assertEqual(2, self._count('proso_models_variable_info_{}'.format(self._info.id)))
+        self.assertEqual(0, self._count('ONLY proso_models_audit'))
+        self.assertEqual(1, self._count('proso_models_audit_info_{}_201601'.format(self._info.id)))
+        self.assertEqual(1, self._count('ONLY proso_models_audit_info_{}'.format(self._info.id)))
+        environment = DatabaseEnvironment(info_id=self._info.id)
+        self.assertEqual(2, environment.read('routed', user=self._user.id))
+        self.assertTrue(detach_partitions(self._info.id))
+        self.assertFalse(Variable.objects.filter(info=self._info).exists())
+        DatabaseEnvironment(info_id=self._info.id).write('detached', 1, user=self._user.id)
+        self.assertEqual(1, self._count('ONLY proso_models_variable'))
+        self.assertTrue(attach_partitions(self._info.id))
+        self.assertEqual(3, Variable.objects.filter(info=self._info).count())
+        self.assertEqual(0, self._count('ONLY proso_models_variable'))
+
+    @unittest.skipUnless(is_partitioning_supported(), 'the database does not support partitioning')
+    def test_flush_and_gc(self):
+        attach_partitions(self._info.id)
+        env = InMemoryDatabaseFlushEnvironment(self._info)
+        env.write('key', 1, user=self._user.id, time=datetime(2016, 1, 1))
+        env.flush(clean=False)
+        self.assertEqual(0, self._count('ONLY proso_models_variable'))
+        self.assertEqual(1, self._count('proso_models_variable_info_{}'.format(self._info.id)))
+        RecomputeModelCommand().handle_gc({'dry_run': False, 'gc_chunk_size': 10, 'gc_rows_per_second': None})
+        self.assertFalse(EnvironmentInfo.objects.filter(id=self._info.id).exists())
+        with closing(connection.cursor()) as cursor:
+            self.assertIsNone(info_partition(cursor, 'proso_models_variable', self._info.id))
+            self.assertIsNone(info_partition(cursor, 'proso_models_audit', self._info.id))
+
+    def _count(self, table_name):
+        with closing(connection.cursor()) as cursor:
+            cursor.execute('SELECT COUNT(*) FROM {}'.format(table_name))
+            return cursor.fetchone()[0]
@@ -1,7 +1,7 @@
 from . import json_enrich
 from .models import get_environment, get_predictive_model, get_item_selector, get_active_environment_info, \
     Answer, Item, recommend_users as models_recommend_users, PracticeContext, \
-    learning_curve as models_learning_curve, get_filter, get_mastery_trashold
+    learning_curve as models_learning_curve, get_filter, get_mastery_trashold, defer_predictive_model_update
 from django.contrib.admin.views.decorators import staff_member_required
 from django.db import transaction
 from django.http import HttpResponse, HttpResponseBadRequest
@@ -460,11 +460,12 @@ def _save_answers(request, practice_context):
     timer('_save_answers')
     json_objects = _get_answers(request)
     answers = []
-    for json_object in json_objects:
-        if 'answer_class' not in json_object:
-            raise BadRequestException('The answer does not contain key "answer_class".')
-        answer_class = Answer.objects.answer_class(json_object['answer_class'])
-        answers.append(answer_class.objects.from_json(json_object, practice_context, request.user.id))
+    with defer_predictive_model_update():
+        for json_object in json_objects:
+            if 'answer_class' not in json_object:
+                raise BadRequestException('The answer does not contain key "answer_class".')
+            answer_class = Answer.objects.answer_class(json_object['answer_class'])
+            answers.append(answer_class.objects.from_json(json_object, practice_context, request.user.id))
     LOGGER.debug("saving of %s answers took %s seconds", len(answers), timer('_save_answers'))
     return answers
 